@@ -2,16 +2,19 @@ import os
 import sys
 import requests
 import json
-from flask import Flask, request, abort
+from flask import Flask, Response, request, abort, g, jsonify
 from flask_apscheduler import APScheduler
-import logging
 import socket
 import time
-from datetime import datetime
-import secrets
-from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric import padding
-import base64
+import functools
+from datetime import datetime, timedelta
+import asyncio
+from apscheduler.jobstores.base import JobLookupError
+from licensing import LicensingClient, AsyncLicensingClient, EventLoopThread, CheckinSchedule, checkin_hint, httpx
+from challenge import CheckinChallenge
+from metrics import Family, exposition, EXPOSITION_CONTENT_TYPE
+from fibonacci import FibonacciEngine, fib_linear
+from logs import LogPipeline
 
 hostIP = "0.0.0.0"
 serverPort = 9090
@@ -22,9 +25,72 @@ username = os.getenv("USERNAME", "tester")
 password = os.getenv("PASSWORD", "testpwd")    
 authsrvr_url = os.getenv("AUTH_SERVER", "http://localhost:5000")
 container_id = socket.gethostname()
-max_checkin_failure = os.getenv("MAX_CHECKIN_FAILURE", 1)
+# the App shuts down after more than MAX_CHECKIN_FAILURE failed checkins in
+# a row (0 does not count them), the answers of a busy server not counted,
+# and at the latest once it went LEASE_TTL seconds without a successful
+# checkin, when the server revokes its license too (0 never does)
+lease_ttl = float(os.getenv("LEASE_TTL", 300))
+max_checkin_failure = int(os.getenv("MAX_CHECKIN_FAILURE", 3))
 failed_checkin_count = 0
-message_bytes = b''
+last_checkin_success = time.monotonic()
+
+# key algorithm asked for (rsa or x25519), the server picks one if empty
+key_algorithm = os.getenv("KEY_ALGORITHM", "")
+
+# protocol mode of the checkin challenges: rsa or session
+checkin_mode = os.getenv("CHECKIN_MODE", "rsa").lower()
+challenge = None
+
+# lease token of the last grant or checkin, lets the server answer the
+# session checkins without reading its database
+lease_token = None
+
+# connection settings for the Authorizing Server
+auth_connect_timeout = float(os.getenv("AUTH_CONNECT_TIMEOUT", 3))
+auth_read_timeout = float(os.getenv("AUTH_READ_TIMEOUT", 10))
+auth_pool_size = int(os.getenv("AUTH_POOL_SIZE", 4))
+auth_http2 = os.getenv("AUTH_HTTP2", "false").lower() in ("1", "true", "yes")
+checkin_async = os.getenv("CHECKIN_ASYNC", "true").lower() in ("1", "true", "yes") and httpx is not None
+
+# pooled keep-alive client for the licensing calls
+client = LicensingClient(authsrvr_url, auth_connect_timeout, auth_read_timeout, auth_pool_size)
+
+# the checkins run on an asyncio loop, so they never hold a scheduler thread
+checkin_loop = None
+async_client = None
+
+# pacing of the checkins: jittered interval, exponential backoff on errors
+checkin_schedule = CheckinSchedule(
+    interval=float(os.getenv("CHECKIN_INTERVAL", 10)),
+    jitter=float(os.getenv("CHECKIN_JITTER", 0.2)),
+    backoff_cap=float(os.getenv("CHECKIN_BACKOFF_CAP", 300)),
+)
+shutting_down = False
+
+# the Fibonacci workload: largest number served, cached results, numbers per batch
+fibonacci_engine = FibonacciEngine(
+    max_n=int(os.getenv("FIB_MAX_N", 100000)),
+    cache_size=int(os.getenv("FIB_CACHE_SIZE", 1024)),
+)
+fib_batch_max = int(os.getenv("FIB_BATCH_MAX", 1000))
+# F(n) has about 0.209 * n decimal digits, above the default limit of str() on newer Pythons
+if hasattr(sys, "set_int_max_str_digits"):
+    sys.set_int_max_str_digits(max(sys.get_int_max_str_digits(), int(0.21 * fibonacci_engine.max_n) + 16))
+
+# metrics served at /metrics
+request_duration = Family(
+    "app_http_request_duration_seconds", "Latency of the requests by route", "histogram", ("method", "route")
+)
+checkin_duration = Family(
+    "app_checkin_duration_seconds", "Round trip of the checkins to the Authorizing Server", "histogram", ("mode",)
+)
+checkins_total = Family(
+    "app_checkins_total", "Checkins by result", "counter", ("mode", "result")
+)
+fibonacci_duration = Family(
+    "app_fibonacci_duration_seconds", "Time spent computing Fibonacci numbers by algorithm", "histogram", ("algorithm",)
+)
+METRICS = [request_duration, checkin_duration, checkins_total, fibonacci_duration]
 
 # create app
 app = Flask(__name__)
@@ -35,34 +101,89 @@ scheduler = APScheduler()
 scheduler.init_app(app)
 scheduler.start()
 
-# config logger
-logging.basicConfig(format='%(asctime)s | [%(levelname)s] | %(message)s', datefmt='%m/%d/%Y | %I:%M:%S %p')
-# app.logger.setLevel(logging.INFO)
-app.logger.setLevel(logging.DEBUG)
+# config logger: JSON lines (or text, LOG_FORMAT) written by a background
+# thread from a queue of LOG_QUEUE_SIZE records, keeping the info and debug
+# records of only a share of the busy routes (LOG_SAMPLING, e.g.
+# "/fibonacci*=0.1,checkin=0.5"), see logs.py
+log_pipeline = LogPipeline(
+    os.getenv("LOGGING_LEVEL", "INFO"),
+    os.getenv("LOG_FORMAT", "json"),
+    int(os.getenv("LOG_QUEUE_SIZE", 10000)),
+    os.getenv("LOG_SAMPLING", ""),
+)
+log_pipeline.install(app.logger)
+log_pipeline.start()
 # logging.getLogger('apscheduler').setLevel(logging.INFO)
 
 
 ######################################################################
 #  U t i l i t y    f u n c t i o n s
 ######################################################################
+def remember_lease_token(token, keep=False):
+    """ Keeps the lease token for the next checkins, `keep` the current one if None """
+    global lease_token
+    if token or not keep:
+        lease_token = token
+
+def count_checkin(result):
+    """ Counts a checkin by its result in the metrics """
+    checkins_total.labels(checkin_mode, result).inc()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.log_token = log_pipeline.start_request(request.url_rule.rule if request.url_rule else "unmatched")
+
+@app.teardown_request
+def end_request_logs(error=None):
+    """ Ends the sampling of the logs of the request """
+    if "log_token" in g:
+        log_pipeline.end_request(g.pop("log_token"))
+
+@app.after_request
+def observe_response(response):
+    """ Records the latency of the request in the metrics """
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    started = g.get("request_started", time.perf_counter())
+    request_duration.labels(request.method, route).observe(time.perf_counter() - started)
+    return response
 def shutdown_server(msg=None):
+    """ Stops the checkins and the App, returns False if the App could not be stopped """
+    global shutting_down
+    shutting_down = True
     app.logger.info(msg)
-    scheduler.remove_job('checkin')
-    res = requests.get("http://{}:{}/shutdown".format(self_ip, serverPort))
+    try:
+        scheduler.remove_job('checkin')
+    except JobLookupError:
+        pass
+    try:
+        requests.get("http://{}:{}/shutdown".format(self_ip, serverPort), timeout=auth_read_timeout)
+    except requests.exceptions.RequestException:
+        # keep checking in rather than running on without a heartbeat
+        app.logger.exception("Error: failed to shut down the server.")
+        shutting_down = False
+        return False
+    return True
 
 
 ######################################################################
 #  L I C E N S I N G    r e l a t e d    f u n c t i o n s
 ######################################################################
 def get_license():
+    global lease_token, last_checkin_success
+
     data = {
         "username": username,
         "password": password,
         "used_by": container_id
     }
+    if key_algorithm:
+        data["key_algorithm"] = key_algorithm
 
-    res = requests.post(authsrvr_url + '/licenses', json = data)
+    res = client.get_license(data)
     lic = json.loads(res.text)
+    lease_token = res.headers.get("X-Lease-Token")
+    last_checkin_success = time.monotonic()
     return lic
 
 def revoke_license(license_id):
@@ -71,90 +192,171 @@ def revoke_license(license_id):
         "revoked_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
     }
 
-    res = requests.patch(authsrvr_url + '/licenses/' + str(license_id), json = data)
+    res = client.revoke_license(license_id, data)
     return res
 
-def periodically_checkin(license_id, license_pub_key):
-    global failed_checkin_count, max_checkin_failure, message_bytes
-
-    # generate a random message
-    message_bytes = secrets.token_bytes()
-    app.logger.debug("message_bytes: {}".format(message_bytes))
-
-    # encrypt the message
-    pub_key_obj = serialization.load_pem_public_key(license_pub_key.encode('UTF-8','strict'))
-    encrypted_message_bytes = pub_key_obj.encrypt(
-        message_bytes,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
-    )
-    app.logger.debug("encrypted_message_bytes: {}".format(encrypted_message_bytes))
-
+def build_checkin(license_pub_key):
+    # a fresh challenge of the checkin mode, see challenge.py
     data = {
         "used_by": container_id,
         "pub_key": license_pub_key,
-        # send the encrypted_message as ascii string
-        "encrypted_message": base64.b64encode(encrypted_message_bytes).decode('ascii','strict')
     }
-    app.logger.debug("data['encrypted_message']: {}".format(data['encrypted_message']))
+    data.update(challenge.build())
+    if lease_token:
+        data["lease_token"] = lease_token
+    app.logger.debug("checkin challenge: %s", data)
+    return data
+
+def handle_checkin_response(status_code, text, headers):
+    """ Checks the response of a checkin, returns True if it succeeded """
+    global failed_checkin_count, last_checkin_success
+
+    if status_code == 200:
+
+        # the answer is the decrypted message, or the tag of the nonce
+        app.logger.debug("checkin answer: %s", text)
+        if not challenge.verify(text):
+            app.logger.error("Error: the message does not match!")
+            count_checkin("mismatch")
+            failed_checkin_count += 1
+            return False
+
+        app.logger.info("successfully finished checkin without issue!")
+        count_checkin("success")
+        failed_checkin_count = 0
+        last_checkin_success = time.monotonic()
+        return True
+
+    elif status_code == 409:
+        # the server has no session for this license (anymore), open a new one
+        app.logger.warning("Warning: checkin session expired, opening a new one.")
+        count_checkin("session_expired")
+        challenge.reset_session()
+        remember_lease_token(None)
+        return False
+    elif status_code in (429, 503) and "Retry-After" in headers:
+        # the server is overloaded for a while, not a failure of this App
+        app.logger.warning("Warning: the server is busy, checking in again later.")
+        count_checkin("throttled")
+        return False
+    elif status_code >= 400 and status_code < 500:
+        app.logger.error("Error: checkin verification failed.")
+        count_checkin("client_error")
+    elif status_code >= 500:
+        app.logger.error("Error: server side error, try again.")
+        count_checkin("server_error")
+    failed_checkin_count += 1
+    return False
+
+def schedule_checkin(license_id, license_pub_key, delay):
+    """ Schedules the next checkin in `delay` seconds """
+    if shutting_down:
+        return
+    app.logger.debug("next checkin in %.1f seconds", delay)
+    scheduler.add_job(
+        func=periodically_checkin,
+        id='checkin',
+        trigger='date',
+        run_date=datetime.now() + timedelta(seconds=delay),
+        args=[license_id, license_pub_key],
+        replace_existing=True,
+        misfire_grace_time=None,
+    )
 
-    with scheduler.app.app_context():
-        while True:
-            if failed_checkin_count > max_checkin_failure:
-                shutdown_server("Error: failed checkin count exceed max_checkin_failure.")
-                return
-
-            try:
-                res = requests.post(authsrvr_url + '/licenses/' + str(license_id) + '/checkin', json = data)
-
-                if res.status_code == 200:
-
-                    # convert the decrypted_message from ascii string to bytes
-                    decrypted_message = res.text
-                    app.logger.debug("decrypted_message: {}".format(decrypted_message))
-                    decrypted_message_bytes = base64.b64decode(decrypted_message.encode('ascii', 'strict'))
-                    app.logger.debug("decrypted_message_bytes: {}".format(decrypted_message_bytes))
-
-                    if decrypted_message_bytes != message_bytes:
-                        app.logger.error("Error: the message does not match!")
-                        failed_checkin_count += 1
-                        break
-
-                    app.logger.info("successfully finished checkin without issue!")
-                    failed_checkin_count = 0
-                    break
-
-                elif res.status_code >= 400 and res.status_code < 500:
-                    app.logger.error("Error: checkin verification failed.")
-                    failed_checkin_count += 1
-                    break
-                elif res.status_code >= 500:
-                    app.logger.error("Error: server side error, try again.")
-                    failed_checkin_count += 1
-                    time.sleep(30)
-            except:
-                app.logger.error("Error: failed to POST /checkin")
-                failed_checkin_count += 1
-                break
+def after_checkin(license_id, license_pub_key, succeeded, hint):
+    """Shuts down once the lease has run out, otherwise schedules the next checkin
+
+    Every checkin ends here, and the next one is scheduled whatever fails
+    before, so that the App never keeps running without a heartbeat
+    """
+    delay = checkin_schedule.interval
+    try:
+        unchecked = time.monotonic() - last_checkin_success
+        reason = None
+        if lease_ttl and unchecked > lease_ttl:
+            reason = "Error: no successful checkin for {:.0f} seconds, the lease has expired.".format(unchecked)
+        elif max_checkin_failure and failed_checkin_count > max_checkin_failure:
+            reason = "Error: failed checkin count exceed max_checkin_failure."
+        if reason and shutdown_server(reason):
+            return
+        delay = checkin_schedule.next_delay(succeeded, hint)
+        if not succeeded and lease_ttl and unchecked < lease_ttl:
+            # the last try of a backoff happens before the lease runs out
+            delay = min(delay, lease_ttl - unchecked)
+    except Exception:  # pylint: disable=broad-except
+        app.logger.exception("Error: failed to handle the checkin.")
+    schedule_checkin(license_id, license_pub_key, delay)
+
+def checkin_done(license_id, license_pub_key, future):
+    """ Logs a checkin of the asyncio loop that failed before its end, and schedules the next one """
+    if not future.cancelled() and future.exception() is None:
+        return
+    error = None if future.cancelled() else future.exception()
+    app.logger.error("Error: the checkin did not complete.", exc_info=error)
+    schedule_checkin(license_id, license_pub_key, checkin_schedule.next_delay(False))
+
+def periodically_checkin(license_id, license_pub_key):
+    global failed_checkin_count
+
+    if async_client:
+        # hand the checkin over to the asyncio loop and free the job thread
+        future = checkin_loop.submit(checkin_once_async(license_id, license_pub_key))
+        future.add_done_callback(functools.partial(checkin_done, license_id, license_pub_key))
+        return
+
+    succeeded, hint = False, None
+    try:
+        data = build_checkin(license_pub_key)
+        started = time.perf_counter()
+        res = client.checkin(license_id, data)
+        checkin_duration.labels(checkin_mode).observe(time.perf_counter() - started)
+        with log_pipeline.sampled("checkin"):
+            succeeded = handle_checkin_response(res.status_code, res.text, res.headers)
+        hint = checkin_hint(res.headers)
+        remember_lease_token(res.headers.get("X-Lease-Token"), keep=True)
+    except:
+        app.logger.exception("Error: failed to POST /checkin")
+        count_checkin("connection_error")
+        failed_checkin_count += 1
+    finally:
+        after_checkin(license_id, license_pub_key, succeeded, hint)
+
+async def checkin_once_async(license_id, license_pub_key):
+    global failed_checkin_count
+
+    succeeded, hint = False, None
+    try:
+        data = build_checkin(license_pub_key)
+        started = time.perf_counter()
+        res = await async_client.checkin(license_id, data)
+        checkin_duration.labels(checkin_mode).observe(time.perf_counter() - started)
+        with log_pipeline.sampled("checkin"):
+            succeeded = handle_checkin_response(res.status_code, res.text, res.headers)
+        hint = checkin_hint(res.headers)
+        remember_lease_token(res.headers.get("X-Lease-Token"), keep=True)
+    except:
+        app.logger.exception("Error: failed to POST /checkin")
+        count_checkin("connection_error")
+        failed_checkin_count += 1
+    finally:
+        # shutting down calls back into this App, keep that off the loop
+        await asyncio.get_running_loop().run_in_executor(
+            None, after_checkin, license_id, license_pub_key, succeeded, hint
+        )
 
 
 ######################################################################
 #  E X A M P L E    C O N T A I N E R I Z E D    A P P
 ######################################################################
-def fib(n):
-    if n == 0:
-        return 0
-    if n == 1:
-        return 1
-    minusTwo = 0
-    minusOne = 1
-    for i in range(2, n + 1):
-        answer = minusOne + minusTwo
-        minusTwo = minusOne
-        minusOne = answer
+def fib(n, algorithm="doubling"):
+    """ Computes F(n), `algorithm` linear runs the former loop for comparison """
+    started = time.perf_counter()
+    if algorithm == "linear":
+        fibonacci_engine.check(n)
+        answer = fib_linear(n)
+    else:
+        answer = fibonacci_engine.compute(n)
+    fibonacci_duration.labels(algorithm).observe(time.perf_counter() - started)
     return answer
 
 @app.route("/")
@@ -165,17 +367,52 @@ def hello():
 def fibonacci():
     try:
         start_time = time.time_ns()
-        app.logger.info("{} | Got a request: {}".format(start_time, request.args.get("number")))
+        app.logger.info("%d | Got a request: %s", start_time, request.args.get("number"))
         n = int(request.args.get("number"))
     except:
         abort(400)
+    algorithm = request.args.get("algorithm", "doubling")
+    if algorithm not in ("doubling", "linear"):
+        abort(400, "algorithm must be doubling or linear")
 
-    answer = str(fib(n))
+    try:
+        answer = str(fib(n, algorithm))
+    except ValueError as error:
+        abort(400, str(error))
     end_time = time.time_ns()
-    app.logger.info("{} | Returning Answer: {}".format(end_time, answer))
-    app.logger.info("{} | Total time: {} nanoseconds".format(end_time, end_time - start_time))
+    app.logger.debug("%d | Returning Answer: %s", end_time, answer)
+    app.logger.info("%d | Total time: %d nanoseconds", end_time, end_time - start_time)
     return "time consumed: {} | answer: {}\n".format(end_time - start_time, answer), 200
 
+@app.route("/fibonacci/batch", methods = ['POST'])
+def fibonacci_batch():
+    """ Computes the Fibonacci numbers of a list of numbers in one call """
+    start_time = time.time_ns()
+    numbers = request.get_json(silent=True)
+    if not isinstance(numbers, list) or not numbers:
+        abort(400, "Request body must be a non-empty list of numbers")
+    if len(numbers) > fib_batch_max:
+        abort(400, "A batch holds at most {} numbers".format(fib_batch_max))
+
+    started = time.perf_counter()
+    try:
+        answers = fibonacci_engine.compute_many(numbers)
+    except ValueError as error:
+        abort(400, str(error))
+    fibonacci_duration.labels("batch").observe(time.perf_counter() - started)
+
+    end_time = time.time_ns()
+    app.logger.info("Computed a batch of %d numbers in %d nanoseconds", len(numbers), end_time - start_time)
+    # the answers are strings, they outgrow the integers of most JSON parsers
+    return jsonify(
+        time_consumed=end_time - start_time,
+        answers=[{"number": n, "answer": str(answer)} for n, answer in zip(numbers, answers)],
+    ), 200
+
+@app.route("/metrics", methods = ['GET'])
+def metrics():
+    return Response(exposition(METRICS), 200, content_type=EXPOSITION_CONTENT_TYPE)
+
 @app.route('/shutdown', methods = ['GET'])
 def shutdown():
     func = request.environ.get('werkzeug.server.shutdown')
@@ -193,27 +430,35 @@ if __name__ == "__main__":
     try:
         # activate a license
         lic = get_license()
-        print("license", type(lic), lic)
+        app.logger.debug("license: %s", lic)
         if not lic:
             sys.exit("Error: failed to get license.")
 
-        # schedule periodical checkin cron job
-        scheduler.add_job(
-            func=periodically_checkin,
-            id='checkin',
-            trigger='interval', 
-            args=[lic["id"], lic["pub_key"]],
-            seconds=10, 
-            max_instances=1,
-            # misfire_grace_time=60,
-        )
+        # the challenges of the checkins of this license, licenses of
+        # servers that do not report a key algorithm are rsa
+        app.logger.info("license key algorithm: %s", lic.get("key_algorithm") or "rsa")
+        challenge = CheckinChallenge(lic["id"], lic["pub_key"], checkin_mode)
+
+        # start the asyncio loop for the checkins
+        if checkin_async:
+            checkin_loop = EventLoopThread()
+            async_client = AsyncLicensingClient(
+                authsrvr_url, auth_connect_timeout, auth_read_timeout, auth_pool_size, auth_http2
+            )
+
+        # schedule the first checkin, every checkin schedules the next one
+        schedule_checkin(lic["id"], lic["pub_key"], checkin_schedule.first_delay())
 
         # start the application
         app.run(host=hostIP, port=serverPort)
 
         # shutdown the scheduler after the flask app exits 
+        shutting_down = True
         scheduler.remove_all_jobs()
         scheduler.shutdown()
+        if checkin_loop:
+            checkin_loop.submit(async_client.close()).result()
+            checkin_loop.stop()
 
         # graceful exit
         while True:
@@ -228,7 +473,7 @@ if __name__ == "__main__":
                 print("Error: server side error, try again.")
                 time.sleep(30)
 
-    except requests.exceptions.ConnectionError:
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
         sys.exit("Error: cannot connect to Authorizing Server")
 
     except SystemExit:
@@ -0,0 +1,139 @@
+"""
+Checkin challenges of the App
+
+Every checkin proves the Authorizing Server holds the private key of the
+license. Two protocol modes are supported:
+
+rsa - every checkin sends a random message encrypted with the pub_key, the
+    server answers with the decrypted message.
+session - the first checkin sends a random session key encrypted with the
+    pub_key, every later checkin sends a random nonce with its HMAC under
+    the session key (the proof), the server answers with the HMAC of the
+    same nonce under a different label. Only the first checkin costs a public key
+    operation on either side.
+
+A fresh random message or nonce per checkin means an answer recorded from an
+earlier checkin never matches, in both modes.
+
+The pub_key of the license is either RSA (encrypted with OAEP) or X25519
+(encrypted ECIES style: an ephemeral X25519 key, HKDF-SHA256 and AES-GCM,
+sent as `ephemeral public key | nonce | ciphertext`). The algorithm follows
+the type of the pub_key handed out by the server.
+"""
+
+import hmac
+import base64
+import hashlib
+import secrets
+from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives.asymmetric import padding, x25519
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+CHECKIN_MODES = ("rsa", "session")
+
+# must match the Authorizing Server (service/crypto.py)
+SESSION_KEY_BYTES = 32
+NONCE_BYTES = 32
+X25519_INFO = b"license-checkin"
+GCM_NONCE_BYTES = 12
+
+OAEP = padding.OAEP(
+    mgf=padding.MGF1(algorithm=hashes.SHA256()),
+    algorithm=hashes.SHA256(),
+    label=None
+)
+
+
+def b64(data):
+    """ Converts bytes to an ascii string """
+    return base64.b64encode(data).decode('ascii', 'strict')
+
+
+def session_tag(session_key, role, license_id, nonce):
+    """ The HMAC of a nonce, labelled with the role of its sender """
+    message = b"%s:%d:%s" % (role, license_id, nonce)
+    return hmac.new(session_key, message, hashlib.sha256).digest()
+
+
+def encrypt(pub_key_obj, message):
+    """ Encrypts a message for the holder of the license private key """
+    if not isinstance(pub_key_obj, x25519.X25519PublicKey):
+        return pub_key_obj.encrypt(message, OAEP)
+
+    ephemeral = x25519.X25519PrivateKey.generate()
+    raw = serialization.Encoding.Raw, serialization.PublicFormat.Raw
+    ephemeral_public = ephemeral.public_key().public_bytes(*raw)
+    recipient_public = pub_key_obj.public_bytes(*raw)
+    key = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=X25519_INFO + ephemeral_public + recipient_public,
+    ).derive(ephemeral.exchange(pub_key_obj))
+    nonce = secrets.token_bytes(GCM_NONCE_BYTES)
+    return ephemeral_public + nonce + AESGCM(key).encrypt(nonce, message, None)
+
+
+class CheckinChallenge:
+    """ Builds the challenges of the checkins of one license and checks the answers """
+
+    def __init__(self, license_id, license_pub_key, mode="rsa"):
+        if mode not in CHECKIN_MODES:
+            raise ValueError("Unknown checkin mode '{}'".format(mode))
+        self.license_id = license_id
+        self.mode = mode
+        self.pub_key_obj = serialization.load_pem_public_key(license_pub_key.encode('UTF-8', 'strict'))
+        self.session_key = None
+        self._pending_session_key = None
+        self._expected = None
+
+    def build(self):
+        """Builds the challenge fields of the next checkin
+
+        :return: the fields to add to the checkin request body
+        :rtype: dict
+        """
+        if self.mode == "rsa":
+            message = secrets.token_bytes()
+            self._expected = message
+            return {"encrypted_message": b64(encrypt(self.pub_key_obj, message))}
+
+        nonce = secrets.token_bytes(NONCE_BYTES)
+        if self.session_key is None:
+            # open a session, the only public key operation of the session mode
+            self._pending_session_key = secrets.token_bytes(SESSION_KEY_BYTES)
+            self._expected = session_tag(self._pending_session_key, b"server", self.license_id, nonce)
+            return {
+                "encrypted_session_key": b64(encrypt(self.pub_key_obj, self._pending_session_key)),
+                "nonce": b64(nonce),
+            }
+
+        self._expected = session_tag(self.session_key, b"server", self.license_id, nonce)
+        return {
+            "nonce": b64(nonce),
+            "proof": b64(session_tag(self.session_key, b"client", self.license_id, nonce)),
+        }
+
+    def verify(self, answer):
+        """Checks the answer of the server to the last challenge
+
+        :param answer: the answer as ascii string
+        :return: True if the server answered correctly
+        """
+        try:
+            answer_bytes = base64.b64decode(answer.encode('ascii', 'strict'))
+        except ValueError:
+            return False
+        if self._expected is None or not hmac.compare_digest(answer_bytes, self._expected):
+            return False
+        self._expected = None
+        if self._pending_session_key is not None:
+            self.session_key = self._pending_session_key
+            self._pending_session_key = None
+        return True
+
+    def reset_session(self):
+        """ Opens a new session with the next checkin, e.g. after 409 Conflict """
+        self.session_key = None
+        self._pending_session_key = None
@@ -0,0 +1,118 @@
+"""
+Fibonacci engine of the example App
+
+The App is the workload the licensing overhead is measured against, so its
+own work should be cheap and predictable. fib(n) is computed by fast
+doubling in O(log n) big-integer multiplications instead of the O(n)
+additions of the linear loop, which is kept for comparison:
+
+    F(2k) = F(k) * (2 * F(k+1) - F(k))
+    F(2k+1) = F(k)^2 + F(k+1)^2
+
+Every step works on the pair (F(k), F(k+1)) with k a prefix of the bits of
+n. The pairs of the requested numbers are kept in a bounded LRU cache. The
+numbers of one batch are computed in order: a number close to the previous
+one is reached by a few additions from its pair, the others share the pairs
+of the common prefixes of their bits. The largest n is bounded by `max_n`,
+the size of F(n) grows linearly with n.
+"""
+
+import threading
+from collections import OrderedDict
+
+# largest gap between two numbers of a batch bridged with additions, one
+# addition costs far less than the multiplications of a doubling step
+FORWARD_STEPS = 256
+
+
+def fib_linear(n):
+    """ Returns F(n) with n additions, the reference implementation """
+    previous, current = 0, 1
+    for _ in range(n):
+        previous, current = current, previous + current
+    return previous
+
+
+def fib_pair(n, memo=None):
+    """Returns (F(n), F(n+1)) by fast doubling
+
+    :param n: the index, 0 or more
+    :param memo: pairs already known by index, filled with the new ones
+    """
+    if n == 0:
+        return 0, 1
+    if memo is not None and n in memo:
+        return memo[n]
+    f_k, f_k1 = fib_pair(n >> 1, memo)
+    f_2k = f_k * (2 * f_k1 - f_k)
+    f_2k1 = f_k * f_k + f_k1 * f_k1
+    pair = (f_2k1, f_2k + f_2k1) if n & 1 else (f_2k, f_2k1)
+    if memo is not None:
+        memo[n] = pair
+    return pair
+
+
+class FibonacciEngine:
+    """ Computes Fibonacci numbers by fast doubling, with an LRU cache of the results """
+
+    def __init__(self, max_n=100000, cache_size=1024):
+        self.max_n = max_n
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, n):
+        """ Raises ValueError if n is not an index the engine computes """
+        if not isinstance(n, int) or isinstance(n, bool) or n < 0:
+            raise ValueError("number must be an integer of 0 or more")
+        if n > self.max_n:
+            raise ValueError("number must not be larger than {}".format(self.max_n))
+
+    def compute(self, n):
+        """ Returns F(n) """
+        return self.compute_many([n])[0]
+
+    def compute_many(self, numbers):
+        """Returns F(n) of every number, in the same order
+
+        The numbers missing from the cache are computed together, in order.
+        """
+        for n in numbers:
+            self.check(n)
+        results = {}
+        with self._lock:
+            for n in set(numbers):
+                pair = self._cache.get(n)
+                if pair is not None:
+                    self._cache.move_to_end(n)
+                    results[n] = pair
+            self.hits += sum(1 for n in numbers if n in results)
+            self.misses += sum(1 for n in numbers if n not in results)
+
+        memo, previous = {}, None
+        missing = sorted(set(numbers) - set(results))
+        for n in missing:
+            if previous is not None and n - previous <= FORWARD_STEPS:
+                f_n, f_n1 = results[previous]
+                for _ in range(n - previous):
+                    f_n, f_n1 = f_n1, f_n + f_n1
+                results[n] = (f_n, f_n1)
+            else:
+                results[n] = fib_pair(n, memo)
+            previous = n
+
+        if missing and self.cache_size > 0:
+            with self._lock:
+                for n in missing:
+                    self._cache[n] = results[n]
+                    self._cache.move_to_end(n)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return [results[n][0] for n in numbers]
+
+    def stats(self):
+        """ Returns the statistics of the cache as a dictionary """
+        with self._lock:
+            return {"size": len(self._cache), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,159 @@
+"""
+Client of the Authorizing Server
+
+All of the licensing calls of the App go through one LicensingClient, which
+keeps a pool of keep-alive connections to the Authorizing Server instead of
+opening a new TCP connection per call, and bounds every call with a connect
+and a read timeout.
+
+The AsyncLicensingClient does the same on asyncio (with optional HTTP/2),
+so that a checkin waiting on the network does not hold a scheduler thread.
+It needs httpx, install `httpx[http2]` to use it.
+
+The CheckinSchedule decides when the next checkin happens. It spreads the
+checkins of the fleet with jitter, backs off exponentially on errors and
+follows the Retry-After / X-Next-Checkin hints of the server.
+"""
+
+import random
+import asyncio
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:  # the asyncio client is optional
+    httpx = None
+
+
+class LicensingClient:
+    """ Pooled, keep-alive HTTP client of the Authorizing Server """
+
+    def __init__(self, base_url, connect_timeout=3.0, read_timeout=10.0, pool_size=4):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get_license(self, data):
+        """ POST /licenses """
+        return self.session.post(self.base_url + "/licenses", json=data, timeout=self.timeout)
+
+    def revoke_license(self, license_id, data):
+        """ PATCH /licenses/<license_id> """
+        return self.session.patch(
+            "{}/licenses/{}".format(self.base_url, license_id), json=data, timeout=self.timeout
+        )
+
+    def checkin(self, license_id, data):
+        """ POST /licenses/<license_id>/checkin """
+        return self.session.post(
+            "{}/licenses/{}/checkin".format(self.base_url, license_id), json=data, timeout=self.timeout
+        )
+
+    def close(self):
+        """ Closes the pooled connections """
+        self.session.close()
+
+
+class AsyncLicensingClient:
+    """ Pooled, keep-alive asyncio HTTP client of the Authorizing Server """
+
+    def __init__(self, base_url, connect_timeout=3.0, read_timeout=10.0, pool_size=4, http2=False):
+        if httpx is None:
+            raise RuntimeError("The asyncio licensing client needs httpx, install httpx[http2]")
+        self.base_url = base_url.rstrip("/")
+        self.client = httpx.AsyncClient(
+            http2=http2,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+
+    async def checkin(self, license_id, data):
+        """ POST /licenses/<license_id>/checkin """
+        return await self.client.post(
+            "{}/licenses/{}/checkin".format(self.base_url, license_id), json=data
+        )
+
+    async def close(self):
+        """ Closes the pooled connections """
+        await self.client.aclose()
+
+
+class EventLoopThread:
+    """ An asyncio event loop running in a background thread """
+
+    def __init__(self, name="licensing-loop"):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, coro):
+        """Schedules a coroutine on the loop
+
+        :return: a concurrent.futures.Future of its result
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        """ Stops the loop and waits for its thread """
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class CheckinSchedule:
+    """ Computes the delay before the next checkin """
+
+    def __init__(self, interval=10.0, jitter=0.2, backoff_cap=300.0):
+        self.interval = interval
+        self.jitter = jitter
+        self.backoff_cap = backoff_cap
+        self.failures = 0
+
+    def first_delay(self):
+        """ Spreads the first checkins of containers started together """
+        return random.uniform(0, self.interval)
+
+    def next_delay(self, succeeded, hint=None):
+        """Returns the number of seconds until the next checkin
+
+        :param succeeded: whether the last checkin succeeded
+        :param hint: the delay asked for by the server, if any
+        """
+        if succeeded:
+            self.failures = 0
+            interval = hint if hint is not None else self.interval
+            return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+        # exponential backoff with "equal jitter", never sooner than asked
+        self.failures += 1
+        backoff = min(self.backoff_cap, self.interval * 2 ** (self.failures - 1))
+        delay = backoff / 2 + random.uniform(0, backoff / 2)
+        return max(delay, hint) if hint is not None else delay
+
+
+def checkin_hint(headers):
+    """Reads the delay the server asks for from the response headers
+
+    X-Next-Checkin holds a number of seconds, Retry-After either a number
+    of seconds or an HTTP date
+
+    :return: the number of seconds, or None if the server did not ask
+    """
+    value = headers.get("X-Next-Checkin") or headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
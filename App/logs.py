@@ -0,0 +1,273 @@
+"""
+Logging pipeline of the App
+
+Twin of AuthSrvr/service/logs.py: the App image is built from App/
+alone, so the module is copied rather than shared. Apart from this
+docstring the two files are identical, a fix to one (redaction,
+sampling, exposition, ...) goes into the other in the same change;
+`diff` them to check.
+
+The request threads never write a log line themselves. A record is put on a
+bounded queue as it is, its message not even formatted, and a single
+listener thread formats it and writes it to stderr, as one JSON object per
+line (or as text). When the queue is full the record is dropped and counted
+rather than making the request wait.
+
+Checkins are far more frequent than anything else, so the info and debug
+records of a request are only kept for a share of the requests of its route
+(e.g. "*/checkin*=0.1"), decided once per request. Warnings and errors are
+always kept.
+
+Key material never reaches the log: the values of the sensitive fields
+(private_key, pub_key, the challenges, ...) of the dictionaries logged are
+replaced, bytes are logged by their length only, and PEM blocks are cut out
+of the messages.
+
+Statistics
+----------
+level - the level of the service loggers
+format - json or text
+queued - the number of records handed to the listener
+dropped - the number of records dropped because the queue was full
+sampled_out - the number of records of the requests not sampled
+"""
+
+import re
+import sys
+import json
+import queue
+import atexit
+import random
+import fnmatch
+import logging
+import threading
+import contextlib
+import contextvars
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMATS = ("json", "text")
+TEXT_FORMAT = "%(asctime)s | [%(levelname)s] | %(name)s | %(message)s"
+
+# fields whose values are never logged
+SENSITIVE_FIELDS = frozenset((
+    "private_key", "pub_key", "password", "session_key", "encrypted_message",
+    "encrypted_session_key", "decrypted_message", "proof", "lease_token",
+))
+REDACTED = "[REDACTED]"
+PEM_PATTERN = re.compile(r"-----BEGIN [A-Z0-9 ]+-----.*?(-----END [A-Z0-9 ]+-----|$)", re.DOTALL)
+
+# the attributes of every LogRecord, the others were passed as `extra`
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "route"}
+
+# the route of the current request, and whether its records are kept
+_request = contextvars.ContextVar("log_request", default=(None, True))
+
+
+def redact(value):
+    """ Returns a copy of a logged value without key material """
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if key in SENSITIVE_FIELDS else redact(item) for key, item in value.items()
+        }
+    if isinstance(value, list) or type(value) is tuple:  # pylint: disable=unidiomatic-typecheck
+        return type(value)(redact(item) for item in value)
+    if isinstance(value, (bytes, bytearray)):
+        return "<{} bytes>".format(len(value))
+    if isinstance(value, str) and "-----BEGIN " in value:
+        return PEM_PATTERN.sub(REDACTED, value)
+    return value
+
+
+def redact_text(text):
+    """ Cuts the PEM blocks out of a formatted message """
+    return PEM_PATTERN.sub(REDACTED, text) if "-----BEGIN " in text else text
+
+
+######################################################################
+#  F O R M A T T E R S
+######################################################################
+class JsonFormatter(logging.Formatter):
+    """
+    Class that formats a record as one JSON object
+    """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": redact_text(record.getMessage()),
+        }
+        if getattr(record, "route", None):
+            entry["route"] = record.route
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = redact(value)
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Class that formats a record as one line of text
+    """
+
+    def format(self, record):
+        return redact_text(super().format(record))
+
+
+######################################################################
+#  P I P E L I N E
+######################################################################
+class LogPipeline:
+    """
+    Class that represents the queue, the listener thread and the sampling of the logs
+    """
+
+    def __init__(self, level: str, log_format: str, queue_size: int, sampling: str = ""):
+        if log_format not in LOG_FORMATS:
+            raise ValueError("Unknown log format '{}', use one of {}".format(log_format, ", ".join(LOG_FORMATS)))
+        if not isinstance(logging.getLevelName(level.upper()), int):
+            raise ValueError("Unknown log level '{}'".format(level))
+        self.level = level.upper()
+        self.log_format = log_format
+        self.rates = parse_sampling(sampling)
+        self.queued = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self._lock = threading.Lock()
+
+        stream = logging.StreamHandler(sys.stderr)
+        stream.setFormatter(JsonFormatter() if log_format == "json" else TextFormatter(TEXT_FORMAT))
+        self._queue = queue.Queue(queue_size)
+        self.handler = PipelineHandler(self, self._queue)
+        self._listener = QueueListener(self._queue, stream)
+        self._started = False
+
+    def __repr__(self):
+        return "<LogPipeline %s %s>" % (self.level, self.log_format)
+
+    def install(self, logger):
+        """ Sends the records of a logger, and of its children, through the pipeline """
+        logger.handlers = [self.handler]
+        logger.setLevel(self.level)
+        logger.propagate = False
+
+    def start(self):
+        """ Starts the listener thread, the records logged before wait in the queue """
+        if self._started:
+            return
+        self._listener.start()
+        self._started = True
+        atexit.register(self.stop)
+
+    def stop(self):
+        """ Writes out the queued records and stops the listener thread """
+        if self._started:
+            self._started = False
+            self._listener.stop()
+
+    def start_request(self, route: str):
+        """Decides whether the records of a request on a route are kept
+
+        :param route: the route of the request, e.g. /licenses/<int:license_id>/checkin
+        :type route: str
+
+        :return: the token to give to end_request()
+        """
+        rate = self.rate(route)
+        return _request.set((route, rate >= 1 or random.random() < rate))
+
+    def end_request(self, token):
+        """ Ends the sampling of a request started with start_request() """
+        _request.reset(token)
+
+    @contextlib.contextmanager
+    def sampled(self, route: str):
+        """ Samples the records logged within a block as a request on a route """
+        token = self.start_request(route)
+        try:
+            yield
+        finally:
+            self.end_request(token)
+
+    def rate(self, route: str):
+        """ Returns the share of the requests of a route whose records are kept """
+        for pattern, rate in self.rates:
+            if fnmatch.fnmatchcase(route, pattern):
+                return rate
+        return 1.0
+
+    def count(self, counter):
+        """ Counts a record as queued, dropped or sampled_out """
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        """ Returns the statistics of the logs as a dictionary """
+        with self._lock:
+            return {
+                "level": self.level,
+                "format": self.log_format,
+                "queued": self.queued,
+                "dropped": self.dropped,
+                "sampled_out": self.sampled_out,
+            }
+
+
+class PipelineHandler(QueueHandler):
+    """
+    Class that puts the sampled records on the queue, unformatted
+    """
+
+    def __init__(self, pipeline, record_queue):
+        super().__init__(record_queue)
+        self.pipeline = pipeline
+
+    def prepare(self, record):
+        """ Strips the key material, the message is formatted by the listener """
+        record.args = redact(record.args)
+        if not isinstance(record.msg, str):
+            record.msg = redact(record.msg)
+        return record
+
+    def emit(self, record):
+        route, keep = _request.get()
+        if not keep and record.levelno < logging.WARNING:
+            self.pipeline.count("sampled_out")
+            return
+        record.route = route
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            self.pipeline.count("dropped")
+            return
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+            return
+        self.pipeline.count("queued")
+
+
+def parse_sampling(sampling: str):
+    """Parses the sampling rates of the routes
+
+    :param sampling: comma separated route=rate pairs, the routes may hold shell style wildcards
+    :type sampling: str
+
+    :return: the (route pattern, rate) pairs, in order
+    :rtype: list
+
+    """
+    rates = []
+    for pair in filter(None, (pair.strip() for pair in sampling.split(","))):
+        pattern, separator, rate = pair.rpartition("=")
+        try:
+            rate = float(rate)
+        except ValueError:
+            rate = None
+        if not separator or not pattern or rate is None or not 0 <= rate <= 1:
+            raise ValueError("Bad log sampling '{}', use route=rate with a rate from 0 to 1".format(pair))
+        rates.append((pattern.strip(), rate))
+    return rates
@@ -0,0 +1,436 @@
+"""
+Metrics of the App
+
+Twin of AuthSrvr/service/metrics.py: the App image is built from App/
+alone, so the module is copied rather than shared. Apart from this
+docstring the two files are identical, a fix to one (redaction,
+sampling, exposition, ...) goes into the other in the same change;
+`diff` them to check.
+
+Lightweight, thread safe instruments for the statistics served at /stats,
+and their exposition in the Prometheus text format served at /metrics.
+
+Histogram - counts observations (e.g. latencies in seconds) into fixed
+    buckets, and keeps their count and sum
+Counter - a total that only goes up
+Gauge - a value that goes up and down
+Family - a named metric with one instrument per set of label values, or
+    with the values collected from a function at scrape time
+
+The instruments live in the memory of every worker process. Without a
+shared directory a scrape only sees the worker that answered it. With one,
+SharedMetrics has every worker write a snapshot of its metrics there every
+`interval` seconds, and a scrape adds up the snapshots of all of the workers:
+
+    - counters and histograms are summed over every snapshot, including the
+      ones of workers that exited, so the totals never go down
+    - gauges are combined over the live workers only, summed or, for a
+      value every worker reads from the same place, their maximum
+
+Statistics
+----------
+directory - the shared directory, empty without one
+workers - the number of worker snapshots in the directory
+live - the number of those workers still running
+writes - the number of snapshots written by this worker
+"""
+
+import os
+import glob
+import json
+import atexit
+import bisect
+import logging
+import threading
+
+# media type of the Prometheus text format
+EXPOSITION_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+METRIC_KINDS = ("counter", "gauge", "histogram")
+# how the gauges of the workers are combined
+AGGREGATIONS = ("sum", "max")
+
+# upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Histogram:
+    """
+    Class that represents a histogram with fixed buckets
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.count = 0
+        self.sum = 0.0
+        # one more bucket for the observations above the last bound
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Histogram count=%d>" % self.count
+
+    def observe(self, value: float):
+        """ Records one observation """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q: float):
+        """Estimates a quantile as the upper bound of its bucket
+
+        :return: the bound, None without observations or above the last bound
+        """
+        with self._lock:
+            counts, count = list(self._counts), self.count
+        if not count:
+            return None
+        rank, seen = q * count, 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        """ Returns the cumulative bucket counts, the count and the sum as a dictionary """
+        with self._lock:
+            counts, count, total = list(self._counts), self.count, self.sum
+        cumulative, seen = [], 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            seen += bucket_count
+            cumulative.append([bound, seen])
+        return {"buckets": cumulative, "count": count, "sum": total}
+
+    def stats(self):
+        """ Returns a summary of the histogram as a dictionary """
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Counter:
+    """
+    Class that represents a total that only goes up
+    """
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Counter %s>" % self.value
+
+    def inc(self, amount: float = 1):
+        """ Adds to the total """
+        with self._lock:
+            self.value += amount
+
+
+class Gauge:
+    """
+    Class that represents a value that goes up and down
+    """
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Gauge %s>" % self.value
+
+    def set(self, value: float):
+        """ Sets the value """
+        with self._lock:
+            self.value = value
+
+    def inc(self, amount: float = 1):
+        """ Adds to the value, a negative amount subtracts """
+        with self._lock:
+            self.value += amount
+
+
+class Family:
+    """
+    Class that represents a metric with one instrument per set of label values
+
+    Without a `collect` function, `labels()` creates the instruments on first
+    use. With one, the function returns the (label values, instrument or
+    number) pairs of the metric whenever it is scraped.
+    """
+
+    def __init__(self, name: str, documentation: str, kind: str, labelnames=(),
+                 collect=None, buckets=LATENCY_BUCKETS, aggregate="sum"):
+        if kind not in METRIC_KINDS:
+            raise ValueError("Unknown metric kind '{}'".format(kind))
+        if aggregate not in AGGREGATIONS:
+            raise ValueError("Unknown aggregation '{}'".format(aggregate))
+        self.name = name
+        self.aggregate = aggregate
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self._collect = collect
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Family %s %s>" % (self.kind, self.name)
+
+    def labels(self, *values):
+        """ Returns the instrument of a set of label values """
+        if len(values) != len(self.labelnames):
+            raise ValueError("{} takes the labels {}".format(self.name, self.labelnames))
+        values = tuple(str(value) for value in values)
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                if self.kind == "histogram":
+                    child = Histogram(self.buckets)
+                else:
+                    child = Counter() if self.kind == "counter" else Gauge()
+                self._children[values] = child
+            return child
+
+    def collect(self):
+        """ Returns the (label values, instrument or number) pairs of the metric """
+        if self._collect is not None:
+            return list(self._collect())
+        with self._lock:
+            return sorted(self._children.items())
+
+
+def exposition(families):
+    """Renders metrics in the Prometheus text format
+
+    :param families: the metrics to render
+    :type families: list of Family
+
+    :return: the text served at /metrics
+    :rtype: str
+
+    """
+    return render(snapshot(families))
+
+
+def snapshot(families):
+    """Returns the current values of metrics as plain, JSON serializable data
+
+    :param families: the metrics to take
+    :type families: list of Family
+
+    :return: one dictionary per metric, its series as [label values, value or histogram snapshot]
+    :rtype: list
+
+    """
+    metrics = []
+    for family in families:
+        series = []
+        for values, instrument in family.collect():
+            if family.kind == "histogram":
+                value = instrument.snapshot()
+            else:
+                value = instrument if isinstance(instrument, (int, float)) else instrument.value
+            series.append([[str(label) for label in values], value])
+        metrics.append({
+            "name": family.name,
+            "documentation": family.documentation,
+            "kind": family.kind,
+            "labelnames": list(family.labelnames),
+            "aggregate": family.aggregate,
+            "series": series,
+        })
+    return metrics
+
+
+def render(metrics):
+    """ Renders the metrics of snapshot() in the Prometheus text format """
+    lines = []
+    for metric in metrics:
+        name = metric["name"]
+        lines.append("# HELP {} {}".format(name, metric["documentation"]))
+        lines.append("# TYPE {} {}".format(name, metric["kind"]))
+        for values, value in metric["series"]:
+            labels = list(zip(metric["labelnames"], values))
+            if metric["kind"] != "histogram":
+                lines.append(_sample(name, labels, value))
+                continue
+            for bound, count in value["buckets"]:
+                lines.append(_sample(name + "_bucket", labels + [("le", repr(float(bound)))], count))
+            lines.append(_sample(name + "_bucket", labels + [("le", "+Inf")], value["count"]))
+            lines.append(_sample(name + "_sum", labels, value["sum"]))
+            lines.append(_sample(name + "_count", labels, value["count"]))
+    return "\n".join(lines) + "\n"
+
+
+def merge(snapshots):
+    """Adds up the snapshots of several workers
+
+    :param snapshots: the (snapshot, whether its worker is alive) pairs
+    :type snapshots: list
+
+    :return: the metrics of all of the workers, in the order of the first snapshot
+    :rtype: list
+
+    """
+    merged, series = {}, {}
+    for metrics, alive in snapshots:
+        for metric in metrics:
+            name = metric["name"]
+            if name not in merged:
+                merged[name] = dict(metric, series=[])
+                series[name] = {}
+            if metric["kind"] == "gauge" and not alive:
+                continue
+            for values, value in metric["series"]:
+                key = tuple(values)
+                if key not in series[name]:
+                    series[name][key] = value
+                    merged[name]["series"].append([values, key])
+                    continue
+                series[name][key] = _combine(metric, series[name][key], value)
+    for name, metric in merged.items():
+        metric["series"] = sorted([values, series[name][key]] for values, key in metric["series"])
+    return list(merged.values())
+
+
+def _combine(metric, total, value):
+    """ Adds a value of a worker to the total of the others """
+    if metric["kind"] == "histogram":
+        counts = {bound: count for bound, count in total["buckets"]}
+        return {
+            "buckets": [[bound, counts.get(bound, 0) + count] for bound, count in value["buckets"]],
+            "count": total["count"] + value["count"],
+            "sum": total["sum"] + value["sum"],
+        }
+    if metric["kind"] == "gauge" and metric["aggregate"] == "max":
+        return max(total, value)
+    return total + value
+
+
+######################################################################
+#  S H A R I N G   A C R O S S   W O R K E R S
+######################################################################
+class SharedMetrics:
+    """
+    Class that represents the metrics of all of the worker processes, shared through a directory
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, app, directory: str, families, interval: float = 5.0):
+        self.app = app
+        self.directory = directory
+        self.families = families
+        self.interval = interval
+        self.writes = 0
+        self._path = os.path.join(directory, "{}.json".format(os.getpid())) if directory else None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def __repr__(self):
+        return "<SharedMetrics %s>" % (self.directory or "-")
+
+    @property
+    def enabled(self):
+        """ True if the metrics are shared, i.e. there is a directory """
+        return bool(self.directory)
+
+    def start(self):
+        """ Starts the thread that writes the snapshots of this worker """
+        if not self.enabled:
+            self.logger.info("Metrics not shared, a scrape only sees the worker answering it")
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self.write()
+        self._thread = threading.Thread(target=self._run, name="shared-metrics", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """ Writes a last snapshot and stops the thread """
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+            self.write()
+
+    def write(self):
+        """ Replaces the snapshot of this worker in the directory """
+        # the collected metrics may read the database
+        with self.app.app_context():
+            metrics = snapshot(self.families)
+        temporary = self._path + ".tmp"
+        with open(temporary, "w") as snapshot_file:
+            json.dump(metrics, snapshot_file)
+        os.replace(temporary, self._path)
+        self.writes += 1
+
+    def exposition(self):
+        """ Renders the metrics of all of the workers, or of this one when not shared """
+        if not self.enabled:
+            return exposition(self.families)
+        self.write()
+        return render(merge(self._read()))
+
+    def stats(self):
+        """ Returns the statistics of the sharing as a dictionary """
+        snapshots = self._read() if self.enabled else []
+        return {
+            "directory": self.directory,
+            "workers": len(snapshots),
+            "live": sum(1 for _, alive in snapshots if alive),
+            "writes": self.writes,
+        }
+
+    def _read(self):
+        """ Returns the (snapshot, alive) pairs of the workers, this one first """
+        paths = sorted(glob.glob(os.path.join(self.directory, "*.json")), key=lambda path: path != self._path)
+        snapshots = []
+        for path in paths:
+            try:
+                with open(path) as snapshot_file:
+                    metrics = json.load(snapshot_file)
+            except (OSError, ValueError):
+                continue
+            pid = os.path.basename(path)[:-len(".json")]
+            snapshots.append((metrics, pid.isdigit() and _alive(int(pid))))
+        return snapshots
+
+    def _run(self):
+        """ Writes a snapshot every interval until stopped """
+        while not self._stopped.wait(self.interval):
+            try:
+                self.write()
+            except Exception:  # pylint: disable=broad-except
+                self.logger.exception("Failed to write the metrics snapshot")
+
+
+def _alive(pid):
+    """ Returns True if a process is running """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _sample(name, labels, value):
+    """ Renders one sample line """
+    if not labels:
+        return "{} {}".format(name, value)
+    rendered = ",".join(
+        '{}="{}"'.format(label, str(label_value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for label, label_value in labels
+    )
+    return "{}{{{}}} {}".format(name, rendered, value)
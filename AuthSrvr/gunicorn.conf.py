@@ -0,0 +1,36 @@
+"""
+Gunicorn settings of the Authorizing Service
+
+SERVER_MODE (see config.py) selects the concurrency of the workers:
+
+wsgi - the Flask app on sync workers, one request at a time per worker
+asgi - service.asgi on uvicorn workers, the heartbeats of many keep-alive
+    connections are served concurrently by every worker
+"""
+
+import os
+
+SERVER_MODE = os.getenv("SERVER_MODE", "wsgi")
+
+if SERVER_MODE == "asgi":
+    wsgi_app = "service.asgi:asgi_app"
+    worker_class = "uvicorn.workers.UvicornWorker"
+    # keep the idle heartbeat connections open between two checkins
+    keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "120"))
+elif SERVER_MODE == "wsgi":
+    wsgi_app = "service:app"
+else:
+    raise ValueError("Unknown SERVER_MODE '{}', use wsgi or asgi".format(SERVER_MODE))
+
+workers = int(os.getenv("GUNICORN_WORKERS", "1"))
+
+
+def on_starting(server):  # pylint: disable=unused-argument
+    """ Drops the metric snapshots of the workers of a previous run """
+    directory = os.getenv("METRICS_DIR", "")
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        if name.endswith(".json") or name.endswith(".json.tmp"):
+            os.remove(os.path.join(directory, name))
+
+# the logs of gunicorn itself, the service has its own (see service/logs.py)
+loglevel = os.getenv("LOGGING_LEVEL", "info").lower()
@@ -9,7 +9,6 @@ This module also sets up the logging to be used with gunicorn
 """
 
 import os
-import logging
 from flask import Flask
 
 # Create Flask application
@@ -17,23 +16,52 @@ app = Flask(__name__)
 app.config.from_object("config")
 
 # Import the routes After the Flask app is created
-from service import routes, models
+from service import routes, models, commands
 
-# Set up logging for production
+# Set up logging for production, the records wait in a queue until the
+# pipeline is started below
 print("Setting up logging for {}...".format(__name__))
-app.logger.propagate = False
-if __name__ != "__main__":
-    gunicorn_logger = logging.getLogger("gunicorn.error")
-    if gunicorn_logger:
-        app.logger.handlers = gunicorn_logger.handlers
-        app.logger.setLevel(gunicorn_logger.level)
-    app.logger.info("Logging established")
+routes.init_logging()
+app.logger.info("Logging established")
 
 app.logger.info(70 * "*")
 app.logger.info("  A U T H O R I Z I N G   S E R V E R   ".center(70, "*"))
 app.logger.info(70 * "*")
 
+# load the master key wrapping the stored private keys
+routes.init_key_store()
+
+# cache the loaded private keys for the checkin endpoint
+routes.init_key_cache()
+
+# run the crypto jobs in worker processes, forked before any other thread
+routes.init_crypto_executor()
+
+# write the logs from a background thread, once the crypto workers are forked
+routes.log_pipeline.start()
+
 # make our sqlalchemy tables
 routes.init_db()
 
+# cache the Licenses read by the GETs and the checkins, if enabled
+routes.init_license_cache()
+
+# pre-generate keypairs for new licenses in the background
+routes.init_key_pools()
+
+# buffer the checkins and write them out in bulk, if enabled
+routes.init_heartbeats()
+
+# revoke the licenses of containers that stopped checking in
+routes.init_reaper()
+
+# recommend the checkin interval from the load of the server
+routes.init_pacer()
+
+# answer the session checkins from their lease tokens, if enabled
+routes.init_lease_tokens()
+
+# add up the metrics of the gunicorn workers, if METRICS_DIR is set
+routes.init_shared_metrics()
+
 app.logger.info("Service initialized!")
@@ -0,0 +1,146 @@
+"""
+Asynchronous access to the License table
+
+Used by the ASGI serving mode (see asgi.py) for the hot endpoints, so that a
+request waiting on the database does not hold a worker. The queries run on
+a pool of asyncpg connections for Postgres, or on an aiosqlite connection
+for local development with SQLite. Both speak to the same table the models
+map, with the same column names. Behind PgBouncer in transaction mode
+(pgbouncer=True) asyncpg does not prepare statements nor send startup
+parameters, as the next query may run on another server connection.
+
+Statistics
+----------
+backend - postgresql or sqlite
+pool_size - the number of open connections
+pool_max - the maximum number of connections
+"""
+
+import re
+import logging
+from datetime import datetime
+from .models import License
+
+LICENSE_TABLE = License.__tablename__
+LICENSE_COLUMNS = (
+    "id", "username", "used_by", "pub_key", "private_key", "key_algorithm", "is_active",
+    "created_at", "revoked_at", "last_checkin", "session_key",
+)
+DATETIME_COLUMNS = ("created_at", "revoked_at", "last_checkin")
+
+# the queries use the $n placeholders of Postgres
+FIND_LICENSE = "SELECT {} FROM {} WHERE id = $1".format(", ".join(LICENSE_COLUMNS), LICENSE_TABLE)
+TOUCH_LICENSE = "UPDATE {} SET last_checkin = $1 WHERE id = $2".format(LICENSE_TABLE)
+SET_SESSION_KEY = "UPDATE {} SET session_key = $1, updated_at = $2 WHERE id = $3".format(LICENSE_TABLE)
+COUNT_ALL_ACTIVE = "SELECT count(*) FROM {} WHERE is_active".format(LICENSE_TABLE)
+
+
+class AsyncLicenseStore:
+    """
+    Class that represents the asynchronous access to the Licenses
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, database_uri: str, min_size: int = 1, max_size: int = 10,
+                 pgbouncer: bool = False, statement_timeout: float = 0):
+        self.database_uri = database_uri
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pgbouncer = pgbouncer
+        self.statement_timeout = statement_timeout
+        self.backend = "sqlite" if database_uri.startswith("sqlite") else "postgresql"
+        self._pool = None
+        self._conn = None
+
+    def __repr__(self):
+        return "<AsyncLicenseStore %s>" % self.backend
+
+    async def connect(self):
+        """ Opens the connection pool, from the startup of the ASGI app """
+        self.logger.info("Opening the %s connection pool", self.backend)
+        if self.backend == "sqlite":
+            import aiosqlite  # pylint: disable=import-outside-toplevel
+            self._conn = await aiosqlite.connect(self.database_uri.split(":///", 1)[1])
+            self._conn.row_factory = aiosqlite.Row
+            return
+
+        import asyncpg  # pylint: disable=import-outside-toplevel
+        options = {}
+        if self.pgbouncer:
+            options["statement_cache_size"] = 0
+        elif self.statement_timeout > 0:
+            options["server_settings"] = {"statement_timeout": str(int(self.statement_timeout * 1000))}
+        self._pool = await asyncpg.create_pool(
+            self.database_uri.replace("postgresql+psycopg2://", "postgresql://", 1),
+            min_size=self.min_size,
+            max_size=self.max_size,
+            **options
+        )
+
+    async def close(self):
+        """ Closes the connection pool """
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    async def find(self, license_id: int):
+        """Finds a License by it's ID, with its key material
+
+        :return: the columns of the License, or None if not found
+        :rtype: dict
+
+        """
+        row = await self._fetchrow(FIND_LICENSE, license_id)
+        if row is None:
+            return None
+        data = dict(zip(LICENSE_COLUMNS, row))
+        if self.backend == "sqlite":
+            data["is_active"] = None if data["is_active"] is None else bool(data["is_active"])
+            for column in DATETIME_COLUMNS:
+                if isinstance(data[column], str):
+                    data[column] = datetime.fromisoformat(data[column])
+        return data
+
+    async def touch(self, license_id: int, checkin_time):
+        """ Updates the last_checkin of a License """
+        await self._execute(TOUCH_LICENSE, checkin_time, license_id)
+
+    async def set_session_key(self, license_id: int, session_key: str):
+        """ Stores the session key of a License, as an update of the License """
+        await self._execute(SET_SESSION_KEY, session_key, datetime.now(), license_id)
+
+    async def count_all_active(self):
+        """ Returns the number of active Licenses """
+        row = await self._fetchrow(COUNT_ALL_ACTIVE)
+        return row[0]
+
+    def stats(self):
+        """ Returns the statistics of the connection pool as a dictionary """
+        if self._pool is not None:
+            return {"backend": self.backend, "pool_size": self._pool.get_size(), "pool_max": self.max_size}
+        return {"backend": self.backend, "pool_size": int(self._conn is not None), "pool_max": 1}
+
+    async def _fetchrow(self, query, *args):
+        if self._pool is not None:
+            return await self._pool.fetchrow(query, *args)
+        async with self._conn.execute(*_sqlite(query, args)) as cursor:
+            return await cursor.fetchone()
+
+    async def _execute(self, query, *args):
+        if self._pool is not None:
+            await self._pool.execute(query, *args)
+            return
+        await self._conn.execute(*_sqlite(query, args))
+        await self._conn.commit()
+
+
+def _sqlite(query, args):
+    """ Converts a query and its arguments to the style of SQLite """
+    args = [
+        arg.strftime("%Y-%m-%d %H:%M:%S.%f") if isinstance(arg, datetime) else arg for arg in args
+    ]
+    return re.sub(r"\$\d+", "?", query), args
@@ -0,0 +1,214 @@
+"""
+ASGI serving mode of the Authorizing Service
+
+Selected with SERVER_MODE=asgi (see config.py and gunicorn.conf.py), which
+runs `service.asgi:asgi_app` on uvicorn workers. The hot endpoints are
+served asynchronously on the AsyncLicenseStore, so thousands of keep-alive
+heartbeat connections share one worker instead of holding one each:
+
+# GET /licenses/{id} - Returns the License with a given id number
+# POST /licenses/{id}/checkin - Checks in a License
+
+They answer exactly like the handlers in routes.py and share their
+challenge code, key caches, crypto executor, write-behind buffer and pacer.
+The crypto runs on a thread so it never blocks the event loop, and a
+session checkin with a valid lease token never waits on the database. Every other
+request is handed to the Flask app.
+
+The Licenses are read from the AsyncLicenseStore rather than the License
+cache, whose client blocks; the writes made here still drop the cached rows.
+"""
+
+import time
+import logging
+from datetime import datetime
+from a2wsgi import WSGIMiddleware
+from flask_api import status  # HTTP Status Codes
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+from werkzeug.exceptions import Forbidden, Conflict
+from werkzeug.http import HTTP_STATUS_CODES
+from . import app, routes
+from .aiodb import AsyncLicenseStore
+from .cryptoexec import CryptoBusy
+from .models import License
+
+logger = logging.getLogger(__name__)
+
+# Asynchronous access to the Licenses, connected on startup
+store = AsyncLicenseStore(
+    app.config["DATABASE_URI"],
+    app.config["ASYNC_DB_POOL_MIN"],
+    app.config["ASYNC_DB_POOL_MAX"],
+    pgbouncer=app.config["DB_POOLER"] == "pgbouncer",
+    statement_timeout=app.config["DB_STATEMENT_TIMEOUT"],
+)
+
+
+######################################################################
+# Error Responses
+######################################################################
+def error_response(status_code, description, headers=None):
+    """ Builds the same JSON error as the error handlers of routes.py """
+    error = HTTP_STATUS_CODES[status_code]
+    app.logger.warning("%d %s: %s", status_code, error, description)
+    return JSONResponse(
+        {
+            "status": status_code,
+            "error": error,
+            "message": "{} {}: {}".format(status_code, error, description),
+        },
+        status_code,
+        headers,
+    )
+
+
+def tracked(route):
+    """Counts the requests of an endpoint as in progress for the pacer,
+    and records them in the metrics and samples their logs under the route
+    of routes.py
+    """
+    def decorator(endpoint):
+        async def wrapper(request):
+            routes.pacer.request_started(request.headers.get("x-request-start"))
+            log_token = routes.log_pipeline.start_request(route)
+            started = time.perf_counter()
+            status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+            try:
+                response = await endpoint(request)
+                status_code = response.status_code
+                return response
+            finally:
+                routes.log_pipeline.end_request(log_token)
+                routes.pacer.request_finished()
+                routes.observe_request(request.method, route, status_code, time.perf_counter() - started)
+                if route.endswith("/checkin"):
+                    routes.count_checkin(getattr(request.state, "checkin_body", None), status_code)
+        return wrapper
+    return decorator
+
+
+######################################################################
+# RETRIEVE A License
+######################################################################
+@tracked("/licenses/<int:license_id>")
+async def get_license(request):
+    """ Retrieve a single License, as GET /licenses/{id} of routes.py """
+    license_id = request.path_params["license_id"]
+    app.logger.info("Request for license with id: %s", license_id)
+    data = await store.find(license_id)
+    if not data:
+        return error_response(
+            status.HTTP_404_NOT_FOUND, "License with id '{}' was not found.".format(license_id)
+        )
+    lic = License(**data)
+    return JSONResponse(lic.serialize(last_checkin=routes.buffered_checkin(license_id)))
+
+
+######################################################################
+# Endpoint for periodical checkin
+######################################################################
+@tracked("/licenses/<int:license_id>/checkin")
+async def periodically_checkin(request):
+    """ Checks in a License, as POST /licenses/{id}/checkin of routes.py """
+    license_id = request.path_params["license_id"]
+    app.logger.info("Checkin request for license with id: %s", license_id)
+    content_type = request.headers.get("Content-Type")
+    if content_type != "application/json":
+        return error_response(
+            status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, "Content-Type must be application/json"
+        )
+
+    try:
+        request_body = await request.json()
+    except ValueError:
+        return error_response(status.HTTP_400_BAD_REQUEST, "Failed to decode JSON object")
+    request.state.checkin_body = request_body
+
+    # a session checkin with a valid lease token skips the database
+    try:
+        answer = routes.answer_token_checkin(license_id, request_body)
+    except (KeyError, TypeError, ValueError):
+        return error_response(
+            status.HTTP_400_BAD_REQUEST, "The checkin challenge of '{}' is malformed.".format(license_id)
+        )
+    except Forbidden as error:
+        return error_response(error.code, error.description)
+    if answer is not None:
+        return JSONResponse(answer, status.HTTP_200_OK, routes.next_checkin_header(count=False))
+
+    data = await store.find(license_id)
+    if not data:
+        return error_response(
+            status.HTTP_404_NOT_FOUND, "License with id '{}' was not found.".format(license_id)
+        )
+    lic = License(**data)
+
+    if not (lic.is_active and lic.used_by == request_body["used_by"] and lic.pub_key == request_body["pub_key"]):
+        return error_response(
+            status.HTTP_403_FORBIDDEN, "The info of '{}' does not match the record in DB.".format(license_id)
+        )
+
+    # answer the challenge, a failed proof is refused before anything is updated
+    try:
+        decrypted_message = await run_in_threadpool(routes.answer_checkin, lic, request_body)
+    except (KeyError, TypeError, ValueError):
+        return error_response(
+            status.HTTP_400_BAD_REQUEST, "The checkin challenge of '{}' is malformed.".format(license_id)
+        )
+    except (Forbidden, Conflict) as error:
+        return error_response(error.code, error.description)
+    except CryptoBusy as error:
+        return error_response(
+            status.HTTP_503_SERVICE_UNAVAILABLE, str(error),
+            {"Retry-After": str(app.config["CRYPTO_RETRY_AFTER"])},
+        )
+    if routes.opens_session(request_body):
+        await store.set_session_key(license_id, lic.session_key)
+        await run_in_threadpool(routes.license_cache.invalidate, [license_id])
+
+    # update 'last_checkin' to current time
+    now = datetime.now()
+    if routes.heartbeats:
+        routes.heartbeats.record([license_id], now)
+    else:
+        await store.touch(license_id, now)
+    await run_in_threadpool(routes.license_cache.record_checkins, [license_id], now)
+
+    headers = await next_checkin_header()
+    headers.update(routes.lease_token_header(lic))
+    return JSONResponse(decrypted_message, status.HTTP_200_OK, headers)
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+async def next_checkin_header():
+    """ Returns the header recommending the interval of the next checkin """
+    if routes.pacer.count_due():
+        routes.pacer.set_active(await store.count_all_active())
+    return {"X-Next-Checkin": str(routes.pacer.next_interval())}
+
+
+async def internal_server_error(request, error):
+    """ Handles unexpected server error with 500_SERVER_ERROR """
+    logger.exception("Exception on %s [%s]", request.url.path, request.method)
+    return error_response(
+        status.HTTP_500_INTERNAL_SERVER_ERROR,
+        "The server encountered an internal error and was unable to complete your request.",
+    )
+
+
+asgi_app = Starlette(
+    routes=[
+        Route("/licenses/{license_id:int}", get_license, methods=["GET"]),
+        Route("/licenses/{license_id:int}/checkin", periodically_checkin, methods=["POST"]),
+        # everything else is served by the Flask app
+        Mount("/", app=WSGIMiddleware(app)),
+    ],
+    exception_handlers={Exception: internal_server_error},
+    on_startup=[store.connect],
+    on_shutdown=[store.close],
+)
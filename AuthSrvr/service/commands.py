@@ -0,0 +1,65 @@
+"""
+Command line interface of the Authorizing Service
+
+Run the commands with the flask CLI, e.g.:
+
+    FLASK_APP=service flask export-licenses --format csv --filter username=tester
+"""
+
+import click
+from . import app, routes
+from .models import License
+from .export import export_licenses, EXPORT_FORMATS
+from .keystore import ENVELOPE_PREFIX
+
+
+######################################################################
+# EXPORT THE License TABLE
+######################################################################
+@app.cli.command("export-licenses")
+@click.option("--format", "export_format", type=click.Choice(sorted(EXPORT_FORMATS)), default="ndjson")
+@click.option("--output", type=click.File("w"), default="-", help="File to write to, stdout by default.")
+@click.option("--filter", "filters", multiple=True, metavar="FIELD=VALUE", help="Only export matching Licenses.")
+@click.option("--batch-size", type=int, default=1000, show_default=True)
+def export_licenses_command(export_format, output, filters, batch_size):
+    """ Exports the Licenses without their private keys """
+    args = {}
+    for item in filters:
+        field, sep, value = item.partition("=")
+        if not sep:
+            raise click.BadParameter("{} is not FIELD=VALUE".format(item), param_hint="--filter")
+        args[field] = value
+
+    for chunk in export_licenses(args, export_format, batch_size=batch_size):
+        output.write(chunk)
+    output.flush()
+
+
+######################################################################
+# RE-WRAP THE STORED PRIVATE AND SESSION KEYS WITH THE MASTER KEY
+######################################################################
+@app.cli.command("rewrap-keys")
+@click.option("--batch-size", type=int, default=500, show_default=True)
+def rewrap_keys_command(batch_size):
+    """ Seals the private and session keys still stored in a legacy format with LICENSE_MASTER_KEY """
+    key_store = routes.key_store
+    if not app.config["LICENSE_MASTER_KEY"]:
+        raise click.UsageError("Set LICENSE_MASTER_KEY to re-wrap the private keys")
+
+    rewrap = {
+        "private_key": lambda key: key_store.wrap(key_store.unwrap(key)),
+        "session_key": lambda key: key_store.wrap_secret(key_store.unwrap_secret(key)),
+    }
+    for column, rewrap_key in rewrap.items():
+        after_id, total = 0, 0
+        while True:
+            rows = License.find_private_keys(after_id, batch_size, skip_prefix=ENVELOPE_PREFIX, column=column)
+            if not rows:
+                break
+            replacements = [(license_id, key, rewrap_key(key)) for license_id, key in rows]
+            License.replace_private_keys(replacements, column=column)
+            routes.license_cache.invalidate([license_id for license_id, _ in rows])
+            after_id = rows[-1][0]
+            total += len(rows)
+            click.echo("Re-wrapped {} {}s (up to id {})".format(total, column.replace("_", " "), after_id), err=True)
+        click.echo("Done, re-wrapped {} {}s".format(total, column.replace("_", " ")), err=True)
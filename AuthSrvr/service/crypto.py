@@ -0,0 +1,128 @@
+"""
+Cryptographic helpers for the Authorizing Service
+
+Every License is a keypair: the public key is handed to the container and
+the private key stays in the database, wrapped by the key store (see
+keystore.py). The container proves the server is
+genuine by sending a random message encrypted with the public key, which the
+server has to decrypt and send back on every checkin.
+
+The keypair is either RSA-2048 (encrypted with OAEP) or X25519, which is
+much cheaper to generate, load and use. X25519 only agrees on keys, so the
+message is encrypted ECIES style: the container generates an ephemeral
+X25519 key, derives an AES-256-GCM key from the shared secret with HKDF and
+sends `ephemeral public key (32) | GCM nonce (12) | ciphertext`.
+
+In the session mode the RSA operation only happens once per lease: the
+container sends a random session key encrypted with the public key, and
+every later checkin is answered with an HMAC of a fresh nonce under that
+key. The client and the server tag the nonce with different labels, so an
+answer of the server can never be replayed as the proof of a client.
+"""
+
+import hmac
+import hashlib
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa, x25519
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+# algorithms of the License keypairs, a License without one is RSA
+KEY_ALGORITHMS = ("rsa", "x25519")
+
+# label of the key derivation of the X25519 messages
+X25519_INFO = b"license-checkin"
+X25519_KEY_BYTES = 32
+GCM_NONCE_BYTES = 12
+
+
+def generate_private_key(algorithm="rsa"):
+    """Generates the private key of a new License keypair
+
+    :param algorithm: one of KEY_ALGORITHMS
+    :type algorithm: str
+
+    """
+    if algorithm == "x25519":
+        return x25519.X25519PrivateKey.generate()
+    if algorithm == "rsa":
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    raise ValueError("Unknown key algorithm '{}'".format(algorithm))
+
+
+def public_pem(private_key_obj):
+    """ Returns the pub_key of a private key as PEM string """
+    public_key = private_key_obj.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    return public_key.decode('UTF-8', 'strict')
+
+
+def decrypt_message(private_key_obj, encrypted_message_bytes):
+    """ Decrypts a checkin message encrypted with the License pub_key """
+    if isinstance(private_key_obj, x25519.X25519PrivateKey):
+        return _decrypt_x25519(private_key_obj, encrypted_message_bytes)
+    return private_key_obj.decrypt(
+        encrypted_message_bytes,
+        padding.OAEP(
+            mgf=padding.MGF1(algorithm=hashes.SHA256()),
+            algorithm=hashes.SHA256(),
+            label=None
+        )
+    )
+
+
+def derive_x25519_key(shared_secret, ephemeral_public, recipient_public):
+    """Derives the AES-256-GCM key of an X25519 message
+
+    Both public keys are bound into the derivation, as raw 32 byte strings
+    """
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=X25519_KEY_BYTES,
+        salt=None,
+        info=X25519_INFO + ephemeral_public + recipient_public,
+    ).derive(shared_secret)
+
+
+def _decrypt_x25519(private_key_obj, encrypted_message_bytes):
+    """ Decrypts an `ephemeral public key | nonce | ciphertext` message """
+    header = X25519_KEY_BYTES + GCM_NONCE_BYTES
+    if len(encrypted_message_bytes) <= header:
+        raise ValueError("Encrypted message is too short")
+    ephemeral_public = encrypted_message_bytes[:X25519_KEY_BYTES]
+    nonce = encrypted_message_bytes[X25519_KEY_BYTES:header]
+    recipient_public = private_key_obj.public_key().public_bytes(
+        encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw
+    )
+    shared_secret = private_key_obj.exchange(x25519.X25519PublicKey.from_public_bytes(ephemeral_public))
+    key = derive_x25519_key(shared_secret, ephemeral_public, recipient_public)
+    try:
+        return AESGCM(key).decrypt(nonce, encrypted_message_bytes[header:], None)
+    except InvalidTag:
+        # fail like a bad RSA ciphertext does
+        raise ValueError("Decryption failed")
+
+
+# length of a session key and the minimum length of a checkin nonce
+SESSION_KEY_BYTES = 32
+NONCE_MIN_BYTES = 16
+
+
+def session_tag(session_key, role, license_id, nonce):
+    """Authenticates a checkin nonce with the session key of a License
+
+    :param session_key: the session key of the License
+    :type session_key: bytes
+    :param role: b"client" for the proof, b"server" for the answer
+    :type role: bytes
+    :param license_id: the id of the License
+    :type license_id: int
+    :param nonce: the random nonce of the checkin
+    :type nonce: bytes
+
+    """
+    message = b"%s:%d:%s" % (role, license_id, nonce)
+    return hmac.new(session_key, message, hashlib.sha256).digest()
@@ -0,0 +1,241 @@
+"""
+Crypto Executor for the Authorizing Service
+
+Keypair generation and private key decryption are CPU bound. Run on the
+request worker they hold the GIL and starve cheap requests such as
+GET /licenses/{id}. The CryptoExecutor runs them in a pool of worker
+processes instead, and the routes only wait for the result.
+
+The pool is bounded: at most `max_pending` jobs are queued or running.
+A request finding the pool full fails right away with CryptoBusy (503 with
+Retry-After), and a job not done within `timeout` seconds fails with
+CryptoBusy as well. Background jobs (the key pool refills) wait for a free
+slot instead. With 0 workers the jobs run inline on the calling thread.
+
+The worker processes are forked when the executor starts, which has to
+happen before the service starts any other thread. Every worker keeps its
+own key store and cache of unwrapped private keys. The hits, misses and key
+load times of those caches are reported back with every decryption and
+recorded by the key cache of the main process.
+
+Statistics
+----------
+workers - the number of worker processes, 0 when running inline
+max_pending - the maximum number of queued and running jobs
+pending - the number of queued and running jobs
+rejected - the number of jobs refused because the pool was full
+timeouts - the number of jobs that did not finish in time
+operations - the latency histograms of every operation, split in the time
+    spent waiting for a worker (queue) and in the worker (exec)
+"""
+
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from .crypto import decrypt_message
+from .keycache import KeyCache
+from .keystore import create_key_store
+from .metrics import Histogram
+
+OPERATIONS = ("keygen", "decrypt")
+
+
+class CryptoBusy(Exception):
+    """ Used when the crypto executor cannot take or finish a job in time """
+
+    pass
+
+
+class _PoolShutDown(Exception):
+    """ Used when the worker processes were shut down, e.g. at exit """
+
+    pass
+
+
+class CryptoExecutor:
+    """
+    Class that represents the execution of the CPU bound crypto jobs
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, key_store, key_cache, workers: int = 0, max_pending: int = 32,
+                 timeout: float = 5.0, worker_config=None):
+        self.key_store = key_store
+        self.key_cache = key_cache
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        # (master_key, legacy_passphrase, key_cache_size) of the worker processes
+        self.worker_config = worker_config
+        self.rejected = 0
+        self.timeouts = 0
+        self.histograms = {
+            operation: {"queue": Histogram(), "exec": Histogram()} for operation in OPERATIONS
+        }
+        self._pool = None
+        self._pending = 0
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<CryptoExecutor workers=%d pending=%d/%d>" % (self.workers, self._pending, self.max_pending)
+
+    def start(self):
+        """ Forks the worker processes """
+        if self.workers <= 0:
+            self.logger.info("Crypto executor disabled, crypto runs on the request workers")
+            return
+        self.logger.info("Starting crypto executor with %d workers", self.workers)
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker,
+            initargs=self.worker_config,
+        )
+        # fork all of the workers now, while the service has no other thread
+        for future in [self._pool.submit(time.sleep, 0.05) for _ in range(self.workers)]:
+            future.result()
+
+    def stop(self):
+        """ Stops the worker processes """
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def generate_keypair(self, algorithm: str, block: bool = True):
+        """Generates a License keypair, wrapped by the key store
+
+        :param algorithm: one of crypto.KEY_ALGORITHMS
+        :type algorithm: str
+        :param block: wait for a free slot instead of failing with CryptoBusy
+        :type block: bool
+
+        :return: the (private_key, pub_key) pair
+        :rtype: tuple
+
+        """
+        if self._pool is not None:
+            try:
+                return self._submit("keygen", block, _generate_keypair, algorithm)
+            except _PoolShutDown:
+                pass
+        return self._run_inline("keygen", self.key_store.generate_keypair, algorithm)
+
+    def decrypt(self, license_id: int, private_key: str, encrypted_message_bytes: bytes):
+        """Decrypts a message with the private key of a License
+
+        :param license_id: the id of the License, the key of the key caches
+        :type license_id: int
+        :param private_key: the private key stored with the License
+        :type private_key: str
+        :param encrypted_message_bytes: the message encrypted with the pub_key
+        :type encrypted_message_bytes: bytes
+
+        """
+        if self._pool is not None:
+            try:
+                message, load_seconds = self._submit(
+                    "decrypt", False, _decrypt, license_id, private_key, encrypted_message_bytes
+                )
+                self.key_cache.record(load_seconds)
+                return message
+            except _PoolShutDown:
+                pass
+        private_key_obj = self.key_cache.get(license_id, private_key)
+        return self._run_inline("decrypt", decrypt_message, private_key_obj, encrypted_message_bytes)
+
+    def stats(self):
+        """ Returns the statistics of the executor as a dictionary """
+        return {
+            "workers": self.workers if self._pool is not None else 0,
+            "max_pending": self.max_pending,
+            "pending": self._pending,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "operations": {
+                operation: {stage: histogram.stats() for stage, histogram in stages.items()}
+                for operation, stages in self.histograms.items()
+            },
+        }
+
+    def _run_inline(self, operation, func, *args):
+        """ Runs a job on the calling thread """
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.histograms[operation]["queue"].observe(0.0)
+            self.histograms[operation]["exec"].observe(time.perf_counter() - started)
+
+    def _submit(self, operation, block, func, *args):
+        """ Runs a job in a worker process, bounded by the slots and the timeout """
+        if not self._slots.acquire(blocking=block, timeout=self.timeout if block else None):
+            with self._lock:
+                self.rejected += 1
+            raise CryptoBusy("The crypto executor is saturated")
+
+        with self._lock:
+            self._pending += 1
+        submitted = time.time()
+        try:
+            future = self._pool.submit(_timed, func, *args)
+        except RuntimeError:
+            # the interpreter is exiting, the job runs inline instead
+            self._release()
+            raise _PoolShutDown()
+        # the slot stays taken until the job is done, even after a timeout
+        future.add_done_callback(lambda _: self._release())
+
+        try:
+            result, started, elapsed = future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            with self._lock:
+                self.timeouts += 1
+            raise CryptoBusy("The crypto job did not finish in {} seconds".format(self.timeout))
+        self.histograms[operation]["queue"].observe(max(0.0, started - submitted))
+        self.histograms[operation]["exec"].observe(elapsed)
+        return result
+
+    def _release(self):
+        """ Frees the slot of a finished job """
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+
+######################################################################
+#  W O R K E R   P R O C E S S E S
+######################################################################
+_worker = {}
+
+
+def _init_worker(master_key, legacy_passphrase, key_cache_size):
+    """ Creates the key store and the key cache of a worker process """
+    key_store = create_key_store(master_key, legacy_passphrase)
+    _worker["key_store"] = key_store
+    _worker["key_cache"] = KeyCache(key_cache_size, key_store.unwrap)
+
+
+def _timed(func, *args):
+    """ Runs a job, returns its result with the wall clock start and duration """
+    started, clock = time.time(), time.perf_counter()
+    result = func(*args)
+    return result, started, time.perf_counter() - clock
+
+
+def _generate_keypair(algorithm):
+    return _worker["key_store"].generate_keypair(algorithm)
+
+
+def _decrypt(license_id, private_key, encrypted_message_bytes):
+    """ Returns the message and the time of loading the key, None if it was cached """
+    key_cache = _worker["key_cache"]
+    # a worker runs one job at a time, a new observation is the load of this key
+    loads, load_total = key_cache.load_time.count, key_cache.load_time.sum
+    private_key_obj = key_cache.get(license_id, private_key)
+    load_seconds = key_cache.load_time.sum - load_total if key_cache.load_time.count > loads else None
+    return decrypt_message(private_key_obj, encrypted_message_bytes), load_seconds
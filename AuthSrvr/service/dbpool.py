@@ -0,0 +1,166 @@
+"""
+Database connection pool of the Authorizing Service
+
+Builds the SQLAlchemy engine options from the DB_* settings of config.py
+and checks at startup that the connections of all of the gunicorn workers
+fit in the database. Each worker holds up to DB_POOL_SIZE + DB_MAX_OVERFLOW
+connections, plus ASYNC_DB_POOL_MAX in the asgi mode.
+
+With DB_POOLER=pgbouncer the service runs behind PgBouncer in transaction
+mode: no startup parameters are sent (the statement timeout has to be set
+on the database role instead) and asyncpg does not prepare statements.
+DB_POOL_SIZE=0 then leaves the pooling to PgBouncer, opening one connection
+per checkout, and the budget is checked against PgBouncer's max_client_conn.
+
+SQLite databases keep the pool Flask-SQLAlchemy picks for them.
+
+Statistics
+----------
+pool - the class of the connection pool
+size - the number of connections kept in the pool
+checked_out - the number of connections in use
+overflow - the number of connections opened above the pool size
+checkout_wait - the latency histogram of getting a connection from the pool
+commit - the latency histogram of the commits of the sessions, flush included
+"""
+
+import time
+import logging
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool, NullPool
+from .metrics import Histogram
+
+POOLERS = ("", "pgbouncer")
+
+logger = logging.getLogger(__name__)
+
+# time waited for a connection, by every pool of the process
+checkout_wait = Histogram()
+
+# time taken by the commits of the sessions, see time_commits()
+commit_duration = Histogram()
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool recording the time waited for a connection
+    """
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            checkout_wait.observe(time.perf_counter() - started)
+
+
+class TimedNullPool(NullPool):
+    """
+    NullPool recording the time taken to open a connection
+    """
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            checkout_wait.observe(time.perf_counter() - started)
+
+
+def engine_options(config):
+    """Builds the options of the SQLAlchemy engine
+
+    :param config: the configuration of the Flask app
+    :type config: dict
+
+    :return: the SQLALCHEMY_ENGINE_OPTIONS
+    :rtype: dict
+
+    """
+    if config["DB_POOLER"] not in POOLERS:
+        raise ValueError("Unknown DB_POOLER '{}', use pgbouncer or leave it empty".format(config["DB_POOLER"]))
+    if config["DATABASE_URI"].startswith("sqlite"):
+        return {}
+
+    options = {"pool_pre_ping": config["DB_POOL_PRE_PING"]}
+    if config["DB_POOL_SIZE"] > 0:
+        options.update(
+            poolclass=TimedQueuePool,
+            pool_size=config["DB_POOL_SIZE"],
+            max_overflow=config["DB_MAX_OVERFLOW"],
+            pool_timeout=config["DB_POOL_TIMEOUT"],
+            pool_recycle=config["DB_POOL_RECYCLE"],
+        )
+    else:
+        options["poolclass"] = TimedNullPool
+
+    if config["DB_STATEMENT_TIMEOUT"] > 0:
+        if config["DB_POOLER"] == "pgbouncer":
+            logger.warning(
+                "DB_STATEMENT_TIMEOUT is ignored behind PgBouncer, set statement_timeout on the database role"
+            )
+        else:
+            options["connect_args"] = {
+                "options": "-c statement_timeout={:d}".format(int(config["DB_STATEMENT_TIMEOUT"] * 1000))
+            }
+    return options
+
+
+def check_connection_budget(config):
+    """Checks that the connections of all of the workers fit in the database
+
+    :param config: the configuration of the Flask app
+    :type config: dict
+
+    :return: the maximum number of connections of all of the workers
+    :rtype: int
+
+    """
+    if config["DATABASE_URI"].startswith("sqlite") or config["DB_MAX_CONNECTIONS"] <= 0:
+        return None
+    if config["DB_POOL_SIZE"] <= 0:
+        logger.info("No connection pool, the connections are bounded by the requests in progress")
+        return None
+
+    per_worker = config["DB_POOL_SIZE"] + config["DB_MAX_OVERFLOW"]
+    if config["SERVER_MODE"] == "asgi":
+        per_worker += config["ASYNC_DB_POOL_MAX"]
+    total = config["GUNICORN_WORKERS"] * per_worker
+    if total > config["DB_MAX_CONNECTIONS"]:
+        raise ValueError(
+            "{} workers may open {} connections each, {} in total, over DB_MAX_CONNECTIONS of {}".format(
+                config["GUNICORN_WORKERS"], per_worker, total, config["DB_MAX_CONNECTIONS"]
+            )
+        )
+    logger.info("At most %d of %d database connections in use", total, config["DB_MAX_CONNECTIONS"])
+    return total
+
+
+def time_commits(session):
+    """Records the duration of the commits of a session in commit_duration
+
+    :param session: the session, or the scoped session, to time
+    :type session: Session
+
+    """
+    def before_commit(session):
+        session.info["commit_started"] = time.perf_counter()
+
+    def after_commit(session):
+        started = session.info.pop("commit_started", None)
+        if started is not None:
+            commit_duration.observe(time.perf_counter() - started)
+
+    event.listen(session, "before_commit", before_commit)
+    event.listen(session, "after_commit", after_commit)
+
+
+def stats(engine):
+    """ Returns the statistics of the connection pool of an engine as a dictionary """
+    pool = engine.pool
+    result = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        result.update(size=pool.size(), checked_out=pool.checkedout(), overflow=pool.overflow())
+    result["checkout_wait"] = checkout_wait.stats()
+    result["commit"] = commit_duration.stats()
+    return result
@@ -0,0 +1,77 @@
+"""
+Export of the License table
+
+The Licenses are streamed from the database in batches and written out
+batch by batch, as newline-delimited JSON or as CSV, so an export takes the
+same amount of memory no matter how large the table is. The private keys
+are never exported.
+"""
+
+import io
+import csv
+import json
+from .models import License
+
+# the fields of an exported License
+EXPORT_FIELDS = tuple(field for field in License.FIELDS if field != "private_key")
+
+# the supported formats and their media types
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def export_licenses(args, export_format="ndjson", fields=EXPORT_FIELDS, batch_size=1000, last_checkin=None):
+    """Exports the Licenses matching a query string
+
+    :param args: the attributes to filter by, as for find_by_query_string
+    :type args: dict
+    :param export_format: one of EXPORT_FORMATS
+    :type export_format: str
+    :param fields: the names of the fields to export
+    :type fields: list
+    :param batch_size: the number of Licenses fetched and written at once
+    :type batch_size: int
+    :param last_checkin: returns the checkin of a License id not written yet
+    :type last_checkin: function
+
+    :return: a generator of text chunks
+    """
+    licenses = License.iterate_by_query_string(args, fields, batch_size)
+    rows = (
+        lic.serialize(fields, last_checkin=last_checkin(lic.id) if last_checkin else None)
+        for lic in licenses
+    )
+    if export_format == "csv":
+        return _csv_chunks(rows, fields, batch_size)
+    return _ndjson_chunks(rows, batch_size)
+
+
+def _ndjson_chunks(rows, batch_size):
+    """ Writes one JSON document per line """
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(row) + "\n")
+        if len(lines) >= batch_size:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+
+def _csv_chunks(rows, fields, batch_size):
+    """ Writes a header line and one line per License """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,128 @@
+"""
+Write-behind buffer of License checkins
+
+Bumping last_checkin with its own transaction on every heartbeat makes the
+checkins the largest write load on the database. When write-behind is
+enabled the HeartbeatBuffer only records the checkins in memory and writes
+them out every flush interval with a single bulk UPDATE. A last_checkin in
+the database is therefore at most one flush interval behind, and the
+buffer is flushed once more when the worker shuts down.
+
+Statistics
+----------
+pending - the number of Licenses with a checkin waiting to be written
+flushes - the number of flushes run
+flushed - the number of checkins written
+last_flush_seconds - how long the last flush took
+"""
+
+import time
+import atexit
+import logging
+import threading
+from .models import License
+
+
+class HeartbeatBuffer:
+    """
+    Class that represents the checkins waiting to be written
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, app, interval: int):
+        self.app = app
+        self.interval = interval
+        self.flushes = 0
+        self.flushed = 0
+        self.last_flush_seconds = None
+        self._checkins = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def __repr__(self):
+        return "<HeartbeatBuffer %d pending>" % (len(self._checkins))
+
+    def start(self):
+        """ Starts the thread that flushes every interval """
+        self.logger.info("Starting heartbeat write-behind every %d seconds", self.interval)
+        self._thread = threading.Thread(target=self._run, name="heartbeats", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """ Stops the flushing thread and writes out what is left """
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def record(self, license_ids: list, checkin_time):
+        """Records the checkin of Licenses
+
+        :param license_ids: the ids of the Licenses that checked in
+        :type license_ids: list
+        :param checkin_time: the time of the checkin
+        :type checkin_time: datetime.datetime
+
+        """
+        with self._lock:
+            for license_id in license_ids:
+                self._checkins[license_id] = checkin_time
+
+    def last_checkin(self, license_id: int):
+        """ Returns the buffered checkin time of a License, if any """
+        with self._lock:
+            return self._checkins.get(license_id)
+
+    def flush(self):
+        """Writes the buffered checkins to the database
+
+        :return: the number of checkins written
+        :rtype: int
+
+        """
+        with self._flush_lock:
+            with self._lock:
+                checkins, self._checkins = self._checkins, {}
+            if not checkins:
+                return 0
+
+            start = time.perf_counter()
+            try:
+                with self.app.app_context():
+                    License.touch_each(checkins)
+            except Exception:
+                # keep the checkins for the next flush, unless newer ones came in
+                with self._lock:
+                    for license_id, checkin_time in checkins.items():
+                        self._checkins.setdefault(license_id, checkin_time)
+                raise
+
+            self.flushes += 1
+            self.flushed += len(checkins)
+            self.last_flush_seconds = time.perf_counter() - start
+            return len(checkins)
+
+    def stats(self):
+        """ Returns the statistics of the buffer as a dictionary """
+        with self._lock:
+            pending = len(self._checkins)
+        return {
+            "interval": self.interval,
+            "pending": pending,
+            "flushes": self.flushes,
+            "flushed": self.flushed,
+            "last_flush_seconds": self.last_flush_seconds,
+        }
+
+    def _run(self):
+        """ Flushes every interval until stopped """
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-except
+                self.logger.exception("Failed to write the buffered checkins")
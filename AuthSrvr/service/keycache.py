@@ -0,0 +1,120 @@
+"""
+Key Cache for the Authorizing Service
+
+Unwrapping a stored private key (see keystore.py) and parsing it costs more
+than the decryption itself, by far so for the keys in the legacy passphrase
+format which run a password based KDF. The KeyCache keeps the
+loaded key objects of the most recently used Licenses in memory, keyed by
+license id. Every entry remembers the PEM it was loaded from, so a License
+whose key changed in another worker is reloaded instead of served stale.
+
+With crypto worker processes (see cryptoexec.py) every worker looks its keys
+up in a cache of its own. The outcome of those lookups, and the load time of
+their misses, are sent back with the results and recorded by the cache of
+the main process, so that its statistics cover the workers.
+
+Statistics
+----------
+size - the number of cached keys
+capacity - the maximum number of cached keys
+hits - the number of lookups served from the cache
+misses - the number of lookups that had to load the key
+evictions - the number of keys dropped to make room for new ones
+load - the latency histogram of loading the keys of the misses
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+from .metrics import Histogram
+
+
+class KeyCache:
+    """
+    Class that represents a bounded LRU cache of loaded private keys
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, size: int, loader):
+        self.size = size
+        self.loader = loader
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_time = Histogram()
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<KeyCache %d/%d>" % (len(self._keys), self.size)
+
+    def get(self, license_id: int, private_key: str):
+        """Returns the loaded private key of a License
+
+        :param license_id: the id of the License
+        :type license_id: int
+        :param private_key: the private key stored with the License
+        :type private_key: str
+
+        :return: the loaded private key object
+        """
+        with self._lock:
+            entry = self._keys.get(license_id)
+            if entry is not None and entry[0] == private_key:
+                self._keys.move_to_end(license_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        started = time.perf_counter()
+        private_key_obj = self.loader(private_key)
+        self.load_time.observe(time.perf_counter() - started)
+        if self.size <= 0:
+            return private_key_obj
+
+        with self._lock:
+            self._keys[license_id] = (private_key, private_key_obj)
+            self._keys.move_to_end(license_id)
+            while len(self._keys) > self.size:
+                self._keys.popitem(last=False)
+                self.evictions += 1
+        return private_key_obj
+
+    def record(self, load_seconds: float = None):
+        """Records a lookup made by the cache of a crypto worker process
+
+        :param load_seconds: the time of loading the key, None if it was a hit
+        :type load_seconds: float
+
+        """
+        with self._lock:
+            if load_seconds is None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if load_seconds is not None:
+            self.load_time.observe(load_seconds)
+
+    def invalidate(self, license_id: int):
+        """ Drops the cached key of a License """
+        with self._lock:
+            self._keys.pop(license_id, None)
+
+    def clear(self):
+        """ Drops all of the cached keys """
+        with self._lock:
+            self._keys.clear()
+
+    def stats(self):
+        """ Returns the statistics of the cache as a dictionary """
+        with self._lock:
+            return {
+                "size": len(self._keys),
+                "capacity": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "load": self.load_time.stats(),
+            }
@@ -0,0 +1,140 @@
+"""
+Key Pool for the Authorizing Service
+
+Generating an RSA keypair takes tens to hundreds of milliseconds, which is
+far too long to spend inside a request. The KeyPool keeps a number of ready
+keypairs in memory and refills them from background worker threads, so that
+create_licenses only has to pop one.
+
+Statistics
+----------
+depth - the number of keypairs ready to be handed out
+capacity - the number of keypairs the pool tries to keep ready
+hits - the number of keypairs handed out from the pool
+misses - the number of requests that found the pool empty
+refill_rate - keypairs generated per second over the last minute
+"""
+
+import time
+import logging
+import threading
+from collections import deque
+
+# window (in seconds) used to compute the refill rate
+REFILL_RATE_WINDOW = 60
+
+
+class KeyPool:
+    """
+    Class that represents a pool of pre-generated License keypairs
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, size: int, generator, workers: int = 1):
+        self.size = size
+        self.workers = workers
+        self.generator = generator
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self._keys = deque()
+        self._pending = 0
+        self._refills = deque()
+        self._threads = []
+        self._stopped = False
+        self._cond = threading.Condition()
+
+    def __repr__(self):
+        return "<KeyPool %d/%d>" % (len(self._keys), self.size)
+
+    def start(self):
+        """ Starts the worker threads that keep the pool filled """
+        if self.size <= 0:
+            self.logger.info("Key pool disabled, keypairs will be generated inline")
+            return
+        self.logger.info("Starting key pool of %d with %d workers", self.size, self.workers)
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._refill, name="keypool-{}".format(i), daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """ Stops the worker threads """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def acquire(self):
+        """Takes a keypair from the pool
+
+        Falls back to generating one inline when the pool is empty
+
+        :return: the (private_key, pub_key) pair as PEM strings
+        :rtype: tuple
+
+        """
+        with self._cond:
+            if self._keys:
+                self.hits += 1
+                keypair = self._keys.popleft()
+                self._cond.notify()
+                return keypair
+            self.misses += 1
+        self.logger.warning("Key pool is empty, generating a keypair inline")
+        return self.generator()
+
+    def release(self, keypair):
+        """ Returns an unused keypair to the pool """
+        with self._cond:
+            if len(self._keys) < self.size:
+                self._keys.appendleft(keypair)
+
+    def stats(self):
+        """ Returns the statistics of the pool as a dictionary """
+        with self._cond:
+            self._trim_refills()
+            return {
+                "depth": len(self._keys),
+                "capacity": self.size,
+                "workers": len(self._threads),
+                "hits": self.hits,
+                "misses": self.misses,
+                "generated": self.generated,
+                "refill_rate": len(self._refills) / REFILL_RATE_WINDOW,
+            }
+
+    def _refill(self):
+        """ Generates keypairs whenever the pool is below its capacity """
+        while True:
+            with self._cond:
+                while not self._stopped and len(self._keys) + self._pending >= self.size:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                self._pending += 1
+            keypair = None
+            try:
+                keypair = self.generator()
+            except Exception:  # pylint: disable=broad-except
+                self.logger.exception("Failed to generate a keypair")
+                time.sleep(1)
+            finally:
+                with self._cond:
+                    self._pending -= 1
+                    if keypair is not None:
+                        self._keys.append(keypair)
+                        self.generated += 1
+                        self._refills.append(time.monotonic())
+                        self._trim_refills()
+
+    def _trim_refills(self):
+        """ Drops the refill timestamps older than the rate window """
+        horizon = time.monotonic() - REFILL_RATE_WINDOW
+        while self._refills and self._refills[0] < horizon:
+            self._refills.popleft()
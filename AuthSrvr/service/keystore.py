@@ -0,0 +1,223 @@
+"""
+Key Store for the Authorizing Service
+
+The private key of a License is never stored in the clear. A KeyStore wraps
+a private key object into the string stored with the License, and unwraps
+that string back into a key object for the checkins.
+
+PassphraseKeyStore - the legacy format: an encrypted PKCS8 PEM. Unwrapping
+    runs a deliberately slow password based KDF.
+EnvelopeKeyStore - envelope encryption: the PKCS8 DER of the key sealed with
+    AES-256-GCM under a master key loaded once at startup, stored as
+    `env1:` + base64(nonce | ciphertext). Unwrapping takes microseconds.
+    Keys still stored in the legacy format are unwrapped with the legacy
+    store until `flask rewrap-keys` migrated them.
+
+The session keys of the session checkin mode are secrets of the same kind:
+whoever reads one can answer the checkins of its License. They are sealed
+with AES-256-GCM as well (wrap_secret), under the master key with the
+EnvelopeKeyStore, under a key derived once from the passphrase with the
+PassphraseKeyStore. Session keys stored in plain base64 by older versions
+are still read until `flask rewrap-keys` sealed them.
+"""
+
+import os
+import base64
+import binascii
+import logging
+import threading
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from .crypto import generate_private_key, public_pem, GCM_NONCE_BYTES
+
+# prefix of the keys stored by the EnvelopeKeyStore
+ENVELOPE_PREFIX = "env1:"
+# associated data of the sealed keys
+ENVELOPE_AAD = b"license-private-key"
+MASTER_KEY_BYTES = 32
+# prefix and associated data of the session keys sealed under the passphrase
+PASSPHRASE_PREFIX = "pss1:"
+SECRET_AAD = b"license-session-key"
+PASSPHRASE_KDF_ITERATIONS = 200000
+
+
+def seal(aead, prefix: str, secret: bytes) -> str:
+    """ Seals a secret with AES-GCM, as prefix + base64(nonce | ciphertext) """
+    nonce = os.urandom(GCM_NONCE_BYTES)
+    sealed = nonce + aead.encrypt(nonce, secret, SECRET_AAD)
+    return prefix + base64.b64encode(sealed).decode('ascii', 'strict')
+
+
+def unseal(aead, prefix: str, stored: str) -> bytes:
+    """ Opens a secret sealed by seal() """
+    try:
+        sealed = base64.b64decode(stored[len(prefix):])
+        return aead.decrypt(sealed[:GCM_NONCE_BYTES], sealed[GCM_NONCE_BYTES:], SECRET_AAD)
+    except (binascii.Error, InvalidTag):
+        raise ValueError("The secret cannot be unsealed")
+
+
+class KeyStore:
+    """
+    Class that represents the way the License private keys are stored
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def wrap(self, private_key_obj) -> str:
+        """ Converts a private key object into the string stored with a License """
+        raise NotImplementedError
+
+    def unwrap(self, private_key: str):
+        """ Converts the string stored with a License back into a key object """
+        raise NotImplementedError
+
+    def needs_rewrap(self, private_key: str) -> bool:
+        """ Returns True if a stored key is not in the format of this store """
+        return False
+
+    def wrap_secret(self, secret: bytes) -> str:
+        """ Converts a secret, e.g. a session key, into the string stored with a License """
+        raise NotImplementedError
+
+    def unwrap_secret(self, stored: str) -> bytes:
+        """Converts a stored secret back into its bytes
+
+        Secrets stored in plain base64 by older versions are decoded as they are
+        """
+        if ":" not in stored:
+            return base64.b64decode(stored)
+        return self._unwrap_secret(stored)
+
+    def _unwrap_secret(self, stored: str) -> bytes:
+        raise ValueError("The secret is not sealed in a format of this key store")
+
+    def generate_keypair(self, algorithm="rsa"):
+        """Generates a new License keypair
+
+        :param algorithm: one of crypto.KEY_ALGORITHMS
+        :type algorithm: str
+
+        :return: the (private_key, pub_key) pair, the private key wrapped
+        :rtype: tuple
+
+        """
+        private_key_obj = generate_private_key(algorithm)
+        return self.wrap(private_key_obj), public_pem(private_key_obj)
+
+
+class PassphraseKeyStore(KeyStore):
+    """
+    Class that stores the private keys as passphrase encrypted PEM
+    """
+
+    def __init__(self, passphrase: bytes):
+        self.passphrase = passphrase
+        # the key sealing the secrets, derived from the passphrase on first use
+        self._secret_aead = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<PassphraseKeyStore>"
+
+    def _aead(self):
+        with self._lock:
+            if self._secret_aead is None:
+                kdf = PBKDF2HMAC(
+                    algorithm=hashes.SHA256(), length=32, salt=SECRET_AAD, iterations=PASSPHRASE_KDF_ITERATIONS
+                )
+                self._secret_aead = AESGCM(kdf.derive(self.passphrase))
+            return self._secret_aead
+
+    def wrap_secret(self, secret):
+        return seal(self._aead(), PASSPHRASE_PREFIX, secret)
+
+    def _unwrap_secret(self, stored):
+        if not stored.startswith(PASSPHRASE_PREFIX):
+            return super()._unwrap_secret(stored)
+        return unseal(self._aead(), PASSPHRASE_PREFIX, stored)
+
+    def wrap(self, private_key_obj):
+        private_key = private_key_obj.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.BestAvailableEncryption(self.passphrase)
+        )
+        return private_key.decode('UTF-8', 'strict')
+
+    def unwrap(self, private_key):
+        return serialization.load_pem_private_key(
+            private_key.encode('UTF-8', 'strict'), password=self.passphrase
+        )
+
+
+class EnvelopeKeyStore(KeyStore):
+    """
+    Class that seals the private keys with a master key
+    """
+
+    def __init__(self, master_key: bytes, legacy: KeyStore = None):
+        if len(master_key) != MASTER_KEY_BYTES:
+            raise ValueError("The master key must be {} bytes".format(MASTER_KEY_BYTES))
+        self.aead = AESGCM(master_key)
+        self.legacy = legacy
+
+    def __repr__(self):
+        return "<EnvelopeKeyStore>"
+
+    def wrap(self, private_key_obj):
+        der = private_key_obj.private_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+        nonce = os.urandom(GCM_NONCE_BYTES)
+        sealed = nonce + self.aead.encrypt(nonce, der, ENVELOPE_AAD)
+        return ENVELOPE_PREFIX + base64.b64encode(sealed).decode('ascii', 'strict')
+
+    def unwrap(self, private_key):
+        if self.needs_rewrap(private_key):
+            if self.legacy is None:
+                raise ValueError("The private key is not sealed with the master key")
+            return self.legacy.unwrap(private_key)
+
+        try:
+            sealed = base64.b64decode(private_key[len(ENVELOPE_PREFIX):])
+            der = self.aead.decrypt(sealed[:GCM_NONCE_BYTES], sealed[GCM_NONCE_BYTES:], ENVELOPE_AAD)
+        except (binascii.Error, InvalidTag):
+            raise ValueError("The private key cannot be unsealed with the master key")
+        # the key is authenticated by the AEAD, so the slow RSA checks are skipped
+        return serialization.load_der_private_key(
+            der, password=None, unsafe_skip_rsa_key_validation=True
+        )
+
+    def needs_rewrap(self, private_key):
+        return not private_key.startswith(ENVELOPE_PREFIX)
+
+    def wrap_secret(self, secret):
+        return seal(self.aead, ENVELOPE_PREFIX, secret)
+
+    def _unwrap_secret(self, stored):
+        if stored.startswith(ENVELOPE_PREFIX):
+            return unseal(self.aead, ENVELOPE_PREFIX, stored)
+        if self.legacy is None:
+            return super()._unwrap_secret(stored)
+        return self.legacy.unwrap_secret(stored)
+
+
+def create_key_store(master_key: str, legacy_passphrase: str):
+    """Creates the key store of the service
+
+    :param master_key: base64 of the 32 byte master key, empty for the legacy store
+    :type master_key: str
+    :param legacy_passphrase: the passphrase of the keys in the legacy format
+    :type legacy_passphrase: str
+
+    """
+    legacy = PassphraseKeyStore(legacy_passphrase.encode('UTF-8', 'strict'))
+    if not master_key:
+        KeyStore.logger.warning("No LICENSE_MASTER_KEY set, private keys are passphrase encrypted")
+        return legacy
+    return EnvelopeKeyStore(base64.b64decode(master_key), legacy)
@@ -0,0 +1,244 @@
+"""
+Lease Tokens for the Authorizing Service
+
+A lease token is issued with a License and with every checkin answered from
+the database. It seals the license id, the container id, the times it was
+issued and expires at, and the session key of the License, with AES-256-GCM
+under a key shared by all of the server replicas. A session mode checkin
+presenting a valid token is verified and answered from the token alone,
+without reading the database. Only a token close to its expiry is renewed
+through the database, which also records the checkin.
+
+A token that does not verify (expired, tampered with, denied, or issued by
+a server with another key) is never an error: the checkin falls back to
+the checks against the database and is answered with a fresh token.
+
+Updates and revocations are enforced with a deny-list of license ids, each
+with the time from which on its tokens are valid again. The updates of this
+worker are denied right away, those of the other workers and replicas are
+polled from the updated_at column every `refresh_interval` seconds, which
+bounds how long a revoked License can keep checking in. An entry is
+dropped once all of the tokens it denies have expired.
+
+The same poll counts the active Licenses for the checkin pacer, so that a
+checkin answered from its token gets its X-Next-Checkin header without a
+database read either.
+
+Statistics
+----------
+ttl - the number of seconds a token is valid
+issued - the number of tokens issued
+accepted - the number of checkins answered from their token
+rejected - the number of tokens refused, by reason
+denied - the number of licenses on the deny-list
+refreshes - the number of polls of the updates
+"""
+
+import os
+import json
+import time
+import base64
+import logging
+import threading
+from datetime import datetime, timedelta
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
+from .models import License
+
+TOKEN_PREFIX = "lt1."
+TOKEN_AAD = b"license-lease-token"
+TOKEN_KEY_BYTES = 32
+GCM_NONCE_BYTES = 12
+REJECT_REASONS = ("invalid", "expired", "denied", "mismatch")
+
+
+class LeaseTokens:
+    """
+    Class that represents the issuing and verification of lease tokens
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, app, key: str, ttl: int, renew_before: int, refresh_interval: int, pacer=None):
+        self.app = app
+        self.pacer = pacer
+        self.ttl = ttl
+        self.renew_before = renew_before
+        self.refresh_interval = refresh_interval
+        self.issued = 0
+        self.accepted = 0
+        self.rejected = dict.fromkeys(REJECT_REASONS, 0)
+        self.refreshes = 0
+        self._aead = None
+        if key:
+            key_bytes = base64.b64decode(key)
+            if len(key_bytes) != TOKEN_KEY_BYTES:
+                raise ValueError("LEASE_TOKEN_KEY must be {} bytes encoded in base64".format(TOKEN_KEY_BYTES))
+            self._aead = AESGCM(key_bytes)
+        # the time from which on the tokens of a License are valid again
+        self._denied = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def __repr__(self):
+        return "<LeaseTokens ttl=%ds>" % (self.ttl)
+
+    @property
+    def enabled(self):
+        """ True if tokens are issued, i.e. there is a token key """
+        return self._aead is not None
+
+    def start(self):
+        """ Starts the thread that polls the updates of the other workers """
+        if not self.enabled:
+            self.logger.info("Lease tokens disabled, every checkin reads the database")
+            return
+        self.logger.info("Starting lease tokens with a TTL of %d seconds", self.ttl)
+        self._thread = threading.Thread(target=self._run, name="lease-tokens", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stops the polling thread """
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def issue(self, lic):
+        """Issues the lease token of a License
+
+        :param lic: the License, with its session key if it has one
+        :type lic: License
+
+        :return: the token, None if tokens are disabled
+        :rtype: str
+
+        """
+        if not self.enabled:
+            return None
+        now = time.time()
+        claims = {"lid": lic.id, "cid": lic.used_by, "iat": now, "exp": now + self.ttl}
+        if lic.session_key:
+            claims["sk"] = lic.session_key
+        nonce = os.urandom(GCM_NONCE_BYTES)
+        sealed = self._aead.encrypt(nonce, json.dumps(claims).encode("utf-8"), TOKEN_AAD)
+        with self._lock:
+            self.issued += 1
+        return TOKEN_PREFIX + base64.urlsafe_b64encode(nonce + sealed).decode("ascii")
+
+    def verify(self, token: str, license_id: int, used_by: str):
+        """Verifies the lease token presented with a checkin
+
+        A token within `renew_before` seconds of its expiry is refused as
+        well, so that the checkin renews it through the database.
+
+        :param token: the token of the checkin
+        :type token: str
+        :param license_id: the id of the License checking in
+        :type license_id: int
+        :param used_by: the container id of the checkin
+        :type used_by: str
+
+        :return: the claims of the token, None if it is not valid
+        :rtype: dict
+
+        """
+        if not self.enabled or not isinstance(token, str):
+            return None
+        claims = self._open(token)
+        if claims is None:
+            return self._reject("invalid")
+        if claims["lid"] != license_id or claims["cid"] != used_by:
+            return self._reject("mismatch")
+        if claims["exp"] - time.time() < self.renew_before:
+            return self._reject("expired")
+        with self._lock:
+            denied_at = self._denied.get(license_id)
+        if denied_at is not None and claims["iat"] <= denied_at:
+            return self._reject("denied")
+        return claims
+
+    def accept(self):
+        """ Counts a checkin answered from its token """
+        with self._lock:
+            self.accepted += 1
+
+    def deny(self, license_id: int, denied_at: float = None):
+        """Invalidates the tokens of a License issued until now
+
+        :param license_id: the id of the License
+        :type license_id: int
+        :param denied_at: the time until which the tokens are invalid, now if None
+        :type denied_at: float
+
+        """
+        denied_at = time.time() if denied_at is None else denied_at
+        with self._lock:
+            self._denied[license_id] = max(denied_at, self._denied.get(license_id, denied_at))
+
+    def refresh(self, since):
+        """Denies the tokens of the Licenses updated by any worker since a point in time
+
+        :param since: the time after which the updates are polled
+        :type since: datetime.datetime
+
+        """
+        with self.app.app_context():
+            updates = License.find_updated_since(since)
+            if self.pacer:
+                self.pacer.set_active(License.count_all_active())
+        for license_id, updated_at in updates:
+            self.deny(license_id, updated_at.timestamp())
+
+        # the tokens issued before an entry have all expired by now
+        expired = time.time() - self.ttl
+        with self._lock:
+            for license_id in [key for key, value in self._denied.items() if value < expired]:
+                del self._denied[license_id]
+            self.refreshes += 1
+
+    def stats(self):
+        """ Returns the statistics of the lease tokens as a dictionary """
+        with self._lock:
+            return {
+                "ttl": self.ttl if self.enabled else 0,
+                "issued": self.issued,
+                "accepted": self.accepted,
+                "rejected": dict(self.rejected),
+                "denied": len(self._denied),
+                "refreshes": self.refreshes,
+            }
+
+    def _open(self, token):
+        """ Returns the claims sealed in a token, None if it does not open """
+        if not token.startswith(TOKEN_PREFIX):
+            return None
+        try:
+            data = base64.urlsafe_b64decode(token[len(TOKEN_PREFIX):].encode("ascii"))
+            plain = self._aead.decrypt(data[:GCM_NONCE_BYTES], data[GCM_NONCE_BYTES:], TOKEN_AAD)
+            return json.loads(plain.decode("utf-8"))
+        except (ValueError, InvalidTag):
+            return None
+
+    def _reject(self, reason):
+        """ Counts a refused token """
+        with self._lock:
+            self.rejected[reason] += 1
+        return None
+
+    def _run(self):
+        """ Polls the updates every interval until stopped """
+        # every token issued before this start may still be in use
+        since = datetime.fromtimestamp(time.time() - self.ttl)
+        while True:
+            polled_at = datetime.now()
+            try:
+                self.refresh(since)
+                # overlap the polls by an interval, an update is stamped
+                # before its transaction commits
+                since = polled_at - timedelta(seconds=self.refresh_interval)
+            except Exception:  # pylint: disable=broad-except
+                self.logger.exception("Failed to refresh the lease token deny-list")
+            if self._stopped.wait(self.refresh_interval):
+                return
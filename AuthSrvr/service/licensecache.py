@@ -0,0 +1,300 @@
+"""
+License Cache for the Authorizing Service
+
+GET /licenses/{id} and the checkins read the same License rows over and
+over. The LicenseCache keeps those rows in a store shared by all of the
+workers and replicas, and loads the missing ones from the database
+(read-through). The cached rows hold the same columns as the table, key
+material included, so the store needs the same protection as the database.
+
+Every write of a License drops its row after the commit and bumps the
+generation of the License. A row loaded from the database is only stored if
+the generation did not change in the meantime, so a read racing with a write
+can never put the older row back. Checkins change last_checkin far too often
+to drop the row every time; their times are kept under a key of their own
+and a read returns the later of the two. The rows also expire after `ttl`
+seconds, as a safety net for writes made around the service.
+
+A failing store never fails a request, the rows are read from the database.
+
+Backends
+--------
+memory - a dictionary in the worker, only coherent with a single worker
+redis - any Redis compatible server (Redis, Valkey, KeyDB, ...), shared by
+    all of the workers and replicas
+
+Statistics
+----------
+backend - the backend of the cache, None when disabled
+hits - the number of reads served from the cache
+misses - the number of reads loaded from the database
+invalidations - the number of rows dropped by writes
+evictions - the number of rows dropped to make room (by the server for redis)
+errors - the number of failed calls to the store
+"""
+
+import json
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+BACKENDS = ("memory", "redis")
+
+
+class LicenseCache:
+    """
+    Class that represents a shared read-through cache of the Licenses
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, backend, loader, ttl: int):
+        self.backend = backend
+        self.loader = loader
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<LicenseCache %s>" % (self.backend.name if self.backend else None)
+
+    def get(self, license_id: int, license_class):
+        """Returns a License with its key material, from the cache if it holds it
+
+        :param license_id: the id of the License
+        :type license_id: int
+        :param license_class: the model the cached rows are converted to
+        :type license_class: class
+
+        :return: the License, None if not found
+        :rtype: License
+
+        """
+        if self.backend is None:
+            return self.loader(license_id)
+
+        try:
+            row, checkin, generation = self.backend.read(license_id)
+        except Exception:  # pylint: disable=broad-except
+            self._error("read")
+            return self.loader(license_id)
+
+        if row is None:
+            self._count("misses")
+            lic = self.loader(license_id)
+            if lic is None:
+                return None
+            try:
+                self.backend.fill(license_id, json.dumps(lic.to_row()), generation, self.ttl)
+            except Exception:  # pylint: disable=broad-except
+                self._error("fill")
+            return lic
+
+        self._count("hits")
+        lic = license_class.from_row(json.loads(row))
+        if checkin is not None:
+            checkin = datetime.fromisoformat(checkin)
+            if lic.last_checkin is None or checkin > lic.last_checkin:
+                lic.last_checkin = checkin
+        return lic
+
+    def invalidate(self, license_ids):
+        """Drops the cached rows of Licenses after they were written
+
+        :param license_ids: the ids of the Licenses
+        :type license_ids: list
+
+        """
+        if self.backend is None or not license_ids:
+            return
+        try:
+            self.backend.invalidate(list(license_ids), self.ttl)
+            self._count("invalidations", len(license_ids))
+        except Exception:  # pylint: disable=broad-except
+            self._error("invalidate")
+
+    def record_checkins(self, license_ids, checkin_time):
+        """Records the checkin of Licenses without dropping their rows
+
+        :param license_ids: the ids of the Licenses that checked in
+        :type license_ids: list
+        :param checkin_time: the time of the checkin
+        :type checkin_time: datetime.datetime
+
+        """
+        if self.backend is None or not license_ids:
+            return
+        try:
+            self.backend.record_checkins(list(license_ids), checkin_time.isoformat(), self.ttl)
+        except Exception:  # pylint: disable=broad-except
+            self._error("record checkins")
+
+    def stats(self):
+        """ Returns the statistics of the cache as a dictionary """
+        evictions = 0
+        if self.backend is not None:
+            try:
+                evictions = self.backend.evictions()
+            except Exception:  # pylint: disable=broad-except
+                self._error("stats")
+        with self._lock:
+            return {
+                "backend": self.backend.name if self.backend else None,
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "evictions": evictions,
+                "errors": self.errors,
+            }
+
+    def _count(self, counter, amount=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def _error(self, operation):
+        self.logger.warning("License cache failed to %s, using the database", operation, exc_info=True)
+        self._count("errors")
+
+
+######################################################################
+#  B A C K E N D S
+######################################################################
+class MemoryBackend:
+    """
+    Class that represents a bounded LRU store in the memory of the worker
+    """
+
+    name = "memory"
+
+    def __init__(self, size: int):
+        self.size = size
+        self.evicted = 0
+        # license id -> (row, expiry), and the checkins and generations
+        self._rows = OrderedDict()
+        self._checkins = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def read(self, license_id):
+        now = datetime.now().timestamp()
+        with self._lock:
+            entry = self._rows.get(license_id)
+            if entry is not None and entry[1] <= now:
+                del self._rows[license_id]
+                entry = None
+            if entry is not None:
+                self._rows.move_to_end(license_id)
+            return (
+                entry[0] if entry else None,
+                self._checkins.get(license_id),
+                self._generations.get(license_id, 0),
+            )
+
+    def fill(self, license_id, row, generation, ttl):
+        with self._lock:
+            if self._generations.get(license_id, 0) != generation:
+                return
+            self._rows[license_id] = (row, datetime.now().timestamp() + ttl)
+            self._rows.move_to_end(license_id)
+            while len(self._rows) > self.size:
+                evicted, _ = self._rows.popitem(last=False)
+                self._checkins.pop(evicted, None)
+                self.evicted += 1
+
+    def invalidate(self, license_ids, ttl):
+        with self._lock:
+            for license_id in license_ids:
+                self._generations[license_id] = self._generations.get(license_id, 0) + 1
+                self._rows.pop(license_id, None)
+                self._checkins.pop(license_id, None)
+
+    def record_checkins(self, license_ids, checkin_time, ttl):
+        with self._lock:
+            for license_id in license_ids:
+                if license_id in self._rows:
+                    self._checkins[license_id] = checkin_time
+
+    def evictions(self):
+        return self.evicted
+
+
+# stores a row unless the generation of the License changed since it was read
+FILL_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') == ARGV[2] then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+end
+"""
+
+
+class RedisBackend:
+    """
+    Class that represents a store on a Redis compatible server
+    """
+
+    name = "redis"
+
+    def __init__(self, url: str, prefix: str = "license:"):
+        import redis  # pylint: disable=import-outside-toplevel
+
+        self.prefix = prefix
+        self._redis = redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+        self._fill = self._redis.register_script(FILL_SCRIPT)
+
+    def _keys(self, license_id):
+        key = "{}{}".format(self.prefix, license_id)
+        return key, key + ":checkin", key + ":gen"
+
+    def read(self, license_id):
+        row, checkin, generation = self._redis.mget(self._keys(license_id))
+        return (
+            row.decode("utf-8") if row is not None else None,
+            checkin.decode("ascii") if checkin is not None else None,
+            int(generation) if generation is not None else 0,
+        )
+
+    def fill(self, license_id, row, generation, ttl):
+        row_key, _, generation_key = self._keys(license_id)
+        self._fill(keys=[row_key, generation_key], args=[row, generation, ttl])
+
+    def invalidate(self, license_ids, ttl):
+        pipeline = self._redis.pipeline(transaction=False)
+        for license_id in license_ids:
+            row_key, checkin_key, generation_key = self._keys(license_id)
+            pipeline.incr(generation_key)
+            # a generation has to outlive the rows read before it changed
+            pipeline.expire(generation_key, ttl * 10)
+            pipeline.delete(row_key, checkin_key)
+        pipeline.execute()
+
+    def record_checkins(self, license_ids, checkin_time, ttl):
+        pipeline = self._redis.pipeline(transaction=False)
+        for license_id in license_ids:
+            pipeline.set(self._keys(license_id)[1], checkin_time, ex=ttl)
+        pipeline.execute()
+
+    def evictions(self):
+        return self._redis.info("stats").get("evicted_keys", 0)
+
+
+def create_backend(name: str, url: str, size: int):
+    """Creates the backend of the License cache
+
+    :param name: one of BACKENDS, the cache is disabled if empty
+    :type name: str
+    :param url: the URL of the server of the redis backend
+    :type url: str
+    :param size: the maximum number of rows of the memory backend
+    :type size: int
+
+    """
+    if not name:
+        return None
+    if name == "memory":
+        return MemoryBackend(size)
+    if name == "redis":
+        return RedisBackend(url)
+    raise ValueError("Unknown license cache backend '{}'".format(name))
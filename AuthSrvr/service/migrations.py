@@ -0,0 +1,121 @@
+"""
+Schema migrations for the Authorizing Service
+
+db.create_all() only creates the tables that do not exist yet, so a database
+volume created by an older version of the service never receives the
+columns and indexes added to the models later on. upgrade_schema() compares
+the models with the live database and adds whatever is missing. It only ever
+adds nullable columns and indexes, which makes it safe to run on every start.
+
+On PostgreSQL the workers starting together take turns under an advisory
+lock (schema_lock()), so that only the first one builds the indexes and the
+others find them in place. An index whose concurrent build failed or was
+cancelled is left INVALID by PostgreSQL; it is dropped and built again.
+"""
+
+import time
+import logging
+import contextlib
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+
+logger = logging.getLogger(__name__)
+
+# key of the advisory lock of the schema upgrades
+SCHEMA_LOCK_KEY = 7243051
+SCHEMA_LOCK_POLL = 0.5
+
+INVALID_INDEXES_SQL = """
+    SELECT index_class.relname FROM pg_index
+    JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid
+    JOIN pg_class table_class ON table_class.oid = pg_index.indrelid
+    WHERE table_class.relname = :table AND NOT pg_index.indisvalid
+"""
+
+
+@contextlib.contextmanager
+def schema_lock(engine):
+    """Holds the lock of the schema upgrades of all of the workers, on PostgreSQL
+
+    The lock belongs to a transaction kept open meanwhile, which also holds
+    behind PgBouncer in transaction mode. It is polled rather than waited
+    for: a worker blocked in pg_advisory_xact_lock() would hold a snapshot,
+    which CREATE INDEX CONCURRENTLY of the lock holder waits for
+
+    :param engine: the engine of the database to upgrade
+
+    """
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect() as conn:
+        while True:
+            transaction = conn.begin()
+            if conn.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY}).scalar():
+                break
+            transaction.rollback()
+            time.sleep(SCHEMA_LOCK_POLL)
+        try:
+            yield
+        finally:
+            transaction.commit()
+
+
+def upgrade_schema(engine, metadata):
+    """Adds the columns and indexes missing from the existing tables
+
+    :param engine: the engine of the database to upgrade
+    :param metadata: the metadata of the models
+
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                logger.info("Adding column %s.%s", table.name, column.name)
+                _execute(engine, _add_column_ddl(engine, table, column))
+
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for name in _invalid_indexes(engine, table.name):
+            logger.warning("Dropping the invalid index %s on %s", name, table.name)
+            _execute(engine, "DROP INDEX CONCURRENTLY IF EXISTS {}".format(name))
+            indexes.discard(name)
+        for index in table.indexes:
+            if index.name not in indexes:
+                logger.info("Creating index %s on %s", index.name, table.name)
+                _execute(engine, _create_index_ddl(engine, index))
+
+
+def _add_column_ddl(engine, table, column):
+    """ Returns the ALTER TABLE statement adding a column """
+    if_not_exists = "IF NOT EXISTS " if engine.dialect.name == "postgresql" else ""
+    return "ALTER TABLE {} ADD COLUMN {}{} {}".format(
+        table.name, if_not_exists, column.name, column.type.compile(dialect=engine.dialect)
+    )
+
+
+def _create_index_ddl(engine, index):
+    """ Returns the CREATE INDEX statement of an index """
+    ddl = str(CreateIndex(index).compile(dialect=engine.dialect))
+    # build the index without blocking writes to a table that is in use
+    options = "CONCURRENTLY IF NOT EXISTS" if engine.dialect.name == "postgresql" else "IF NOT EXISTS"
+    return ddl.replace("INDEX", "INDEX " + options, 1)
+
+
+def _invalid_indexes(engine, table_name):
+    """ Returns the names of the indexes of a table left invalid by a failed build """
+    if engine.dialect.name != "postgresql":
+        return []
+    with engine.connect() as conn:
+        return [row[0] for row in conn.execute(text(INVALID_INDEXES_SQL), {"table": table_name})]
+
+
+def _execute(engine, ddl):
+    """ Runs a DDL statement outside of a transaction """
+    with engine.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").execute(text(ddl))
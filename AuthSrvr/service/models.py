@@ -18,7 +18,10 @@ License - A license in the pool
     pub_key (text) 
         - the license is consist of a pub_key and private_key pair
     private_key (text) 
-        - the license is consist of a pub_key and private_key pair
+        - the license is consist of a pub_key and private_key pair,
+          stored wrapped by the key store
+    key_algorithm (string)
+        - the algorithm of the keypair (rsa or x25519), None for rsa
     is_active (boolean) 
         - True for license is not revoked
     created_at (datetime.datetime() object) 
@@ -27,11 +30,31 @@ License - A license in the pool
         - datetime when a license was revoked by a container 
     last_checkin
         - the time when the license is last checked in
+    session_key (text)
+        - the symmetric key of the checkins in the session mode, never serialized
+    updated_at (datetime.datetime() object)
+        - the time of the last update, which invalidates the lease tokens
+          issued before it (see leasetokens.py), never serialized
+
+Seat - The license quota of a user
+    Attributes:
+    -----------
+    username (string)
+        - the username of the owner
+    max_licenses (integer)
+        - the number of Licenses the user may have active at once
+    allocations (integer)
+        - the number of Licenses allocated so far, bumped to lock the row
 
 """
 
 import logging
+from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.orm import load_only, undefer_group
+from sqlalchemy import bindparam, or_
+from sqlalchemy.exc import IntegrityError
+from .migrations import upgrade_schema, schema_lock
 
 # Create the SQLAlchemy object to be initialized later in init_db()
 db = SQLAlchemy()
@@ -59,13 +82,35 @@ class License(db.Model):
     ##################################################
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64))
-    used_by = db.Column(db.String(64))
-    pub_key = db.Column(db.Text())
-    private_key = db.Column(db.Text())
+    used_by = db.Column(db.String(64), index=True)
+    # the key material is only loaded by the callers that ask for it
+    pub_key = db.deferred(db.Column(db.Text()), group="keys")
+    private_key = db.deferred(db.Column(db.Text()), group="keys")
+    key_algorithm = db.Column(db.String(16))
     is_active = db.Column(db.Boolean())
     created_at = db.Column(db.DateTime())
     revoked_at = db.Column(db.DateTime())
-    last_checkin = db.Column(db.DateTime())
+    last_checkin = db.Column(db.DateTime(), index=True)
+    session_key = db.deferred(db.Column(db.Text()), group="keys")
+    updated_at = db.Column(db.DateTime(), index=True)
+
+    # the fields of a serialized License
+    FIELDS = (
+        "id", "username", "used_by", "pub_key", "private_key", "key_algorithm",
+        "is_active", "created_at", "revoked_at", "last_checkin",
+    )
+    KEY_FIELDS = ("pub_key", "private_key")
+    COMPACT_FIELDS = (
+        "id", "username", "used_by", "key_algorithm", "is_active",
+        "created_at", "revoked_at", "last_checkin",
+    )
+
+    __table_args__ = (
+        # serves the quota check and the per-user listings
+        db.Index("ix_license_username_is_active", "username", "is_active"),
+        # serves the lease reaper, oldest active checkins first
+        db.Index("ix_license_is_active_last_checkin", "is_active", "last_checkin"),
+    )
 
     ##################################################
     # INSTANCE METHODS
@@ -81,12 +126,45 @@ class License(db.Model):
         db.session.add(self)
         db.session.commit()
 
+    def allocate(self, max_licenses: int):
+        """
+        Creates a License to the data store if its user has a seat left
+
+        The Seat row of the user is locked by bumping its allocations before
+        the active Licenses are counted, and stays locked until the License
+        is committed. Concurrent grants for the same user therefore serialize
+        on that row, while grants for different users never wait on each other.
+
+        :param max_licenses: the quota of a user without a Seat row yet
+        :type max_licenses: int
+
+        :return: True if the License was created, False if the quota is used up
+        :rtype: bool
+
+        """
+        Seat.ensure(self.username, max_licenses)
+        try:
+            Seat.query.filter_by(username=self.username).update(
+                {Seat.allocations: Seat.allocations + 1}, synchronize_session=False
+            )
+            quota = db.session.query(Seat.max_licenses).filter_by(username=self.username).scalar()
+            if License.count_active(self.username) >= quota:
+                db.session.rollback()
+                return False
+            db.session.add(self)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return True
+
     def update(self):
         """
         Updates a License to the data store
         """
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
+        self.updated_at = datetime.now()
         db.session.commit()
 
     def delete(self):
@@ -94,19 +172,28 @@ class License(db.Model):
         db.session.delete(self)
         db.session.commit()
 
-    def serialize(self):
-        """ Serializes a License into a dictionary """
-        return {
-            "id": self.id,
-            "username": self.username,
-            "used_by": self.used_by,
-            "pub_key": self.pub_key,
-            "private_key": self.private_key,
-            "is_active": self.is_active,
-            "created_at": self.created_at.strftime("%Y-%m-%d %H:%M:%S") if self.created_at is not None else None,
-            "revoked_at": self.revoked_at.strftime("%Y-%m-%d %H:%M:%S") if self.revoked_at is not None else None,
-            "last_checkin": self.last_checkin.strftime("%Y-%m-%d %H:%M:%S") if self.last_checkin is not None else None,
-        }
+    def serialize(self, fields=None, compact=False, last_checkin=None):
+        """Serializes a License into a dictionary
+
+        :param fields: the names of the fields to include, all of them if None
+        :type fields: list
+        :param compact: leave out the key material (and never load it)
+        :type compact: bool
+        :param last_checkin: a checkin not written to the data store yet
+        :type last_checkin: datetime.datetime
+
+        """
+        if not fields:
+            fields = self.COMPACT_FIELDS if compact else self.FIELDS
+        data = {}
+        for field in fields:
+            value = getattr(self, field)
+            if field == "last_checkin" and last_checkin is not None:
+                value = max(value, last_checkin) if value is not None else last_checkin
+            if isinstance(value, datetime):
+                value = value.strftime("%Y-%m-%d %H:%M:%S")
+            data[field] = value
+        return data
 
     def deserialize(self, data: dict):
         """
@@ -124,6 +211,8 @@ class License(db.Model):
             self.used_by = data["used_by"]
             self.pub_key = data["pub_key"]
             self.private_key = data["private_key"]
+            # optional, the licenses of older clients are rsa
+            self.key_algorithm = data.get("key_algorithm", self.key_algorithm)
             self.is_active = data["is_active"]
             self.created_at = data["created_at"] 
             self.revoked_at = data["revoked_at"] 
@@ -136,10 +225,53 @@ class License(db.Model):
             )
         return self
 
+    def to_row(self):
+        """Converts a License into the JSON safe values of all of its columns
+
+        :return: the columns, the datetimes in ISO format
+        :rtype: dict
+
+        """
+        row = {}
+        for column in self.__table__.columns:
+            value = getattr(self, column.name)
+            row[column.name] = value.isoformat() if isinstance(value, datetime) else value
+        return row
+
     ##################################################
     # CLASS METHODS
     ##################################################
 
+    @classmethod
+    def from_row(cls, row: dict):
+        """Creates a License from the values returned by to_row()
+
+        The License is not attached to the database session, so it can be
+        read and serialized but not updated
+
+        """
+        return cls(**cls.parse_datetimes(row))
+
+    @classmethod
+    def parse_datetimes(cls, data: dict):
+        """Converts the ISO format strings of the DateTime columns in a dictionary
+
+        :param data: a dictionary of attributes, e.g. the body of a PATCH
+        :type data: dict
+
+        :return: a copy of the dictionary with datetimes
+        :rtype: dict
+
+        """
+        data = dict(data)
+        for column in cls.__table__.columns:
+            if isinstance(column.type, db.DateTime) and isinstance(data.get(column.name), str):
+                try:
+                    data[column.name] = datetime.fromisoformat(data[column.name])
+                except ValueError:
+                    raise DataValidationError("Invalid License: bad date in " + column.name)
+        return data
+
     @classmethod
     def init_db(cls, app):
         """Initializes the database session
@@ -153,7 +285,14 @@ class License(db.Model):
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        with schema_lock(db.engine):  # one worker at a time
+            db.create_all()  # make our sqlalchemy tables
+            upgrade_schema(db.engine, db.metadata)  # add what older tables lack
+
+    @classmethod
+    def _query(cls, keys: bool):
+        """ Returns a query that loads the key material only if asked to """
+        return cls.query.options(undefer_group("keys")) if keys else cls.query
 
     @classmethod
     def all(cls):
@@ -162,18 +301,237 @@ class License(db.Model):
         return cls.query.all()
 
     @classmethod
-    def find(cls, license_id: int):
+    def find(cls, license_id: int, keys: bool = False):
         """Finds a License by it's ID
 
         :param license_id: the id of the License to find
         :type license_id: int
+        :param keys: load the key material along with the License
+        :type keys: bool
 
         :return: an instance with the license_id, or None if not found
         :rtype: License
 
         """
         cls.logger.info("Processing lookup for id %s ...", license_id)
-        return cls.query.get(license_id)
+        return cls._query(keys).get(license_id)
+
+    @classmethod
+    def find_all(cls, license_ids: list, keys: bool = False):
+        """Finds the Licenses with the given IDs in one query
+
+        :param license_ids: the ids of the Licenses to find
+        :type license_ids: list
+        :param keys: load the key material along with the Licenses
+        :type keys: bool
+
+        :return: the Licenses that were found
+        :rtype: list
+
+        """
+        cls.logger.info("Processing lookup for %d ids ...", len(license_ids))
+        if not license_ids:
+            return []
+        return cls._query(keys).filter(cls.id.in_(license_ids)).all()
+
+    @classmethod
+    def touch(cls, license_ids: list, checkin_time):
+        """Updates the last_checkin of many Licenses with one statement
+
+        :param license_ids: the ids of the Licenses that checked in
+        :type license_ids: list
+        :param checkin_time: the time of the checkin
+        :type checkin_time: datetime.datetime
+
+        """
+        cls.logger.info("Processing checkin for %d ids ...", len(license_ids))
+        if not license_ids:
+            return
+        cls.query.filter(cls.id.in_(license_ids)).update(
+            {cls.last_checkin: checkin_time}, synchronize_session=False
+        )
+        db.session.commit()
+
+    @classmethod
+    def find_stale(cls, cutoff, limit: int):
+        """Finds the active Licenses that did not check in since a cutoff
+
+        The rows are locked until the transaction ends, and rows already
+        locked by another transaction are skipped
+
+        :param cutoff: the oldest acceptable last_checkin
+        :type cutoff: datetime.datetime
+        :param limit: the maximum number of Licenses to return
+        :type limit: int
+
+        :return: the ids of the stale Licenses, oldest checkin first
+        :rtype: list
+
+        """
+        cls.logger.info("Processing lookup for checkins before %s ...", cutoff)
+        rows = (
+            db.session.query(cls.id)
+            .filter_by(is_active=True)
+            .filter(cls.last_checkin < cutoff)
+            .order_by(cls.last_checkin)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        return [row.id for row in rows]
+
+    @classmethod
+    def revoke_stale(cls, license_ids: list, cutoff, revoked_at):
+        """Revokes the Licenses that are still stale
+
+        A License that checked in after it was found stale is left active
+
+        :param license_ids: the ids returned by find_stale
+        :type license_ids: list
+        :param cutoff: the cutoff given to find_stale
+        :type cutoff: datetime.datetime
+        :param revoked_at: the time of the revocation
+        :type revoked_at: datetime.datetime
+
+        :return: the number of Licenses revoked
+        :rtype: int
+
+        """
+        cls.logger.info("Processing revocation of %d stale ids ...", len(license_ids))
+        try:
+            count = (
+                cls.query.filter(cls.id.in_(license_ids))
+                .filter_by(is_active=True)
+                .filter(cls.last_checkin < cutoff)
+                .update(
+                    {cls.is_active: False, cls.revoked_at: revoked_at, cls.updated_at: revoked_at},
+                    synchronize_session=False,
+                )
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return count
+
+    @classmethod
+    def set_session_key(cls, license_id: int, session_key: str):
+        """Stores the session key of a License, as an update of the License
+
+        :param license_id: the id of the License
+        :type license_id: int
+        :param session_key: the session key, None to drop the session
+        :type session_key: str
+
+        """
+        cls.logger.info("Processing session key of id %s ...", license_id)
+        cls.query.filter_by(id=license_id).update(
+            {cls.session_key: session_key, cls.updated_at: datetime.now()}, synchronize_session=False
+        )
+        db.session.commit()
+
+    @classmethod
+    def find_updated_since(cls, since):
+        """Finds the Licenses updated or revoked after a point in time
+
+        :param since: the time after which the updates are returned
+        :type since: datetime.datetime
+
+        :return: the (id, updated_at) pairs of the updated Licenses
+        :rtype: list
+
+        """
+        cls.logger.info("Processing lookup for updates after %s ...", since)
+        return db.session.query(cls.id, cls.updated_at).filter(cls.updated_at > since).all()
+
+    @classmethod
+    def touch_each(cls, checkins: dict):
+        """Updates the last_checkin of many Licenses to their own times
+
+        All of the Licenses are updated with one executemany, and a
+        last_checkin is never moved back in time
+
+        :param checkins: the checkin times by License id
+        :type checkins: dict
+
+        """
+        cls.logger.info("Processing checkins of %d ids ...", len(checkins))
+        table = cls.__table__
+        statement = (
+            table.update()
+            .where(table.c.id == bindparam("checkin_id"))
+            .where(or_(table.c.last_checkin.is_(None), table.c.last_checkin < bindparam("checkin_time")))
+            .values(last_checkin=bindparam("checkin_time"))
+        )
+        try:
+            db.session.execute(statement, [
+                {"checkin_id": license_id, "checkin_time": checkin_time}
+                for license_id, checkin_time in checkins.items()
+            ])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    @classmethod
+    def find_private_keys(cls, after_id: int, limit: int, skip_prefix: str = None, column: str = "private_key"):
+        """Finds a batch of stored private keys in the order of the ids
+
+        :param after_id: only Licenses with a greater id are returned
+        :type after_id: int
+        :param limit: the maximum number of keys to return
+        :type limit: int
+        :param skip_prefix: leave out the keys starting with this prefix
+        :type skip_prefix: str
+        :param column: the key column, private_key or session_key
+        :type column: str
+
+        :return: the (id, key) pairs
+        :rtype: list
+
+        """
+        cls.logger.info("Processing lookup for %s after id %s ...", column, after_id)
+        key_column = getattr(cls, column)
+        query = (
+            db.session.query(cls.id, key_column)
+            .filter(cls.id > after_id)
+            .filter(key_column.isnot(None))
+        )
+        if skip_prefix:
+            query = query.filter(~key_column.startswith(skip_prefix, autoescape=True))
+        return [tuple(row) for row in query.order_by(cls.id).limit(limit).all()]
+
+    @classmethod
+    def replace_private_keys(cls, replacements: list, column: str = "private_key"):
+        """Replaces many stored private keys with one executemany
+
+        A key that was changed since it was read is left alone
+
+        :param replacements: (id, old key, new key) triples
+        :type replacements: list
+        :param column: the key column, private_key or session_key
+        :type column: str
+
+        """
+        cls.logger.info("Processing %s replacement of %d ids ...", column, len(replacements))
+        if not replacements:
+            return
+        table = cls.__table__
+        statement = (
+            table.update()
+            .where(table.c.id == bindparam("key_id"))
+            .where(table.c[column] == bindparam("old_private_key"))
+            .values({column: bindparam("new_private_key")})
+        )
+        try:
+            db.session.execute(statement, [
+                {"key_id": license_id, "old_private_key": old, "new_private_key": new}
+                for license_id, old, new in replacements
+            ])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
 
     @classmethod
     def find_or_404(cls, license_id: int):
@@ -189,8 +547,133 @@ class License(db.Model):
         cls.logger.info("Processing lookup or 404 for id %s ...", license_id)
         return cls.query.get_or_404(license_id)
 
+    @classmethod
+    def count_active(cls, username: str):
+        """Counts the active Licenses of a user
+
+        :param username: the owner of the Licenses
+        :type username: str
+
+        :return: the number of active Licenses
+        :rtype: int
+
+        """
+        cls.logger.info("Processing active count for %s ...", username)
+        return (
+            db.session.query(db.func.count(cls.id))
+            .filter_by(username=username, is_active=True)
+            .scalar()
+        )
+
+    @classmethod
+    def count_all_active(cls):
+        """Counts the active Licenses of all users
+
+        :return: the number of active Licenses
+        :rtype: int
+
+        """
+        cls.logger.info("Processing active count ...")
+        return db.session.query(db.func.count(cls.id)).filter_by(is_active=True).scalar()
+
     @classmethod
     def find_by_query_string(cls, args):
         """ Find Licenses by query string """
         cls.logger.info(" Processing lookup based on query string %s ...", args)
         return cls.query.filter_by(**args).order_by(License.created_at).all()
+
+    @classmethod
+    def iterate_by_query_string(cls, args, fields=None, batch_size: int = 1000):
+        """Iterates over the Licenses by query string
+
+        The rows are fetched from a server-side cursor in batches, so only
+        one batch is held in memory at a time
+
+        :param args: the attributes to filter by
+        :type args: dict
+        :param fields: the only fields to load, all of them if None
+        :type fields: list
+        :param batch_size: the number of rows fetched at once
+        :type batch_size: int
+
+        :return: a generator of Licenses ordered by id
+        """
+        cls.logger.info(" Processing iteration based on query string %s ...", args)
+        query = cls.query.filter_by(**args)
+        if fields:
+            query = query.options(load_only(*fields))
+        query = query.order_by(cls.id).execution_options(stream_results=True)
+        return query.yield_per(batch_size)
+
+    @classmethod
+    def find_page_by_query_string(cls, args, limit: int, cursor: int = None, fields=None):
+        """Finds one page of Licenses by query string
+
+        The pages are ordered by id, so a page starts right after the
+        cursor without scanning the Licenses of the previous pages
+
+        :param args: the attributes to filter by
+        :type args: dict
+        :param limit: the maximum number of Licenses to return
+        :type limit: int
+        :param cursor: the id of the last License of the previous page
+        :type cursor: int
+        :param fields: the only fields to load, all of them if None
+        :type fields: list
+
+        :return: the Licenses of the page
+        :rtype: list
+
+        """
+        cls.logger.info(" Processing page after %s based on query string %s ...", cursor, args)
+        query = cls.query.filter_by(**args)
+        if fields:
+            query = query.options(load_only(*fields))
+        if cursor is not None:
+            query = query.filter(cls.id > cursor)
+        return query.order_by(cls.id).limit(limit).all()
+
+
+class Seat(db.Model):
+    """
+    Class that represents the license quota of a user
+
+    The row of a user doubles as the lock taken while one of its Licenses
+    is allocated, see License.allocate()
+    """
+
+    logger = logging.getLogger(__name__)
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    username = db.Column(db.String(64), primary_key=True)
+    max_licenses = db.Column(db.Integer())
+    allocations = db.Column(db.Integer())
+
+    def __repr__(self):
+        return "<Seat %r>" % (self.username)
+
+    ##################################################
+    # CLASS METHODS
+    ##################################################
+
+    @classmethod
+    def ensure(cls, username: str, max_licenses: int):
+        """Creates the Seat of a user unless it exists
+
+        :param username: the owner of the Seat
+        :type username: str
+        :param max_licenses: the quota of the user
+        :type max_licenses: int
+
+        """
+        if cls.query.get(username):
+            return
+        cls.logger.info("Creating seat for %s with %d licenses", username, max_licenses)
+        db.session.add(cls(username=username, max_licenses=max_licenses, allocations=0))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # another request created it first
+            db.session.rollback()
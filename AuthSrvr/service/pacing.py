@@ -0,0 +1,204 @@
+"""
+Checkin pacing for the Authorizing Service
+
+The CheckinPacer recommends how long a container should wait before its
+next checkin. The recommendation is sent back with every checkin in the
+X-Next-Checkin header, and the App adopts it. It is computed from:
+
+    - the checkin QPS budget: with N active Licenses the fleet checks in
+      N / interval times per second, so the interval never drops below
+      N / budget
+    - the load of the server: when one of the signals below exceeds its
+      limit, the interval is stretched by the same factor
+        - the CPU pressure of the container's cgroup (the share of the last
+          10 seconds its tasks waited for a CPU, cgroup v2 only)
+        - the time the requests waited before being served: from the
+          X-Request-Start header of the proxy in front of gunicorn
+          ("t=<epoch seconds, ms or us>"), and from the queue of the crypto
+          executor, averaged over the recent requests
+        - in the asgi mode only, the number of requests in progress in this
+          worker; a sync worker only ever has one
+    - the lease TTL: the interval never exceeds a third of the TTL, so a
+      License survives two missed checkins before the reaper revokes it
+
+Statistics
+----------
+interval - the last recommended interval
+active - the number of active Licenses last counted
+inflight - the number of requests in progress in this worker
+queue_wait - the recent average wait of the requests, in seconds
+cpu_pressure - the CPU pressure of the cgroup, in percent (None if unknown)
+load - the load factor last applied
+"""
+
+import time
+import logging
+import threading
+from flask import request
+from .models import License
+
+# the CPU pressure of the cgroup of the container, on cgroup v2
+CPU_PRESSURE_FILE = "/sys/fs/cgroup/cpu.pressure"
+# weight of a new wait in the average of the recent waits
+WAIT_SMOOTHING = 0.1
+
+
+class CheckinPacer:
+    """
+    Class that represents the recommendation of the checkin interval
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, base_interval: float, qps_budget: float, max_queue_wait: float,
+                 max_cpu_pressure: float, lease_ttl: int, max_inflight: int = 0, refresh: float = 5.0):
+        self.base_interval = base_interval
+        self.qps_budget = qps_budget
+        self.max_queue_wait = max_queue_wait
+        self.max_cpu_pressure = max_cpu_pressure
+        self.max_inflight = max_inflight
+        self.lease_ttl = lease_ttl
+        self.refresh = refresh
+        self.inflight = 0
+        self.queue_wait = 0.0
+        self.cpu_pressure = None
+        self.active = 0
+        self.load = 1.0
+        self.interval = base_interval
+        self._counted_at = None
+        self._sampled_at = None
+        self._queues = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<CheckinPacer %.1fs>" % (self.interval)
+
+    def init_app(self, app):
+        """ Tracks the requests in progress of a Flask app """
+        app.before_request(lambda: self.request_started(request.headers.get("X-Request-Start")))
+        app.teardown_request(self.request_finished)
+
+    def watch_queue(self, histogram):
+        """ Adds the waits recorded by a histogram, e.g. the queue of the crypto executor, to the recent waits """
+        with self._lock:
+            self._queues.append([histogram, histogram.count, histogram.sum])
+
+    def count_due(self):
+        """ Returns True if the active Licenses should be counted again """
+        return self._counted_at is None or time.monotonic() - self._counted_at > self.refresh
+
+    def set_active(self, active: int):
+        """ Sets the number of active Licenses, counted by the caller """
+        self._counted_at = time.monotonic()
+        self.active = active
+
+    def next_interval(self, count: bool = True):
+        """Returns the recommended number of seconds until the next checkin
+
+        :param count: whether the active Licenses may be counted, False
+            serves the last count on the paths that do not read the database
+        :type count: bool
+
+        :rtype: float
+
+        """
+        if count and self.count_due():
+            # one COUNT every refresh interval, not one per checkin
+            self.set_active(License.count_all_active())
+
+        interval = max(self.base_interval, self.active / self.qps_budget)
+
+        if self._sampled_at is None or time.monotonic() - self._sampled_at > self.refresh:
+            self._sample()
+        signals = [1.0, self.queue_wait / self.max_queue_wait]
+        if self.cpu_pressure is not None:
+            signals.append(self.cpu_pressure / self.max_cpu_pressure)
+        if self.max_inflight:
+            signals.append(self.inflight / self.max_inflight)
+        self.load = round(max(signals), 2)
+        interval *= self.load
+
+        if self.lease_ttl > 0:
+            interval = min(interval, self.lease_ttl / 3)
+        self.interval = round(interval, 1)
+        return self.interval
+
+    def stats(self):
+        """ Returns the statistics of the pacer as a dictionary """
+        return {
+            "interval": self.interval,
+            "active": self.active,
+            "inflight": self.inflight,
+            "queue_wait": round(self.queue_wait, 4),
+            "cpu_pressure": self.cpu_pressure,
+            "load": self.load,
+        }
+
+    def observe_wait(self, seconds: float, count: int = 1):
+        """ Adds the wait of a request, or the average wait of `count` requests, to the average of the recent waits """
+        weight = 1 - (1 - WAIT_SMOOTHING) ** count
+        with self._lock:
+            self.queue_wait += weight * (seconds - self.queue_wait)
+
+    def _sample(self):
+        """ Reads the CPU pressure and the new waits of the watched queues """
+        self._sampled_at = time.monotonic()
+        self.cpu_pressure = read_cpu_pressure()
+        with self._lock:
+            queues = list(self._queues)
+        for watched in queues:
+            histogram, count, total = watched
+            if histogram.count > count:
+                new = histogram.count - count
+                self.observe_wait((histogram.sum - total) / new, new)
+                watched[1:] = [histogram.count, histogram.sum]
+
+    def request_started(self, request_start: str = None):
+        """Counts a request in progress
+
+        :param request_start: the X-Request-Start header set by the proxy, if any
+        :type request_start: str
+
+        """
+        with self._lock:
+            self.inflight += 1
+        if request_start:
+            started = parse_request_start(request_start)
+            if started is not None:
+                self.observe_wait(max(0.0, time.time() - started))
+
+    def request_finished(self, error=None):
+        """ Counts a finished request """
+        with self._lock:
+            self.inflight -= 1
+
+
+def parse_request_start(value: str):
+    """Reads the time a proxy received a request from its X-Request-Start header
+
+    :param value: "t=<epoch>" or "<epoch>", in seconds, milliseconds or microseconds
+    :type value: str
+
+    :return: the epoch in seconds, or None if it cannot be read
+    """
+    try:
+        epoch = float(value.strip().lstrip("t="))
+    except ValueError:
+        return None
+    # scaled down to seconds from milliseconds (> year 2286 in seconds) or microseconds
+    while epoch > 1e10:
+        epoch /= 1000
+    return epoch
+
+
+def read_cpu_pressure(path: str = CPU_PRESSURE_FILE):
+    """ Returns the share of the last 10 seconds in which tasks of the cgroup waited for a CPU, in percent """
+    try:
+        with open(path) as pressure:
+            for line in pressure:
+                if line.startswith("some "):
+                    fields = dict(field.split("=", 1) for field in line.split()[1:])
+                    return float(fields["avg10"])
+    except (OSError, KeyError, ValueError):
+        pass
+    return None
@@ -0,0 +1,123 @@
+"""
+Lease Reaper for the Authorizing Service
+
+A container that dies without revoking its License never checks in again,
+but its License stays active and keeps using up a seat of its user. The
+LeaseReaper periodically revokes the active Licenses whose last checkin is
+older than the lease TTL. Every sweep works in bounded batches, walking the
+(is_active, last_checkin) index from the oldest checkin on, and commits after
+each batch so no lock is held for long. On Postgres the rows locked by the
+reaper of another worker are skipped.
+
+With the checkin write-behind enabled, the buffer of the worker is flushed
+before every sweep, and the TTL is extended by one flush interval to cover
+the checkins still buffered in the other workers.
+
+The cached rows of the Licenses of every batch are dropped from the License
+cache, if there is one.
+
+Statistics
+----------
+ttl - the number of seconds a License may go without checking in
+sweeps - the number of sweeps run
+reaped - the number of Licenses revoked
+last_sweep_seconds - how long the last sweep took
+last_sweep_reaped - the number of Licenses revoked by the last sweep
+"""
+
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from .models import License
+
+
+class LeaseReaper:
+    """
+    Class that represents the background revocation of stale Licenses
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, app, ttl: int, interval: int, batch_size: int, heartbeats=None, license_cache=None):
+        self.app = app
+        self.ttl = ttl
+        self.interval = interval
+        self.batch_size = batch_size
+        self.heartbeats = heartbeats
+        self.license_cache = license_cache
+        self.sweeps = 0
+        self.reaped = 0
+        self.last_sweep_seconds = None
+        self.last_sweep_reaped = 0
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def __repr__(self):
+        return "<LeaseReaper ttl=%ds>" % (self.ttl)
+
+    def start(self):
+        """ Starts the thread that sweeps every interval """
+        if self.ttl <= 0:
+            self.logger.info("Lease reaper disabled, stale licenses stay active")
+            return
+        self.logger.info("Starting lease reaper with a TTL of %d seconds", self.ttl)
+        self._thread = threading.Thread(target=self._run, name="lease-reaper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stops the sweeping thread """
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def sweep(self):
+        """Revokes the Licenses that did not check in within the TTL
+
+        :return: the number of Licenses revoked
+        :rtype: int
+
+        """
+        start = time.perf_counter()
+        now = datetime.now()
+        cutoff = now - timedelta(seconds=self.ttl)
+        if self.heartbeats:
+            self.heartbeats.flush()
+            cutoff -= timedelta(seconds=self.heartbeats.interval)
+        reaped = 0
+        with self.app.app_context():
+            while not self._stopped.is_set():
+                ids = License.find_stale(cutoff, self.batch_size)
+                if ids:
+                    reaped += License.revoke_stale(ids, cutoff, now)
+                    if self.license_cache:
+                        self.license_cache.invalidate(ids)
+                if len(ids) < self.batch_size:
+                    break
+
+        self.sweeps += 1
+        self.reaped += reaped
+        self.last_sweep_reaped = reaped
+        self.last_sweep_seconds = time.perf_counter() - start
+        if reaped:
+            self.logger.info("Reaped %d stale licenses in %.3f seconds", reaped, self.last_sweep_seconds)
+        return reaped
+
+    def stats(self):
+        """ Returns the statistics of the reaper as a dictionary """
+        return {
+            "ttl": self.ttl,
+            "sweeps": self.sweeps,
+            "reaped": self.reaped,
+            "last_sweep_seconds": self.last_sweep_seconds,
+            "last_sweep_reaped": self.last_sweep_reaped,
+        }
+
+    def _run(self):
+        """ Sweeps every interval until stopped """
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception:  # pylint: disable=broad-except
+                self.logger.exception("Failed to reap stale licenses")
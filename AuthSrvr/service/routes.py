@@ -16,22 +16,123 @@ Authorizing Service
 import os
 import sys
 import logging
-from flask import Flask, jsonify, request, url_for, make_response, abort
+from flask import Flask, Response, jsonify, request, url_for, make_response, abort, stream_with_context, g
 from flask_api import status  # HTTP Status Codes
-from werkzeug.exceptions import NotFound, Forbidden, InternalServerError
+from werkzeug.exceptions import NotFound, Forbidden, Conflict, InternalServerError
 from datetime import datetime
-from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric import padding, rsa
+import time
 import base64
+import hmac
+import functools
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 from flask_sqlalchemy import SQLAlchemy
-from .models import License, DataValidationError
+from .models import License, DataValidationError, db
+from .keypool import KeyPool
+from .keycache import KeyCache
+from .keystore import create_key_store
+from .cryptoexec import CryptoExecutor, CryptoBusy
+from .reaper import LeaseReaper
+from .leasetokens import LeaseTokens
+from .licensecache import LicenseCache, create_backend
+from .heartbeats import HeartbeatBuffer
+from .pacing import CheckinPacer
+from .crypto import session_tag, KEY_ALGORITHMS, SESSION_KEY_BYTES, NONCE_MIN_BYTES
+from .export import export_licenses, EXPORT_FORMATS
+from .metrics import Family, SharedMetrics, EXPOSITION_CONTENT_TYPE
+from .logs import LogPipeline
+from . import dbpool
 
 # Import Flask application
 from . import app
 
+# Wrapping of the stored private keys, created in init_key_store()
+key_store = None
+
+# Execution of the CPU bound crypto jobs, started in init_crypto_executor()
+crypto_executor = None
+
+# Pools of pre-generated keypairs per key algorithm, started in init_key_pools()
+key_pools = {}
+
+# Cache of loaded private keys, created in init_key_cache()
+key_cache = None
+
+# Revocation of stale licenses, started in init_reaper()
+reaper = None
+
+# Lease tokens of the checkins that skip the database, started in init_lease_tokens()
+lease_tokens = None
+
+# Queue, listener and sampling of the logs, created in init_logging()
+log_pipeline = None
+
+# Shared read-through cache of the Licenses, created in init_license_cache()
+license_cache = None
+
+# Write-behind buffer of checkins, started in init_heartbeats() if enabled
+heartbeats = None
+
+# Recommendation of the checkin interval, created in init_pacer()
+pacer = None
+
+# Metrics of all of the workers, started in init_shared_metrics()
+shared_metrics = None
+
+# Metrics served at /metrics, the others are collected from the subsystems
+request_duration = Family(
+    "authsrvr_http_request_duration_seconds", "Latency of the requests by route", "histogram", ("method", "route")
+)
+requests_total = Family(
+    "authsrvr_http_requests_total", "Requests by route and status", "counter", ("method", "route", "status")
+)
+checkins_total = Family(
+    "authsrvr_checkins_total", "Checkins by protocol mode and status", "counter", ("mode", "status")
+)
+METRICS = [
+    request_duration,
+    requests_total,
+    checkins_total,
+    Family(
+        "authsrvr_crypto_duration_seconds",
+        "Time of the crypto jobs waiting for a worker (queue) and running (exec)",
+        "histogram",
+        ("operation", "stage"),
+        collect=lambda: [
+            ((operation, stage), histogram)
+            for operation, stages in sorted(crypto_executor.histograms.items())
+            for stage, histogram in sorted(stages.items())
+        ],
+    ),
+    Family(
+        "authsrvr_key_load_duration_seconds",
+        "Time of unwrapping and parsing a private key missing from the key cache",
+        "histogram",
+        collect=lambda: [((), key_cache.load_time)],
+    ),
+    Family(
+        "authsrvr_db_commit_duration_seconds",
+        "Time of the database commits, flush included",
+        "histogram",
+        collect=lambda: [((), dbpool.commit_duration)],
+    ),
+    Family(
+        "authsrvr_db_checkout_wait_seconds",
+        "Time waited for a database connection from the pool",
+        "histogram",
+        collect=lambda: [((), dbpool.checkout_wait)],
+    ),
+    Family(
+        "authsrvr_active_licenses",
+        "Active licenses, counted at most once per pacer refresh",
+        "gauge",
+        collect=lambda: [((), active_licenses())],
+        # every worker counts the same table
+        aggregate="max",
+    ),
+]
+
 ######################################################################
 # Error Handlers
 ######################################################################
@@ -51,6 +152,19 @@ def bad_request(error):
         status.HTTP_400_BAD_REQUEST,
     )
 
+@app.errorhandler(status.HTTP_403_FORBIDDEN)
+def forbidden(error):
+    """ Handles refused requests with 403_FORBIDDEN """
+    app.logger.warning(str(error))
+    return (
+        jsonify(
+            status=status.HTTP_403_FORBIDDEN,
+            error="Forbidden",
+            message=str(error),
+        ),
+        status.HTTP_403_FORBIDDEN,
+    )
+
 @app.errorhandler(status.HTTP_404_NOT_FOUND)
 def not_found(error):
     """ Handles resources not found with 404_NOT_FOUND """
@@ -75,6 +189,19 @@ def method_not_supported(error):
         status.HTTP_405_METHOD_NOT_ALLOWED,
     )
 
+@app.errorhandler(status.HTTP_409_CONFLICT)
+def resource_conflict(error):
+    """ Handles requests that conflict with the state of the resource """
+    app.logger.warning(str(error))
+    return (
+        jsonify(
+            status=status.HTTP_409_CONFLICT,
+            error="Conflict",
+            message=str(error),
+        ),
+        status.HTTP_409_CONFLICT,
+    )
+
 @app.errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 def mediatype_not_supported(error):
     """ Handles unsuppoted media requests with 415_UNSUPPORTED_MEDIA_TYPE """
@@ -88,6 +215,20 @@ def mediatype_not_supported(error):
         status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
     )
 
+@app.errorhandler(CryptoBusy)
+def crypto_busy(error):
+    """ Handles a saturated crypto executor with 503_SERVICE_UNAVAILABLE """
+    app.logger.warning(str(error))
+    return (
+        jsonify(
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            error="Service Unavailable",
+            message=str(error),
+        ),
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        {"Retry-After": str(app.config["CRYPTO_RETRY_AFTER"])},
+    )
+
 @app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
 def internal_server_error(error):
     """ Handles unexpected server error with 500_SERVER_ERROR """
@@ -102,6 +243,32 @@ def internal_server_error(error):
     )
 
 
+######################################################################
+# Request Metrics
+######################################################################
+@app.before_request
+def start_request_timer():
+    """ Remembers when the request started, and whether its logs are sampled """
+    g.request_started = time.perf_counter()
+    g.log_token = log_pipeline.start_request(request.url_rule.rule if request.url_rule else "unmatched")
+
+@app.teardown_request
+def end_request_logs(error=None):
+    """ Ends the sampling of the logs of the request """
+    if "log_token" in g:
+        log_pipeline.end_request(g.pop("log_token"))
+
+@app.after_request
+def observe_response(response):
+    """ Records the latency and the status of the request in the metrics """
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    started = g.get("request_started", time.perf_counter())
+    observe_request(request.method, route, response.status_code, time.perf_counter() - started)
+    if request.url_rule and request.url_rule.endpoint == "periodically_checkin":
+        count_checkin(request.get_json(silent=True), response.status_code)
+    return response
+
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -119,18 +286,116 @@ def index():
     )
 
 
+######################################################################
+# GET SERVICE STATISTICS
+######################################################################
+@app.route("/stats", methods=["GET"])
+def get_stats():
+    """ Returns the runtime statistics of the service """
+    app.logger.info("Request for service statistics")
+    return make_response(
+        jsonify(
+            key_pools={algorithm: pool.stats() for algorithm, pool in key_pools.items()},
+            key_cache=key_cache.stats(),
+            logs=log_pipeline.stats(),
+            license_cache=license_cache.stats(),
+            crypto=crypto_executor.stats(),
+            reaper=reaper.stats(),
+            lease_tokens=lease_tokens.stats(),
+            heartbeats=heartbeats.stats() if heartbeats else None,
+            pacer=pacer.stats(),
+            db=dbpool.stats(db.engine),
+            metrics=shared_metrics.stats(),
+        ),
+        status.HTTP_200_OK,
+    )
+
+
+######################################################################
+# GET PROMETHEUS METRICS
+######################################################################
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """ Returns the metrics of all of the workers (or of this one) in the Prometheus text format """
+    return Response(shared_metrics.exposition(), status.HTTP_200_OK, content_type=EXPOSITION_CONTENT_TYPE)
+
+
 ######################################################################
 # LIST ALL License
 ######################################################################
 @app.route("/licenses", methods=["GET"])
 def list_licenses():
-    """ Returns all of the Licenses """
+    """
+    Returns a page of the Licenses
+
+    The query string filters the Licenses by their attributes, except for:
+      limit - the maximum number of Licenses on the page
+      cursor - the value of X-Next-Cursor returned with the previous page
+      fields - comma separated names of the only fields to return
+    A full page carries the cursor of the next one in the X-Next-Cursor and
+    Link headers. The key material is only returned when asked for in fields.
+    """
     args = request.args.to_dict()
     app.logger.info("Request to list Licenses based on query string %s ...", args)
-    licenses = License.find_by_query_string(args)
-    results = [lic.serialize() for lic in licenses]
+
+    try:
+        limit = int(args.pop("limit", app.config["LIST_DEFAULT_LIMIT"]))
+        cursor = int(args.pop("cursor")) if "cursor" in args else None
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, "limit and cursor must be integers")
+    if limit < 1:
+        abort(status.HTTP_400_BAD_REQUEST, "limit must be positive")
+    limit = min(limit, app.config["LIST_MAX_LIMIT"])
+
+    fields = None
+    if "fields" in args:
+        fields = [field for field in args.pop("fields").split(",") if field]
+        unknown = set(fields) - set(License.FIELDS)
+        if unknown:
+            abort(status.HTTP_400_BAD_REQUEST, "Unknown fields: {}".format(", ".join(sorted(unknown))))
+
+    licenses = License.find_page_by_query_string(args, limit, cursor, fields or License.COMPACT_FIELDS)
+    results = [
+        lic.serialize(fields, compact=True, last_checkin=buffered_checkin(lic.id))
+        for lic in licenses
+    ]
     app.logger.info("Returning %d licenses", len(results))
-    return make_response(jsonify(results), status.HTTP_200_OK)
+
+    headers = {}
+    if len(licenses) == limit:
+        next_cursor = licenses[-1].id
+        next_url = url_for(
+            "list_licenses", _external=True,
+            **dict(request.args.to_dict(), cursor=next_cursor)
+        )
+        headers = {"X-Next-Cursor": str(next_cursor), "Link": '<{}>; rel="next"'.format(next_url)}
+    return make_response(jsonify(results), status.HTTP_200_OK, headers)
+
+
+######################################################################
+# EXPORT ALL License
+######################################################################
+@app.route("/licenses/export", methods=["GET"])
+def export_all_licenses():
+    """
+    Streams all of the Licenses without their private keys
+
+    The query string filters the Licenses the same way as GET /licenses,
+    except for `format`, which is either `ndjson` (default) or `csv`
+    """
+    args = request.args.to_dict()
+    export_format = args.pop("format", "ndjson")
+    if export_format not in EXPORT_FORMATS:
+        abort(status.HTTP_400_BAD_REQUEST, "format must be one of {}".format(", ".join(sorted(EXPORT_FORMATS))))
+
+    app.logger.info("Request to export Licenses as %s based on query string %s ...", export_format, args)
+    chunks = export_licenses(args, export_format, last_checkin=buffered_checkin)
+    return Response(
+        stream_with_context(chunks),
+        status=status.HTTP_200_OK,
+        mimetype=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": "attachment; filename=licenses.{}".format(export_format)},
+    )
 
 
 ######################################################################
@@ -144,12 +409,14 @@ def get_licenses(license_id):
     This endpoint will return a License based on it's id
     """
     app.logger.info("Request for license with id: %s", license_id)
-    lic = License.find(license_id)
+    lic = find_license(license_id)
     if not lic:
         raise NotFound("License with id '{}' was not found.".format(license_id))
 
-    app.logger.info("Returning lic: %s", lic.pub_key)
-    return make_response(jsonify(lic.serialize()), status.HTTP_200_OK)
+    app.logger.info("Returning license with id: %s", lic.id)
+    return make_response(
+        jsonify(lic.serialize(last_checkin=buffered_checkin(lic.id))), status.HTTP_200_OK
+    )
 
 
 ######################################################################
@@ -169,7 +436,12 @@ def update_licenses(license_id):
         raise NotFound("License with id '{}' was not found.".format(license_id))
     lic.deserialize(request.get_json())
     lic.id = license_id
+    # a session belongs to the keypair it was opened with
+    lic.session_key = None
     lic.update()
+    license_cache.invalidate([license_id])
+    key_cache.invalidate(license_id)
+    lease_tokens.deny(license_id)
 
     app.logger.info("License with ID [%s] updated.", lic.id)
     return make_response(jsonify(lic.serialize()), status.HTTP_200_OK)
@@ -192,14 +464,26 @@ def patch_licenses(license_id):
         raise NotFound("License with id '{}' was not found.".format(license_id))
 
     # use existing values for the fields
-    update_data = request.get_json()
+    update_data = License.parse_datetimes(request.get_json())
     for field in update_data:
         setattr(lic, field, update_data[field])
     lic.id = license_id
+    # a session belongs to the keypair it was opened with
+    if set(update_data) & set(License.KEY_FIELDS):
+        lic.session_key = None
     lic.update()
+    license_cache.invalidate([license_id])
+    key_cache.invalidate(license_id)
+    lease_tokens.deny(license_id)
+
+    # only send the key material back if it was changed
+    compact = not set(update_data) & set(License.KEY_FIELDS)
 
     app.logger.info("License with ID [%s] updated.", lic.id)
-    return make_response(jsonify(lic.serialize()), status.HTTP_200_OK)
+    return make_response(
+        jsonify(lic.serialize(compact=compact, last_checkin=buffered_checkin(lic.id))),
+        status.HTTP_200_OK,
+    )
 
 
 ######################################################################
@@ -220,34 +504,31 @@ def create_licenses():
     if not authenticate(data["username"], data["password"]):
         return make_response(jsonify({}), status.HTTP_401_UNAUTHORIZED)
 
-    # check if the user has available license
-    # TODO: max_license_available should be stored at the users table, we hardcoded it for now.
-    max_license_available = 2
-    if not check_license_available(data["username"], max_license_available):
-        return make_response(jsonify({}), status.HTTP_403_FORBIDDEN)
+    # the deployment picks the key algorithm, unless the container asks for one
+    key_algorithm = data.get("key_algorithm") or app.config["KEY_ALGORITHM"]
+    if key_algorithm not in key_pools:
+        abort(status.HTTP_400_BAD_REQUEST, "Unsupported key algorithm '{}'".format(key_algorithm))
 
-    private_key_obj = rsa.generate_private_key(public_exponent=65537,key_size=2048)
-    private_key = private_key_obj.private_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PrivateFormat.PKCS8,
-        encryption_algorithm=serialization.BestAvailableEncryption(b'mypassword')
-    )
-    public_key_obj = private_key_obj.public_key()
-    public_key = public_key_obj.public_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PublicFormat.SubjectPublicKeyInfo
-    )
+    key_pool = key_pools[key_algorithm]
+    keypair = key_pool.acquire()
+    private_key, public_key = keypair
 
     data["is_active"] = True
-    data["private_key"] = private_key.decode('UTF-8','strict')
-    data["pub_key"] = public_key.decode('UTF-8','strict')
+    data["private_key"] = private_key
+    data["pub_key"] = public_key
+    data["key_algorithm"] = key_algorithm
     data["created_at"] = datetime.now()
     data["revoked_at"] = None
     data["last_checkin"] = datetime.now()
 
     lic = License()
     lic.deserialize(data)
-    lic.create()
+
+    # create the license only if the user has available license
+    if not lic.allocate(app.config["MAX_LICENSES_PER_USER"]):
+        key_pool.release(keypair)
+        app.logger.info("User %s has no available license", data["username"])
+        return make_response(jsonify({}), status.HTTP_403_FORBIDDEN)
 
     message = lic.serialize()
     message["private_key"] = "shh!"
@@ -255,9 +536,9 @@ def create_licenses():
     location_url = url_for("get_licenses", license_id=lic.id, _external=True)
 
     app.logger.info("License with ID [%s] created.", lic.id)
-    return make_response(
-        jsonify(message), status.HTTP_201_CREATED, {"Location": location_url}
-    )
+    headers = {"Location": location_url}
+    headers.update(lease_token_header(lic))
+    return make_response(jsonify(message), status.HTTP_201_CREATED, headers)
 
 
 # # ###################################################################
@@ -291,74 +572,295 @@ def periodically_checkin(license_id):
     """
     When the application container ping this endpoint,
     Then AS checks the `container_id` and `pub_key` in request body,
-    If they do not match the record in DB, 
+    If they do not match the record in DB, or the license was revoked,
         return 403 Forbidden
     If they matches the record in DB, 
         Then AS updated a field `last_checkedin` to current time,
         return 200 if succeeded
         return 500 if failed
+    The challenge is either an `encrypted_message` to decrypt, or in the
+    session mode an `encrypted_session_key` opening a session followed by
+    checkins with a `nonce` and its `proof` (see answer_checkin()).
+    A session checkin presenting a valid `lease_token` is answered without
+    reading the database (see answer_token_checkin()), the others are
+    answered with a fresh token in the X-Lease-Token header.
+    The recommended number of seconds until the next checkin is returned
+    in the X-Next-Checkin header.
     """
     app.logger.info("Checkin request for license with id: %s", license_id)
     check_content_type("application/json")
+    request_body = request.get_json()
 
-    lic = License.find(license_id)
+    try:
+        answer = answer_token_checkin(license_id, request_body)
+    except (KeyError, TypeError, ValueError):
+        abort(status.HTTP_400_BAD_REQUEST, "The checkin challenge of '{}' is malformed.".format(license_id))
+    if answer is not None:
+        return make_response(jsonify(answer), status.HTTP_200_OK, next_checkin_header(count=False))
+
+    lic = find_license(license_id)
     if not lic:
         raise NotFound("License with id '{}' was not found.".format(license_id))
 
     # check if request matches the record in DB
     else:
-        request_body = request.get_json()
-
         req_cid = request_body['used_by']
         req_pub_key = request_body['pub_key']
         lic_cid = lic.used_by
         lic_pub_key = lic.pub_key
 
-        if lic_cid == req_cid and lic_pub_key == req_pub_key:
+        if lic.is_active and lic_cid == req_cid and lic_pub_key == req_pub_key:
+            # answer the challenge, a failed proof is refused before anything is updated
+            try:
+                decrypted_message = answer_checkin(lic, request_body)
+            except (KeyError, TypeError, ValueError):
+                abort(status.HTTP_400_BAD_REQUEST, "The checkin challenge of '{}' is malformed.".format(license_id))
+            if opens_session(request_body):
+                store_session(lic)
             try:
                 # update 'last_checkin' to current time
-                lic.last_checkin = datetime.now()
-                lic.update()    # actually write to the database
-                app.logger.info("Successfully updated last_checkin field of current license with id '{}'.".format(license_id))
-
-                # convert the encrypted_message from ascii string to bytes
-                encrypted_message = request_body["encrypted_message"]
-                app.logger.debug("encrypted_message: {}".format(encrypted_message))
-                encrypted_message_bytes = base64.b64decode(encrypted_message.encode('ascii', 'strict'))
-                app.logger.debug("encrypted_message_bytes: {}".format(encrypted_message_bytes))
-
-                # decrypt the message
-                private_key_obj = serialization.load_pem_private_key(lic.private_key.encode('UTF-8','strict'), password=b'mypassword')
-                decrypted_message_byte = private_key_obj.decrypt(
-                    encrypted_message_bytes,
-                    padding.OAEP(
-                        mgf=padding.MGF1(algorithm=hashes.SHA256()),
-                        algorithm=hashes.SHA256(),
-                        label=None
-                    )
-                )
-                app.logger.debug("decrypted_message_byte: {}".format(decrypted_message_byte))
-
-                # send the decrypted_message as ascii string
-                decrypted_message = base64.b64encode(decrypted_message_byte).decode('ascii','strict')
-                # For testing the replay attack:
-                # decrypted_message = 'ABCDEFG12345'
-                app.logger.debug("decrypted_message: {}".format(decrypted_message))
-
-                return make_response(jsonify(decrypted_message), status.HTTP_200_OK)
+                record_checkin([license_id], datetime.now())
+                app.logger.info("Successfully updated last_checkin field of current license with id '%s'.", license_id)
+
+                headers = next_checkin_header()
+                headers.update(lease_token_header(lic))
+                return make_response(jsonify(decrypted_message), status.HTTP_200_OK, headers)
             except:
                 raise InternalServerError("Failed to update last_checkin field of current license with id '{}'.".format(license_id))
         else:
             raise Forbidden("The info of '{}' does not match the record in DB.".format(license_id))
 
 
+######################################################################
+# Endpoint for batched periodical checkin
+######################################################################
+@app.route("/licenses/checkin:batch", methods=["POST"])
+def batch_checkin():
+    """
+    Checks in many licenses with one request
+
+    The request body is a list of `{id, used_by, pub_key, encrypted_message}`
+    entries (or session mode entries, see answer_checkin()), e.g. sent by a node agent on behalf of all of its containers.
+    Every entry is verified the same way as POST /licenses/{id}/checkin and
+    the `last_checkin` of all the verified licenses is updated at once.
+    The response is a list of `{id, status, message}` results in the order
+    of the entries, where `message` holds the decrypted message on success.
+    The X-Next-Checkin header applies to all of the licenses.
+    """
+    app.logger.info("Batch checkin request")
+    check_content_type("application/json")
+
+    entries = request.get_json()
+    if not isinstance(entries, list):
+        abort(status.HTTP_400_BAD_REQUEST, "Request body must be a list of checkins")
+    if len(entries) > app.config["CHECKIN_BATCH_MAX"]:
+        abort(
+            status.HTTP_400_BAD_REQUEST,
+            "A batch can contain at most {} checkins".format(app.config["CHECKIN_BATCH_MAX"]),
+        )
+
+    ids = [entry["id"] for entry in entries if isinstance(entry, dict) and isinstance(entry.get("id"), int)]
+    licenses = {lic.id: lic for lic in License.find_all(ids, keys=True)}
+
+    results = []
+    for entry in entries:
+        try:
+            license_id = entry["id"]
+            lic = licenses.get(license_id)
+            if not lic:
+                results.append(checkin_result(license_id, status.HTTP_404_NOT_FOUND, "Not Found"))
+            elif not lic.is_active or lic.used_by != entry["used_by"] or lic.pub_key != entry["pub_key"]:
+                results.append(checkin_result(license_id, status.HTTP_403_FORBIDDEN, "Forbidden"))
+            else:
+                decrypted_message = answer_checkin(lic, entry)
+                if opens_session(entry):
+                    store_session(lic)
+                results.append(checkin_result(license_id, status.HTTP_200_OK, decrypted_message))
+        except Forbidden:
+            results.append(checkin_result(license_id, status.HTTP_403_FORBIDDEN, "Forbidden"))
+        except Conflict:
+            results.append(checkin_result(license_id, status.HTTP_409_CONFLICT, "Conflict"))
+        except (KeyError, TypeError, ValueError):
+            license_id = entry.get("id") if isinstance(entry, dict) else None
+            results.append(checkin_result(license_id, status.HTTP_400_BAD_REQUEST, "Bad Request"))
+    for entry, result in zip(entries, results):
+        count_checkin(entry, result["status"])
+
+    checked_in = [result["id"] for result in results if result["status"] == status.HTTP_200_OK]
+    try:
+        record_checkin(checked_in, datetime.now())
+    except Exception:
+        raise InternalServerError("Failed to update last_checkin field of the batch.")
+
+    app.logger.info("Checked in %d of %d licenses", len(checked_in), len(results))
+    return make_response(jsonify(results), status.HTTP_200_OK, next_checkin_header())
+
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
 def init_db():
     """ Initializes the SQLAlchemy app """
     global app
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = dbpool.engine_options(app.config)
+    dbpool.check_connection_budget(app.config)
     License.init_db(app)
+    dbpool.time_commits(db.session)
+
+def init_shared_metrics():
+    """ Shares the metrics of the workers through METRICS_DIR, if set """
+    global shared_metrics
+    if app.config["METRICS_SHARE_INTERVAL"] <= 0:
+        raise ValueError("METRICS_SHARE_INTERVAL must be positive")
+    shared_metrics = SharedMetrics(app, app.config["METRICS_DIR"], METRICS, app.config["METRICS_SHARE_INTERVAL"])
+    shared_metrics.start()
+
+def init_logging():
+    """ Sends the logs of the service through the log pipeline """
+    global log_pipeline
+    log_pipeline = LogPipeline(
+        app.config["LOGGING_LEVEL"],
+        app.config["LOG_FORMAT"],
+        app.config["LOG_QUEUE_SIZE"],
+        app.config["LOG_SAMPLING"],
+    )
+    log_pipeline.install(app.logger)
+
+def init_key_store():
+    """ Creates the key store wrapping the stored private keys """
+    global key_store
+    key_store = create_key_store(app.config["LICENSE_MASTER_KEY"], app.config["LEGACY_KEY_PASSPHRASE"])
+
+def init_crypto_executor():
+    """ Forks the worker processes of the crypto jobs, if enabled """
+    global crypto_executor
+    crypto_executor = CryptoExecutor(
+        key_store,
+        key_cache,
+        app.config["CRYPTO_WORKERS"],
+        app.config["CRYPTO_MAX_PENDING"],
+        app.config["CRYPTO_TIMEOUT"],
+        (app.config["LICENSE_MASTER_KEY"], app.config["LEGACY_KEY_PASSPHRASE"], app.config["KEY_CACHE_SIZE"]),
+    )
+    crypto_executor.start()
+
+def init_key_pools():
+    """ Starts a pool of pre-generated keypairs for every allowed key algorithm """
+    global key_pools
+    algorithms = set(app.config["KEY_ALGORITHMS"]) | {app.config["KEY_ALGORITHM"]}
+    for algorithm in sorted(algorithms):
+        if algorithm not in KEY_ALGORITHMS:
+            raise ValueError("Unknown key algorithm '{}'".format(algorithm))
+        key_pools[algorithm] = KeyPool(
+            app.config["KEY_POOL_SIZE"],
+            functools.partial(crypto_executor.generate_keypair, algorithm),
+            app.config["KEY_POOL_WORKERS"],
+        )
+        key_pools[algorithm].start()
+
+def init_key_cache():
+    """ Creates the cache of loaded private keys """
+    global key_cache
+    key_cache = KeyCache(app.config["KEY_CACHE_SIZE"], key_store.unwrap)
+
+def init_license_cache():
+    """ Creates the shared cache of the Licenses, if a backend is configured """
+    global license_cache
+    backend = create_backend(
+        app.config["LICENSE_CACHE_BACKEND"], app.config["LICENSE_CACHE_URL"], app.config["LICENSE_CACHE_SIZE"]
+    )
+    if backend is not None and backend.name == "memory" and app.config["GUNICORN_WORKERS"] > 1:
+        raise ValueError("The memory license cache is not shared, use redis with more than one worker")
+    license_cache = LicenseCache(
+        backend, functools.partial(License.find, keys=True), app.config["LICENSE_CACHE_TTL"]
+    )
+
+def init_heartbeats():
+    """ Starts the write-behind buffer of checkins if it is enabled """
+    global heartbeats
+    if not app.config["CHECKIN_WRITE_BEHIND"]:
+        return
+    heartbeats = HeartbeatBuffer(app, app.config["CHECKIN_FLUSH_INTERVAL"])
+    heartbeats.start()
+
+def init_reaper():
+    """ Starts the revocation of stale licenses """
+    global reaper
+    reaper = LeaseReaper(
+        app,
+        app.config["LEASE_TTL"],
+        app.config["LEASE_REAP_INTERVAL"],
+        app.config["LEASE_REAP_BATCH"],
+        heartbeats,
+        license_cache,
+    )
+    reaper.start()
+
+def init_lease_tokens():
+    """ Starts the lease tokens of the checkins, if there is a token key """
+    global lease_tokens
+    lease_tokens = LeaseTokens(
+        app,
+        app.config["LEASE_TOKEN_KEY"],
+        app.config["LEASE_TOKEN_TTL"],
+        app.config["LEASE_TOKEN_RENEW"],
+        app.config["LEASE_DENY_REFRESH"],
+        # the poll counts the active licenses, the token checkins do not
+        pacer,
+    )
+    if lease_tokens.enabled and 0 < app.config["LEASE_TTL"] <= app.config["LEASE_TOKEN_TTL"]:
+        # the checkins are only recorded when the tokens are renewed
+        raise ValueError("LEASE_TOKEN_TTL must be shorter than LEASE_TTL")
+    lease_tokens.start()
+
+def init_pacer():
+    """ Creates the recommendation of the checkin interval """
+    global pacer
+    if app.config["CHECKIN_MAX_QUEUE_WAIT"] <= 0 or app.config["CHECKIN_MAX_CPU_PRESSURE"] <= 0:
+        raise ValueError("CHECKIN_MAX_QUEUE_WAIT and CHECKIN_MAX_CPU_PRESSURE must be positive")
+    pacer = CheckinPacer(
+        app.config["CHECKIN_INTERVAL"],
+        app.config["CHECKIN_QPS_BUDGET"],
+        app.config["CHECKIN_MAX_QUEUE_WAIT"],
+        app.config["CHECKIN_MAX_CPU_PRESSURE"],
+        app.config["LEASE_TTL"],
+        # a sync worker has one request in progress at most
+        app.config["CHECKIN_MAX_INFLIGHT"] if app.config["SERVER_MODE"] == "asgi" else 0,
+    )
+    pacer.init_app(app)
+    # the decryptions of the checkins waiting for a crypto worker
+    pacer.watch_queue(crypto_executor.histograms["decrypt"]["queue"])
+
+def active_licenses():
+    """ Returns the number of active licenses, the count of the pacer while it is fresh """
+    if pacer.count_due():
+        pacer.set_active(License.count_all_active())
+    return pacer.active
+
+def next_checkin_header(count=True):
+    """ Returns the header recommending the interval of the next checkin, `count` False never reads the database """
+    return {"X-Next-Checkin": str(pacer.next_interval(count))}
+
+def record_checkin(license_ids, checkin_time):
+    """ Records the checkin of licenses, buffered if write-behind is enabled """
+    if heartbeats:
+        heartbeats.record(license_ids, checkin_time)
+    else:
+        License.touch(license_ids, checkin_time)
+    license_cache.record_checkins(license_ids, checkin_time)
+
+def find_license(license_id):
+    """ Finds a License with its key material, through the License cache """
+    return license_cache.get(license_id, License)
+
+def store_session(lic):
+    """ Stores the session key opened by a checkin, of a License that may come from the cache """
+    License.set_session_key(lic.id, lic.session_key)
+    license_cache.invalidate([lic.id])
+
+def buffered_checkin(license_id):
+    """ Returns the checkin of a license not written to the database yet """
+    return heartbeats.last_checkin(license_id) if heartbeats else None
 
 def check_content_type(content_type):
     """ Checks that the media type is correct """
@@ -367,16 +869,132 @@ def check_content_type(content_type):
     app.logger.error("Invalid Content-Type: %s", request.headers["Content-Type"])
     abort(415, "Content-Type must be {}".format(content_type))
 
+def answer_checkin(lic, body):
+    """Answers the challenge of a checkin in the protocol mode it uses
+
+    - `encrypted_message`: the message encrypted with the pub_key (RSA mode)
+    - `encrypted_session_key` and `nonce`: opens a session (session mode)
+    - `nonce` and `proof`: a checkin within the session (session mode)
+
+    """
+    if "proof" in body:
+        return answer_session_challenge(lic, body["nonce"], body["proof"])
+    if opens_session(body):
+        return open_session(lic, body["encrypted_session_key"], body["nonce"])
+    return answer_challenge(lic, body["encrypted_message"])
+
+def decode_nonce(nonce):
+    """ Converts the nonce of a checkin from ascii string to bytes """
+    nonce_bytes = base64.b64decode(nonce.encode('ascii', 'strict'))
+    if len(nonce_bytes) < NONCE_MIN_BYTES:
+        raise ValueError("The nonce must be at least {} bytes".format(NONCE_MIN_BYTES))
+    return nonce_bytes
+
+def opens_session(body):
+    """ Returns True if a checkin opens a session (see answer_checkin()) """
+    return "proof" not in body and "encrypted_session_key" in body
+
+def open_session(lic, encrypted_session_key, nonce):
+    """Sets the session key a container encrypted with the pub_key
+
+    This is the only RSA operation of the session. The answer proves the
+    server could decrypt the key: the tag of the nonce under that key.
+    The caller stores the session key of the License.
+    """
+    nonce_bytes = decode_nonce(nonce)
+    encrypted_session_key_bytes = base64.b64decode(encrypted_session_key.encode('ascii', 'strict'))
+    session_key = crypto_executor.decrypt(lic.id, lic.private_key, encrypted_session_key_bytes)
+    if len(session_key) != SESSION_KEY_BYTES:
+        raise ValueError("The session key must be {} bytes".format(SESSION_KEY_BYTES))
+
+    # stored and cached sealed, like the private key
+    lic.session_key = key_store.wrap_secret(session_key)
+    app.logger.info("Opened a checkin session for license with id: %s", lic.id)
+    return base64.b64encode(session_tag(session_key, b"server", lic.id, nonce_bytes)).decode('ascii', 'strict')
+
+def answer_session_challenge(lic, nonce, proof):
+    """Verifies the proof of a checkin within a session and answers it
+
+    A License without a session (never opened, or reset by a change of its
+    keypair) answers 409 Conflict, telling the container to open a new one.
+    """
+    if not lic.session_key:
+        raise Conflict("License with id '{}' has no checkin session.".format(lic.id))
+    return session_answer(lic.session_key, lic.id, nonce, proof)
+
+def session_answer(session_key, license_id, nonce, proof):
+    """ Verifies a proof with the sealed session key of a License, returns the answer """
+    nonce_bytes = decode_nonce(nonce)
+    session_key = key_store.unwrap_secret(session_key)
+    expected = session_tag(session_key, b"client", license_id, nonce_bytes)
+    if not hmac.compare_digest(expected, base64.b64decode(proof.encode('ascii', 'strict'))):
+        raise Forbidden("The checkin proof of '{}' is not valid.".format(license_id))
+    return base64.b64encode(session_tag(session_key, b"server", license_id, nonce_bytes)).decode('ascii', 'strict')
+
+def answer_token_checkin(license_id, body):
+    """Answers a session checkin from its lease token, without the database
+
+    The token vouches for the License being active and used by the container,
+    and carries the session key the proof is verified with. A checkin that
+    is not in the session mode, has no valid token or one close to its expiry
+    is answered from the database instead, which renews the token.
+
+    :return: the answer, None if the checkin has to be checked against the database
+    :rtype: str
+
+    """
+    if "proof" not in body or "lease_token" not in body:
+        return None
+    claims = lease_tokens.verify(body["lease_token"], license_id, body["used_by"])
+    if claims is None or "sk" not in claims:
+        return None
+    answer = session_answer(claims["sk"], license_id, body["nonce"], body["proof"])
+    lease_tokens.accept()
+    return answer
+
+def lease_token_header(lic):
+    """ Returns the header carrying a fresh lease token of a License, if enabled """
+    token = lease_tokens.issue(lic)
+    return {"X-Lease-Token": token} if token else {}
+
+def answer_challenge(lic, encrypted_message):
+    """ Decrypts the checkin message of a License and returns it as ascii string """
+    # convert the encrypted_message from ascii string to bytes
+    app.logger.debug("Decrypting the checkin message of license %s", lic.id)
+    encrypted_message_bytes = base64.b64decode(encrypted_message.encode('ascii', 'strict'))
+
+    # decrypt the message
+    decrypted_message_byte = crypto_executor.decrypt(lic.id, lic.private_key, encrypted_message_bytes)
+
+    # send the decrypted_message as ascii string
+    decrypted_message = base64.b64encode(decrypted_message_byte).decode('ascii', 'strict')
+    # For testing the replay attack:
+    # decrypted_message = 'ABCDEFG12345'
+    return decrypted_message
+
+def checkin_mode(body):
+    """ Returns the protocol mode of a checkin (see answer_checkin()) """
+    if not isinstance(body, dict):
+        return "unknown"
+    if "proof" in body:
+        return "session"
+    if opens_session(body):
+        return "session_open"
+    return "rsa"
+
+def count_checkin(body, status_code):
+    """ Counts a checkin by its protocol mode and status in the metrics """
+    checkins_total.labels(checkin_mode(body), status_code).inc()
+
+def observe_request(method, route, status_code, seconds):
+    """ Records the latency and the status of a request in the metrics """
+    request_duration.labels(method, route).observe(seconds)
+    requests_total.labels(method, route, status_code).inc()
+
+def checkin_result(license_id, status_code, message):
+    """ Builds the result of one entry of a batch checkin """
+    return {"id": license_id, "status": status_code, "message": message}
+
 # TODO:
 def authenticate(username, password):
     return True
-
-def check_license_available(username, max_license_available):
-    licenses = License.find_by_query_string({
-        "username": username,
-        "is_active": True
-    })
-    results = [lic.serialize() for lic in licenses]
-    app.logger.info("Returning %d licenses", len(results))
-
-    return True if len(results) < max_license_available else False
@@ -0,0 +1,121 @@
+"""
+Micro-benchmark of the checkin challenge modes
+
+Compares the ops/sec of the rsa and the session checkin modes for every key
+algorithm, once for the bare challenge (client build, server answer, client
+verify, no I/O) and once for whole POST /licenses/{id}/checkin requests
+through an in-process Authorizing Server on DATABASE_URI. The keypair
+generation and the unwrapping of a stored private key (with the passphrase
+and with the envelope key store) are measured as well:
+
+    python bench/checkin_crypto.py --seconds 3 --algorithms rsa,x25519
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+parser.add_argument("--seconds", type=float, default=2.0, help="duration of every measurement")
+parser.add_argument("--algorithms", default="rsa,x25519", help="comma separated key algorithms")
+args = parser.parse_args()
+
+os.environ.setdefault(
+    "DATABASE_URI", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "checkin.db")
+)
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(root, "AuthSrvr"))
+sys.path.insert(0, os.path.join(root, "App"))
+
+from service import app, routes  # noqa: E402  pylint: disable=wrong-import-position
+from service.crypto import generate_private_key  # noqa: E402  pylint: disable=wrong-import-position
+from service.keystore import PassphraseKeyStore, EnvelopeKeyStore  # noqa: E402  pylint: disable=wrong-import-position
+from challenge import CheckinChallenge, CHECKIN_MODES  # noqa: E402  pylint: disable=wrong-import-position
+
+
+def measure(operation):
+    """ Runs an operation for args.seconds, returns its ops/sec """
+    count = 0
+    start = time.perf_counter()
+    deadline = start + args.seconds
+    while time.perf_counter() < deadline:
+        operation()
+        count += 1
+    return count / (time.perf_counter() - start)
+
+
+def grant(client, used_by, algorithm):
+    """ Gets a license from the in-process server """
+    res = client.post(
+        "/licenses",
+        json={"username": used_by, "password": "", "used_by": used_by, "key_algorithm": algorithm},
+    )
+    return res.get_json()
+
+
+def bench_challenge(lic, mode):
+    """ Client and server side of the challenge, without the request """
+    with app.app_context():
+        stored = routes.License.find(lic["id"], keys=True)
+        challenge = CheckinChallenge(lic["id"], lic["pub_key"], mode)
+        if mode == "session":
+            # the session is opened once, outside of the measurement
+            assert challenge.verify(routes.answer_checkin(stored, challenge.build()))
+
+        def checkin():
+            assert challenge.verify(routes.answer_checkin(stored, challenge.build()))
+
+        return measure(checkin)
+
+
+def bench_request(client, lic, mode):
+    """ Whole checkin requests, including the database round trips """
+    challenge = CheckinChallenge(lic["id"], lic["pub_key"], mode)
+    url = "/licenses/{}/checkin".format(lic["id"])
+
+    def checkin():
+        data = {"used_by": lic["used_by"], "pub_key": lic["pub_key"]}
+        data.update(challenge.build())
+        res = client.post(url, json=data)
+        assert res.status_code == 200 and challenge.verify(res.get_data(as_text=True))
+
+    checkin()
+    return measure(checkin)
+
+
+client = app.test_client()
+run = "bench-{}".format(int(time.time()))
+algorithms = args.algorithms.split(",")
+
+passphrase_store = PassphraseKeyStore(b"mypassword")
+envelope_store = EnvelopeKeyStore(os.urandom(32))
+
+print("{:<10} {:>14} {:>18} {:>18}".format("algorithm", "keygen/s", "passphrase load/s", "envelope load/s"))
+for algorithm in algorithms:
+    private_key_obj = generate_private_key(algorithm)
+    passphrase_key = passphrase_store.wrap(private_key_obj)
+    envelope_key = envelope_store.wrap(private_key_obj)
+    print("{:<10} {:>14.1f} {:>18.1f} {:>18.1f}".format(
+        algorithm,
+        measure(lambda: generate_private_key(algorithm)),  # pylint: disable=cell-var-from-loop
+        measure(lambda: passphrase_store.unwrap(passphrase_key)),  # pylint: disable=cell-var-from-loop
+        measure(lambda: envelope_store.unwrap(envelope_key)),  # pylint: disable=cell-var-from-loop
+    ))
+
+results = {}
+for algorithm in algorithms:
+    for mode in CHECKIN_MODES:
+        lic = grant(client, "{}-{}-{}".format(run, algorithm, mode), algorithm)
+        results[algorithm, mode] = (bench_challenge(lic, mode), bench_request(client, lic, mode))
+
+print()
+print("{:<10} {:<10} {:>14} {:>14}".format("algorithm", "mode", "challenge/s", "request/s"))
+for (algorithm, mode), (challenge_ops, request_ops) in results.items():
+    print("{:<10} {:<10} {:>14.1f} {:>14.1f}".format(algorithm, mode, challenge_ops, request_ops))
+for algorithm in algorithms:
+    rsa, session = results[algorithm, "rsa"], results[algorithm, "session"]
+    print("{} session/rsa: {:.1f}x challenge, {:.1f}x request".format(
+        algorithm, session[0] / rsa[0], session[1] / rsa[1]
+    ))
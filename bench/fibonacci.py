@@ -0,0 +1,52 @@
+"""
+Micro-benchmark of the Fibonacci workload of the App
+
+Times the former linear loop against fast doubling for a range of numbers,
+without and with the LRU cache, and one batch of all of the numbers against
+computing them one by one:
+
+    python bench/fibonacci.py --numbers 1000,10000,100000 --repeat 5
+"""
+
+import os
+import sys
+import time
+import argparse
+
+parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+parser.add_argument("--numbers", default="100,1000,10000,100000", help="comma separated numbers")
+parser.add_argument("--repeat", type=int, default=5, help="runs of every measurement, the best one counts")
+args = parser.parse_args()
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "App"))
+
+from fibonacci import FibonacciEngine, fib_linear, fib_pair  # noqa: E402  pylint: disable=wrong-import-position
+
+numbers = [int(number) for number in args.numbers.split(",")]
+
+
+def best(operation):
+    """ Returns the shortest of args.repeat runs of an operation, in milliseconds """
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        operation()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+print("{:>8} {:>12} {:>12} {:>12} {:>9}".format("n", "linear ms", "doubling ms", "cached ms", "speedup"))
+for n in numbers:
+    engine = FibonacciEngine(max_n=max(numbers))
+    engine.compute(n)
+    linear = best(lambda: fib_linear(n))
+    doubling = best(lambda: fib_pair(n))
+    cached = best(lambda: engine.compute(n))
+    print("{:>8} {:>12.3f} {:>12.3f} {:>12.4f} {:>8.0f}x".format(n, linear, doubling, cached, linear / doubling))
+
+batch = list(range(max(numbers) - 100, max(numbers) + 1)) + numbers
+one_by_one = best(lambda: [fib_pair(n) for n in batch])
+shared = best(lambda: FibonacciEngine(max_n=max(numbers), cache_size=0).compute_many(batch))
+print("batch of {} numbers up to {}: {:.2f} ms one by one, {:.2f} ms in one batch".format(
+    len(batch), max(numbers), one_by_one, shared
+))
@@ -0,0 +1,272 @@
+"""
+Fleet simulation of containers checking in with the Authorizing Server
+
+Simulates a fleet of virtual containers, each going through the lifecycle of
+the App over HTTP: POST /licenses, a number of checkins answering real
+challenges (rsa or session mode, see App/challenge.py), and the PATCH that
+revokes the license on exit. The throughput and the p50/p95/p99 latencies
+of every endpoint are written as JSON, and two such reports can be compared
+to catch the regressions of a build:
+
+    python bench/fleet.py --containers 200 --concurrency 20 --checkins 10 --output new.json
+    python bench/fleet.py --url http://localhost:5000 --mode session --output new.json
+    python bench/fleet.py --compare base.json new.json --threshold 0.1
+
+Without --url the server is started in-process, on a local port, against
+DATABASE_URI (a temporary SQLite database by default, or a local Postgres).
+The comparison exits with status 1 if an endpoint got slower or lost
+throughput by more than the threshold, or failed more often.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import logging
+import argparse
+import tempfile
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlparse
+
+parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+parser.add_argument("--url", help="base URL of a running server, started in-process if unset")
+parser.add_argument("--containers", type=int, default=50, help="number of virtual containers")
+parser.add_argument("--concurrency", type=int, default=10, help="number of containers running at once")
+parser.add_argument("--checkins", type=int, default=5, help="checkins of every container")
+parser.add_argument("--interval", type=float, default=0.0, help="seconds between two checkins of a container")
+parser.add_argument("--mode", default="rsa", help="checkin mode, rsa or session")
+parser.add_argument("--algorithm", default="rsa", help="key algorithm of the licenses")
+parser.add_argument("--label", default="", help="name of the build recorded in the report")
+parser.add_argument("--output", help="file to write the JSON report to, stdout if unset")
+parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="compare two reports instead of running")
+parser.add_argument("--threshold", type=float, default=0.10, help="tolerated relative regression of --compare")
+args = parser.parse_args()
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(root, "App"))
+
+# the endpoints of the lifecycle, in the order they are reported
+ENDPOINTS = ("grant", "checkin", "revoke")
+PERCENTILES = (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))
+
+
+######################################################################
+#  R E C O R D I N G
+######################################################################
+class Recorder:
+    """
+    Class that collects the latency and the outcome of every request
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.errors = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, status_code, ok):
+        """ Records one request, `status_code` is "error" if it got no response """
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            self.statuses[endpoint][str(status_code)] += 1
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def report(self, duration):
+        """ Returns the statistics of every endpoint """
+        endpoints = {}
+        for endpoint in ENDPOINTS:
+            latencies = sorted(self.latencies[endpoint])
+            if not latencies:
+                continue
+            count = len(latencies)
+            latency_ms = {name: round(percentile(latencies, q) * 1000, 3) for name, q in PERCENTILES}
+            latency_ms["mean"] = round(sum(latencies) / count * 1000, 3)
+            latency_ms["max"] = round(latencies[-1] * 1000, 3)
+            endpoints[endpoint] = {
+                "requests": count,
+                "errors": self.errors[endpoint],
+                "throughput": round(count / duration, 2),
+                "latency_ms": latency_ms,
+                "statuses": dict(self.statuses[endpoint]),
+            }
+        return endpoints
+
+
+def percentile(ordered, q):
+    """ Returns the nearest-rank percentile of sorted values """
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+######################################################################
+#  F L E E T
+######################################################################
+def start_server():
+    """ Serves the Authorizing Server in-process on a free local port, returns its URL """
+    os.environ.setdefault(
+        "DATABASE_URI", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "fleet.db")
+    )
+    sys.path.insert(0, os.path.join(root, "AuthSrvr"))
+    from werkzeug.serving import make_server  # pylint: disable=import-outside-toplevel
+    from service import app  # pylint: disable=import-outside-toplevel
+
+    # one access log line per request would drown the report
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="fleet-server", daemon=True).start()
+    return "http://127.0.0.1:{}".format(server.server_port)
+
+
+def run_container(number, url, run, recorder):
+    """ Runs the lifecycle of one virtual container """
+    import requests  # pylint: disable=import-outside-toplevel
+    from challenge import CheckinChallenge  # pylint: disable=import-outside-toplevel
+
+    session = requests.Session()
+    container_id = "{}-{}".format(run, number)
+
+    def call(endpoint, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            res = session.request(method, url + path, timeout=30, **kwargs)
+        except requests.exceptions.RequestException:
+            recorder.record(endpoint, time.perf_counter() - start, "error", False)
+            return None
+        return res, time.perf_counter() - start
+
+    # every container is a user of its own, the quota never gets in the way
+    result = call("grant", "POST", "/licenses", json={
+        "username": container_id, "password": "", "used_by": container_id, "key_algorithm": args.algorithm,
+    })
+    if result is None:
+        return
+    res, seconds = result
+    recorder.record("grant", seconds, res.status_code, res.status_code == 201)
+    if res.status_code != 201:
+        return
+    lic = res.json()
+    lease_token = res.headers.get("X-Lease-Token")
+    challenge = CheckinChallenge(lic["id"], lic["pub_key"], args.mode)
+
+    for checkin in range(args.checkins):
+        if checkin and args.interval:
+            time.sleep(args.interval)
+        data = {"used_by": container_id, "pub_key": lic["pub_key"]}
+        data.update(challenge.build())
+        if lease_token:
+            data["lease_token"] = lease_token
+        result = call("checkin", "POST", "/licenses/{}/checkin".format(lic["id"]), json=data)
+        if result is None:
+            continue
+        res, seconds = result
+        ok = res.status_code == 200 and challenge.verify(res.text)
+        recorder.record("checkin", seconds, res.status_code, ok)
+        if res.status_code == 409:
+            challenge.reset_session()
+        lease_token = res.headers.get("X-Lease-Token") or lease_token
+
+    # revoke on exit, as the App does
+    result = call("revoke", "PATCH", "/licenses/{}".format(lic["id"]), json={
+        "is_active": False, "revoked_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    })
+    if result is not None:
+        res, seconds = result
+        recorder.record("revoke", seconds, res.status_code, res.status_code == 200)
+
+
+def run_fleet():
+    """ Runs the whole fleet, returns the report """
+    url = (args.url or start_server()).rstrip("/")
+    database = urlparse(os.environ.get("DATABASE_URI", "")).scheme if not args.url else None
+    # tag the containers of this run so reruns against the same database start clean
+    run = "fleet-{}".format(int(time.time()))
+    recorder = Recorder()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for future in [executor.submit(run_container, i, url, run, recorder) for i in range(args.containers)]:
+            future.result()
+    duration = time.perf_counter() - start
+
+    return {
+        "label": args.label,
+        "url": url,
+        "database": database,
+        "containers": args.containers,
+        "concurrency": args.concurrency,
+        "checkins": args.checkins,
+        "interval": args.interval,
+        "mode": args.mode,
+        "algorithm": args.algorithm,
+        "duration_seconds": round(duration, 3),
+        "endpoints": recorder.report(duration),
+    }
+
+
+######################################################################
+#  C O M P A R I S O N
+######################################################################
+def compare(base, new, threshold):
+    """Compares the endpoints of two reports
+
+    :return: the changes of every endpoint, and whether any of them regressed
+    :rtype: tuple
+
+    """
+    changes, regressed = {}, False
+    for endpoint in ENDPOINTS:
+        if endpoint not in base["endpoints"] or endpoint not in new["endpoints"]:
+            continue
+        old, cur = base["endpoints"][endpoint], new["endpoints"][endpoint]
+        change = {"throughput": relative(old["throughput"], cur["throughput"])}
+        for name, _ in PERCENTILES:
+            change[name] = relative(old["latency_ms"][name], cur["latency_ms"][name])
+        change["error_rate"] = round(cur["errors"] / cur["requests"] - old["errors"] / old["requests"], 4)
+        change["regressed"] = (
+            change["throughput"] < -threshold
+            or any(change[name] > threshold for name in ("p95", "p99"))
+            or change["error_rate"] > 0
+        )
+        regressed = regressed or change["regressed"]
+        changes[endpoint] = change
+    return changes, regressed
+
+
+def relative(old, new):
+    """ Returns the relative change from old to new """
+    if not old:
+        return 0.0
+    return round((new - old) / old, 4)
+
+
+if args.compare:
+    reports = []
+    for path in args.compare:
+        with open(path) as report_file:
+            reports.append(json.load(report_file))
+    changes, regressed = compare(reports[0], reports[1], args.threshold)
+    for endpoint, change in changes.items():
+        print("{:8} throughput {:+.1%}  p50 {:+.1%}  p95 {:+.1%}  p99 {:+.1%}  errors {:+.2%}{}".format(
+            endpoint, change["throughput"], change["p50"], change["p95"], change["p99"],
+            change["error_rate"], "  REGRESSED" if change["regressed"] else "",
+        ), file=sys.stderr)
+    print(json.dumps({"base": reports[0]["label"], "new": reports[1]["label"], "endpoints": changes}, indent=2))
+    if regressed:
+        sys.exit("Error: regressed by more than {:.0%}.".format(args.threshold))
+    sys.exit(0)
+
+report = run_fleet()
+for name, stats in report["endpoints"].items():
+    print("{:8} {:6d} requests {:8.1f}/s  p50 {:8.2f}ms  p95 {:8.2f}ms  p99 {:8.2f}ms  errors {}".format(
+        name, stats["requests"], stats["throughput"], stats["latency_ms"]["p50"],
+        stats["latency_ms"]["p95"], stats["latency_ms"]["p99"], stats["errors"],
+    ), file=sys.stderr)
+if args.output:
+    with open(args.output, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+else:
+    print(json.dumps(report, indent=2))